@@ -0,0 +1,256 @@
+"""Micro-benchmark di MessageLogger e DataManager su dati sintetici di dimensione realistica.
+
+Genera log JSONL nel formato di MessageLogger.log_message (N giorni x M chat x K utenti), poi
+misura ogni operazione in un processo separato, così da registrare anche il picco di memoria.
+I risultati si salvano in JSON e si possono confrontare con un'esecuzione precedente.
+
+Esempi:
+    python bench/bench_storage.py --sizes 10000,100000,1000000 --output storage.json
+    python bench/bench_storage.py --sizes 100000 --compare storage.json --threshold 1.25
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+
+WORDS = ("ciao come va oggi domani partita pizza lavoro treno film libro concerto vacanze gatto "
+         "computer progetto ufficio pioggia sole mare montagna cena pranzo caffè birra").split()
+
+LOGGER_OPERATIONS = [
+    "get_recent_logs", "get_chat_message_history", "get_user_message_history",
+    "extract_users_from_logs", "extract_messages_from_logs", "load_logs",
+]
+DATA_MANAGER_OPERATIONS = ["save_user_data", "load_user_data", "save_conversations", "load_conversations"]
+
+
+def chat_ids(chats):
+    return [-1001000000000 - i for i in range(chats)]
+
+
+def user_ids(chat_id, users):
+    return [abs(chat_id) % 100000 * 1000 + i for i in range(users)]
+
+
+def generate_logs(log_dir, records, days, chats, users, seed=1):
+    """Scrive ``records`` voci di log divise su ``days`` file giornalieri; l'ultimo è quello di oggi"""
+    os.makedirs(log_dir, exist_ok=True)
+    rng = random.Random(seed)
+    all_chats = chat_ids(chats)
+    members = {chat_id: user_ids(chat_id, users) for chat_id in all_chats}
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    per_day = max(1, records // days)
+    written = 0
+    for day in range(days):
+        date = today - timedelta(days=days - 1 - day)
+        count = per_day if day < days - 1 else records - written
+        step = 86400 / max(count, 1)
+        path = os.path.join(log_dir, f"telegram_log_{date.strftime('%Y-%m-%d')}.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for i in range(count):
+                chat_id = rng.choice(all_chats)
+                user_id = rng.choice(members[chat_id])
+                moment = (date + timedelta(seconds=i * step)).isoformat()
+                entry = {
+                    "timestamp": moment,
+                    "message_id": written + i,
+                    "chat_id": chat_id,
+                    "chat_type": "supergroup",
+                    "user_id": user_id,
+                    "user_first_name": f"Utente{user_id % 1000}",
+                    "user_last_name": None,
+                    "username": f"utente{user_id}",
+                    "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 20))),
+                    "date": moment,
+                }
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        written += count
+
+
+def generate_data(data_dir, chats, users, seed=1):
+    """Scrive user_data.json e conversations.json con la forma usata da bot.py"""
+    os.makedirs(data_dir, exist_ok=True)
+    rng = random.Random(seed)
+    user_data = {}
+    conversations = {}
+    for chat_id in chat_ids(chats):
+        user_data[chat_id] = {}
+        history = []
+        for user_id in user_ids(chat_id, users):
+            info = {
+                "id": user_id, "first_name": f"Utente{user_id % 1000}", "last_name": "",
+                "username": f"utente{user_id}",
+                "carattere": " ".join(rng.choice(WORDS) for _ in range(50)),
+            }
+            user_data[chat_id][user_id] = info
+        for _ in range(100):
+            info = rng.choice(list(user_data[chat_id].values()))
+            history.append({"role": "user", "content": " ".join(rng.choice(WORDS) for _ in range(12)), "user_info": info})
+        conversations[chat_id] = history
+    with open(os.path.join(data_dir, "user_data.json"), "w", encoding="utf-8") as f:
+        json.dump(user_data, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(data_dir, "conversations.json"), "w", encoding="utf-8") as f:
+        json.dump(conversations, f, ensure_ascii=False, indent=2)
+
+
+def dataset_dir(base_dir, records, days, chats, users):
+    """Genera il dataset se non esiste già e ne restituisce la directory"""
+    path = os.path.join(base_dir, f"r{records}_d{days}_c{chats}_u{users}")
+    marker = os.path.join(path, ".complete")
+    if not os.path.exists(marker):
+        print(f"Generazione di {records} voci di log in {path}...", flush=True)
+        start = time.perf_counter()
+        generate_logs(os.path.join(path, "logs"), records, days, chats, users)
+        generate_data(os.path.join(path, "data"), chats, users)
+        open(marker, "w").close()
+        print(f"  generato in {time.perf_counter() - start:.1f} s", flush=True)
+    return path
+
+
+def run_operation(path, operation, chats, users, repeat):
+    """Eseguito nel processo figlio: misura un'operazione e stampa il risultato in JSON"""
+    sys.path.insert(0, SRC_DIR)
+    import logging
+    logging.disable(logging.CRITICAL)
+    from logger import MessageLogger
+    from data_manager import DataManager
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    message_logger = MessageLogger(os.path.join(path, "logs"))
+    data_manager = DataManager(os.path.join(path, "data"))
+    chat_id = chat_ids(chats)[0]
+    user_id = user_ids(chat_id, users)[0]
+
+    if operation in ("save_user_data", "save_conversations"):
+        loaded = data_manager.load_user_data() if operation == "save_user_data" else data_manager.load_conversations()
+        # Le chiavi tornano stringhe dal JSON, come dopo un riavvio del bot
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        call = lambda: getattr(data_manager, operation)(loaded)
+    elif operation in DATA_MANAGER_OPERATIONS:
+        call = getattr(data_manager, operation)
+    elif operation == "get_recent_logs":
+        call = lambda: message_logger.get_recent_logs(100)
+    elif operation == "get_chat_message_history":
+        call = lambda: message_logger.get_chat_message_history(chat_id)
+    elif operation == "get_user_message_history":
+        call = lambda: message_logger.get_user_message_history(chat_id, user_id)
+    else:
+        call = getattr(message_logger, operation)
+
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = call()
+        timings.append(time.perf_counter() - start)
+
+    size = len(result) if hasattr(result, "__len__") else result
+    if operation.startswith("save_"):
+        file_name = "user_data.json" if operation == "save_user_data" else "conversations.json"
+        size = os.path.getsize(os.path.join(path, "data", file_name))
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        "seconds": min(timings),
+        "seconds_all": timings,
+        "result_size": size,
+        # ru_maxrss è in KB su Linux
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+        "delta_rss_mb": round((peak_rss - baseline_rss) / 1024, 1),
+    }))
+
+
+def measure(path, operation, chats, users, repeat):
+    command = [sys.executable, os.path.abspath(__file__), "--run-operation", operation, "--dataset", path,
+               "--chats", str(chats), "--users", str(users), "--repeat", str(repeat)]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(results, baseline_path, threshold):
+    """Confronta con un'esecuzione precedente; restituisce le operazioni più lente della soglia"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(entry["records"], entry["operation"]): entry for entry in json.load(f)["results"]}
+    regressions = []
+    for entry in results:
+        previous = baseline.get((entry["records"], entry["operation"]))
+        if not previous or previous["seconds"] <= 0:
+            continue
+        ratio = entry["seconds"] / previous["seconds"]
+        entry["baseline_seconds"] = previous["seconds"]
+        entry["ratio"] = round(ratio, 2)
+        if ratio > threshold:
+            regressions.append(entry)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark di MessageLogger e DataManager")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="numeri di voci di log separati da virgole (es. 10000,...,10000000)")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=25, help="utenti per chat")
+    parser.add_argument("--repeat", type=int, default=3, help="ripetizioni per operazione (si tiene la migliore)")
+    parser.add_argument("--operations", help="sottoinsieme di operazioni separate da virgole")
+    parser.add_argument("--data-dir", default=os.path.join("/tmp", "bot-bench-storage"),
+                        help="dove generare (e riusare) i dataset sintetici")
+    parser.add_argument("--output", help="salva i risultati in questo file JSON")
+    parser.add_argument("--compare", help="file JSON di un'esecuzione precedente da confrontare")
+    parser.add_argument("--threshold", type=float, default=1.25, help="rapporto oltre il quale è una regressione")
+    parser.add_argument("--run-operation", help=argparse.SUPPRESS)
+    parser.add_argument("--dataset", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_operation:
+        run_operation(args.dataset, args.run_operation, args.chats, args.users, args.repeat)
+        return
+
+    operations = args.operations.split(",") if args.operations else LOGGER_OPERATIONS + DATA_MANAGER_OPERATIONS
+    results = []
+    for records in (int(float(size)) for size in args.sizes.split(",")):
+        path = dataset_dir(args.data_dir, records, args.days, args.chats, args.users)
+        print(f"\n{records} voci di log ({args.days} giorni, {args.chats} chat, {args.users} utenti per chat)")
+        for operation in operations:
+            measurement = measure(path, operation, args.chats, args.users, args.repeat)
+            entry = {"records": records, "operation": operation, **measurement}
+            results.append(entry)
+            print(f"  {operation:30s} {entry['seconds'] * 1000:10.1f} ms  "
+                  f"picco RSS {entry['peak_rss_mb']:8.1f} MB (+{entry['delta_rss_mb']} MB)  "
+                  f"risultato {entry['result_size']}", flush=True)
+
+    exit_code = 0
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            exit_code = 1
+            print(f"\nRegressioni oltre {args.threshold}x rispetto a {args.compare}:")
+            for entry in regressions:
+                print(f"  {entry['records']:>10} {entry['operation']:30s} "
+                      f"{entry['baseline_seconds'] * 1000:.1f} -> {entry['seconds'] * 1000:.1f} ms ({entry['ratio']}x)")
+        else:
+            print(f"\nNessuna regressione oltre {args.threshold}x rispetto a {args.compare}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {
+                    "date": datetime.now().isoformat(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "days": args.days, "chats": args.chats, "users": args.users, "repeat": args.repeat,
+                },
+                "results": results,
+            }, f, indent=2)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Bot API finta per i benchmark: risponde ai metodi usati dal bot e registra i messaggi inviati.
+
+Il bot la usa impostando ``telebot.apihelper.API_URL = fake.api_url``.
+"""
+import json
+import time
+import threading
+from urllib.parse import parse_qsl, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeTelegram:
+    """Registra in ``sent`` ogni sendMessage con l'istante di ricezione"""
+
+    def __init__(self, port=0, host="127.0.0.1", bot_username="benchbot", bot_id=999, latency=0.0):
+        self.bot_username = bot_username
+        self.bot_id = bot_id
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.sent = []  # dict con chat_id, text, reply_to_message_id, at
+        self.calls = {}
+        self.message_id = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.api_url = f"http://{host}:{self.port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="FakeTelegram", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def sent_count(self):
+        with self.lock:
+            return len(self.sent)
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {"id": self.bot_id, "is_bot": True, "first_name": "Bench", "username": self.bot_username}
+        if method == "sendMessage":
+            with self.lock:
+                self.message_id += 1
+                self.sent.append({
+                    "chat_id": params.get("chat_id"),
+                    "text": params.get("text", ""),
+                    "reply_to_message_id": params.get("reply_to_message_id"),
+                    "at": time.time(),
+                })
+                message_id = self.message_id
+            chat_id = int(params.get("chat_id", 0))
+            return {
+                "message_id": message_id, "date": int(time.time()), "text": params.get("text", ""),
+                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                "from": {"id": self.bot_id, "is_bot": True, "first_name": "Bench"},
+            }
+        if method == "getUpdates":
+            return []
+        # setWebhook, deleteWebhook e gli altri metodi: basta l'esito positivo
+        return True
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _handle(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    if "json" in (self.headers.get("Content-Type") or ""):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body.decode("utf-8")))
+                with fake.lock:
+                    fake.calls[method] = fake.calls.get(method, 0) + 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                data = json.dumps({"ok": True, "result": fake._result(method, params)}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
@@ -0,0 +1,238 @@
+"""Benchmark end-to-end del bot con Ollama e Bot API finti.
+
+Gli aggiornamenti (sintetici o registrati) passano dagli handler reali di bot.py tramite
+bot.process_new_updates; il bot parla con la Bot API finta e con il mock di Ollama su localhost.
+Alla fine riporta risposte/s, latenza per fase (dalle tracce di /stats), CPU e memoria.
+
+Esempi:
+    python bench/load_test.py --chats 20 --users 8 --messages 2000 --rate 100
+    python bench/load_test.py --updates updates.jsonl --bot-username mio_bot --output risultati.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+sys.path.insert(0, BENCH_DIR)
+
+from mock_ollama import MockOllama
+from fake_telegram import FakeTelegram
+
+PHRASES = [
+    "qualcuno ha visto la partita ieri sera", "stasera pizza o sushi", "domani piove di nuovo",
+    "avete letto la notizia sul treno", "chi viene al concerto sabato", "il mio computer non parte più",
+    "che film mi consigliate", "ho finito il progetto finalmente", "oggi in ufficio è un disastro",
+    "qualcuno sa cucinare la carbonara", "le vacanze quest'anno dove le fate", "il gatto ha rotto un vaso",
+]
+QUESTIONS = [
+    "cosa ne pensi?", "mi consigli un libro?", "riassumi la discussione di oggi",
+    "chi ha ragione secondo te?", "spiegami come funziona un motore elettrico", "che tempo farà domani?",
+]
+
+
+def synthetic_updates(chats, users, messages, mention_ratio, bot_username, seed=42):
+    """Genera messaggi di gruppo casuali; una parte menziona il bot"""
+    rng = random.Random(seed)
+    chat_ids = [-1000000000 - i for i in range(chats)]
+    for update_id in range(1, messages + 1):
+        chat_id = rng.choice(chat_ids)
+        user_id = 1000 + abs(chat_id) % 1000 * users + rng.randrange(users)
+        if rng.random() < mention_ratio:
+            text = f"@{bot_username} {rng.choice(QUESTIONS)}"
+        else:
+            text = rng.choice(PHRASES)
+        yield {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"Utente{user_id}"},
+                "text": text,
+            },
+        }
+
+
+def recorded_updates(path):
+    """Legge aggiornamenti registrati: uno per riga, o risposte getUpdates con il campo result"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            for update in data.get("result", [data]) if isinstance(data, dict) else data:
+                if "message" in update:
+                    update["message"]["date"] = int(time.time())
+                yield update
+
+
+def prepare_workdir(keep):
+    """Directory di lavoro temporanea con i file di dati del progetto (trigger, intercalari)"""
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    source_data = os.path.join(SRC_DIR, "data")
+    os.makedirs(os.path.join(workdir, "data"))
+    for name in os.listdir(source_data):
+        # Dati utente e conversazioni partono vuoti a ogni esecuzione
+        if name.endswith(".json") and name not in ("user_data.json", "conversations.json"):
+            shutil.copy(os.path.join(source_data, name), os.path.join(workdir, "data", name))
+    if not keep:
+        import atexit
+        atexit.register(shutil.rmtree, workdir, True)
+    return workdir
+
+
+def is_idle(app):
+    coalescer = app.reply_coalescer
+    return (
+        app.chat_worker_pool.queue_depth() == 0
+        and (coalescer is None or (coalescer.pending_count() == 0 and not coalescer.busy))
+        and app.send_dispatcher.queue_depth() == 0
+        and not app.send_dispatcher.in_flight
+    )
+
+
+def wait_until_drained(app, fake, settle=2.0, timeout=600.0):
+    """Attende che code e risposte siano ferme per ``settle`` secondi"""
+    deadline = time.monotonic() + timeout
+    last_sent = -1
+    stable_since = time.monotonic()
+    while time.monotonic() < deadline:
+        sent = fake.sent_count()
+        if sent != last_sent or not is_idle(app):
+            last_sent = sent
+            stable_since = time.monotonic()
+        elif time.monotonic() - stable_since >= settle:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def summarize(values):
+    from tracing import percentile
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end del bot")
+    parser.add_argument("--updates", help="file JSONL di aggiornamenti registrati (altrimenti sintetici)")
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--users", type=int, default=8, help="utenti per chat")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--mention-ratio", type=float, default=0.2, help="frazione di messaggi che menzionano il bot")
+    parser.add_argument("--rate", type=float, default=100.0, help="aggiornamenti al secondo (0 = senza pausa)")
+    parser.add_argument("--bot-username", default="benchbot")
+    parser.add_argument("--ollama-latency", type=float, default=0.2, help="secondi prima del primo token")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--response-tokens", type=int, default=60)
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="latenza di ogni chiamata alla Bot API")
+    parser.add_argument("--send-limits", action="store_true", help="mantiene i limiti di invio di Telegram")
+    parser.add_argument("--keep-workdir", action="store_true", help="non cancella log e dati generati")
+    parser.add_argument("--output", help="salva i risultati in questo file JSON")
+    args = parser.parse_args()
+
+    mock = MockOllama(latency=args.ollama_latency, tokens_per_second=args.tokens_per_second,
+                      response_tokens=args.response_tokens).start()
+    fake = FakeTelegram(bot_username=args.bot_username, latency=args.telegram_latency).start()
+
+    # config.py legge l'ambiente all'import: va preparato prima di importare il bot
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    os.environ["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "WARNING")
+    if not args.send_limits:
+        os.environ["SEND_GLOBAL_RATE"] = os.environ["SEND_CHAT_RATE"] = os.environ["SEND_GROUP_PER_MINUTE"] = "1000000"
+    workdir = prepare_workdir(args.keep_workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, SRC_DIR)
+
+    import telebot
+    telebot.apihelper.API_URL = fake.api_url
+    import bot as app
+    from log_setup import setup_logging
+
+    setup_logging()
+    app.create_app()
+    app.ai_service.api_url = mock.url + "/api/chat"
+    app.ai_service.embed_url = mock.url + "/api/embed"
+
+    if args.updates:
+        updates = recorded_updates(args.updates)
+    else:
+        updates = synthetic_updates(args.chats, args.users, args.messages, args.mention_ratio, args.bot_username)
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    fed = mentions = 0
+    mention = f"@{args.bot_username}"
+    for update in updates:
+        if args.rate > 0:
+            # Ritmo costante: si aspetta l'istante previsto per questo aggiornamento
+            delay = start + fed / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if mention in (update.get("message", {}).get("text") or ""):
+            mentions += 1
+        app.bot.process_new_updates([telebot.types.Update.de_json(update)])
+        fed += 1
+    feed_seconds = time.perf_counter() - start
+
+    drained = wait_until_drained(app, fake)
+    elapsed = time.perf_counter() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    stages = {
+        stage: {"count": count, "p50_ms": round(p50 * 1000, 1), "p95_ms": round(p95 * 1000, 1), "p99_ms": round(p99 * 1000, 1)}
+        for stage, (count, p50, p95, p99) in app.tracer.stage_summary().items()
+    }
+    reply_traces = app.tracer.slowest(count=len(app.tracer.traces), name="risposta")
+    replies = len([message for message in fake.sent if message["reply_to_message_id"]])
+    results = {
+        "updates": fed,
+        "mentions": mentions,
+        "replies": replies,
+        "messages_sent": fake.sent_count(),
+        "ollama_requests": mock.requests,
+        "feed_seconds": round(feed_seconds, 2),
+        "elapsed_seconds": round(elapsed, 2),
+        "drained": drained,
+        "updates_per_second": round(fed / feed_seconds, 1) if feed_seconds else None,
+        "replies_per_second": round(replies / elapsed, 2) if elapsed else None,
+        "reply_latency": summarize([trace.total for trace in reply_traces]),
+        "stages": stages,
+        "cpu_seconds": round((usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime), 2),
+        # ru_maxrss è in KB su Linux
+        "max_rss_mb": round(usage_end.ru_maxrss / 1024, 1),
+        "workdir": workdir if args.keep_workdir else None,
+    }
+
+    print(f"Aggiornamenti: {fed} ({results['updates_per_second']}/s), menzioni: {mentions}, risposte: {replies}")
+    print(f"Risposte/s: {results['replies_per_second']} in {results['elapsed_seconds']} s"
+          f"{'' if drained else ' (code non svuotate entro il timeout)'}")
+    latency = results["reply_latency"]
+    print(f"Latenza risposta: p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, p99 {latency['p99_ms']} ms")
+    print("Fasi (campioni, p50 / p95 / p99 ms):")
+    for stage, summary in sorted(stages.items(), key=lambda item: item[1]["p95_ms"], reverse=True):
+        print(f"  {stage:40s} {summary['count']:6d}  {summary['p50_ms']:9.1f} / {summary['p95_ms']:9.1f} / {summary['p99_ms']:9.1f}")
+    print(f"CPU: {results['cpu_seconds']} s, RSS massimo: {results['max_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output if os.path.isabs(args.output) else os.path.join(START_DIR, args.output), "w") as f:
+            json.dump(results, f, indent=2)
+
+
+START_DIR = os.getcwd()
+
+if __name__ == "__main__":
+    main()
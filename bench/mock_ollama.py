@@ -0,0 +1,132 @@
+"""Server finto di Ollama per i benchmark: /api/chat e /api/embed con latenza configurabile.
+
+Uso autonomo:
+    python bench/mock_ollama.py --port 11434 --latency 0.2 --tokens-per-second 40
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = "ciao allora comunque secondo me bella domanda direi che sicuramente forse vediamo".split()
+
+
+class MockOllama:
+    """Simula la generazione: ``latency`` secondi prima del primo token, poi ``tokens_per_second``"""
+
+    def __init__(self, port=0, host="127.0.0.1", latency=0.2, tokens_per_second=40.0, response_tokens=60,
+                 embedding_dim=768):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.embedding_dim = embedding_dim
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.url = f"http://{host}:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="MockOllama", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def _prompt_tokens(self, payload):
+        # Stima grossolana: una parola ~ un token
+        return sum(len(str(message.get("content", "")).split()) for message in payload.get("messages", []))
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                with server.lock:
+                    server.requests += 1
+                if self.path == "/api/embed":
+                    inputs = payload.get("input", [])
+                    inputs = [inputs] if isinstance(inputs, str) else inputs
+                    self._send_json({"embeddings": [
+                        [random.uniform(-1, 1) for _ in range(server.embedding_dim)] for _ in inputs
+                    ]})
+                elif self.path == "/api/chat":
+                    self._chat(payload)
+                else:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+
+            def _chat(self, payload):
+                prompt_tokens = server._prompt_tokens(payload)
+                tokens = [random.choice(WORDS) for _ in range(server.response_tokens)]
+                token_time = 1.0 / server.tokens_per_second if server.tokens_per_second > 0 else 0.0
+                start = time.perf_counter()
+                time.sleep(server.latency)
+                final = {
+                    "model": payload.get("model", "mock"),
+                    "done": True,
+                    "prompt_eval_count": prompt_tokens,
+                    "prompt_eval_duration": int(server.latency * 1e9),
+                    "eval_count": len(tokens),
+                }
+                if payload.get("stream", True) is False:
+                    time.sleep(token_time * len(tokens))
+                    final["message"] = {"role": "assistant", "content": " ".join(tokens)}
+                    final["eval_duration"] = int(token_time * len(tokens) * 1e9)
+                    final["total_duration"] = int((time.perf_counter() - start) * 1e9)
+                    self._send_json(final)
+                    return
+                # Streaming come Ollama: una riga JSON per token, poi quella finale con done=true
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for token in tokens:
+                    time.sleep(token_time)
+                    self._write_chunk({"message": {"role": "assistant", "content": token + " "}, "done": False})
+                final["message"] = {"role": "assistant", "content": ""}
+                final["total_duration"] = int((time.perf_counter() - start) * 1e9)
+                self._write_chunk(final)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write_chunk(self, body):
+                data = (json.dumps(body) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server finto di Ollama")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=0.2, help="secondi prima del primo token")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--response-tokens", type=int, default=60)
+    args = parser.parse_args()
+    mock = MockOllama(args.port, args.host, args.latency, args.tokens_per_second, args.response_tokens)
+    print(f"Mock Ollama in ascolto su {mock.url}")
+    try:
+        mock.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
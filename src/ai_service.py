@@ -1,12 +1,41 @@
 import requests
 import json
+import logging
 import os
 import random
+import threading
+from collections import OrderedDict
+
+from log_setup import should_sample, summarize_payload, summarize_response
+from metrics import LLM_LATENCY, LLM_ERRORS, LLM_PROMPT_EVAL_TOKENS, LLM_PROMPT_EVAL_SECONDS
+
+log = logging.getLogger(__name__)
+
+# Coppie (metodo, chat) tenute nelle statistiche di valutazione del prompt; le meno recenti escono
+PROMPT_EVAL_MAX_ENTRIES = 500
+
+# Metodi che servono una risposta in attesa; gli altri girano in background
+INTERACTIVE_METHODS = {"generate_response", "analyze_message_history", "analyze_message_history_with_focus"}
+
+
+def method_priority(method):
+    return "interattiva" if method in INTERACTIVE_METHODS else "background"
+
 
 class AIService:
-    def __init__(self, model="llama3", api_url="http://localhost:11434/api/chat", log_dir="./logs"):
+    def __init__(self, model="llama3", api_url="http://localhost:11434/api/chat", log_dir="./logs",
+                 embedding_model="nomic-embed-text", embed_url="http://localhost:11434/api/embed", keep_alive=None,
+                 usage_ledger=None, background_timeout=None, embed_timeout=30):
         self.model = model
         self.api_url = api_url
+        self.keep_alive = keep_alive
+        self.prompt_eval_stats = OrderedDict()  # (metodo, chat_id) -> token e tempo, dalla meno recente
+        self.stats_lock = threading.Lock()
+        self.embedding_model = embedding_model
+        self.embed_url = embed_url
+        self.embed_timeout = embed_timeout  # secondi massimi per una chiamata di embedding
+        self.usage_ledger = usage_ledger  # UsageLedger opzionale per le statistiche di ogni chiamata
+        self.background_timeout = background_timeout  # secondi massimi per le analisi in background
         
         # Carica gli intercalari e gli appellativi
         self.intercalari_cattivo = self._load_data_file("data/intercalari_cattivo.json", [])
@@ -14,12 +43,14 @@ class AIService:
         self.appellativi_cattivo = self._load_data_file("data/appellativi_cattivo.json", [])
         self.appellativi_non_cattivo = self._load_data_file("data/appellativi_non_cattivo.json", [])
         
-        print(f"Caricati {len(self.intercalari_cattivo)} intercalari cattivi e {len(self.intercalari_non_cattivo)} intercalari non cattivi")
-        print(f"Caricati {len(self.appellativi_cattivo)} appellativi cattivi e {len(self.appellativi_non_cattivo)} appellativi non cattivi")
-        print(f"Intercalari cattivi: {self.intercalari_cattivo}")
-        print(f"Intercalari non cattivi: {self.intercalari_non_cattivo}")
-        print(f"Appellativi cattivi: {self.appellativi_cattivo}")
-        print(f"Appellativi non cattivi: {self.appellativi_non_cattivo}")
+        log.info("Caricati %d intercalari cattivi e %d intercalari non cattivi",
+                 len(self.intercalari_cattivo), len(self.intercalari_non_cattivo))
+        log.info("Caricati %d appellativi cattivi e %d appellativi non cattivi",
+                 len(self.appellativi_cattivo), len(self.appellativi_non_cattivo))
+        log.debug("Intercalari cattivi: %s", self.intercalari_cattivo)
+        log.debug("Intercalari non cattivi: %s", self.intercalari_non_cattivo)
+        log.debug("Appellativi cattivi: %s", self.appellativi_cattivo)
+        log.debug("Appellativi non cattivi: %s", self.appellativi_non_cattivo)
 
     def _load_data_file(self, filepath, default_value):
         """Carica un file JSON e restituisce il contenuto"""
@@ -27,28 +58,135 @@ class AIService:
             if os.path.exists(filepath):
                 with open(filepath, "r", encoding="utf-8") as f:
                     return json.load(f)
-            print(f"⚠️ File {filepath} non trovato. Uso valore predefinito.")
+            log.warning("⚠️ File %s non trovato. Uso valore predefinito.", filepath)
             return default_value
         except json.JSONDecodeError as e:
-            print(f"❌ Errore nel parsing del file {filepath}: {e}")
+            log.error("❌ Errore nel parsing del file %s: %s", filepath, e)
             return default_value
         except Exception as e:
-            print(f"❌ Errore nel caricamento del file {filepath}: {e}")
+            log.error("❌ Errore nel caricamento del file %s: %s", filepath, e)
             return default_value
 
-    def analyze_user_character(self, user_messages):
-        """Analizza il carattere dell'utente basandosi sui suoi messaggi"""
+    def _post_chat(self, payload, method, chat_id=None):
+        """Invia il payload all'endpoint chat di Ollama e decodifica la risposta una sola volta"""
+        timeout, sampled = self.begin_chat(payload, method)
+        try:
+            with LLM_LATENCY.time(method):
+                response = requests.post(self.api_url, json=payload, timeout=timeout)
+                response.raise_for_status()
+                result = response.json()
+        except Exception:
+            LLM_ERRORS.inc(method)
+            raise
+        return self.end_chat(payload, method, chat_id, result, sampled)
+
+    def begin_chat(self, payload, method):
+        """Parte comune di ogni chiamata a /api/chat prima dell'invio (anche per il client asyncio).
+
+        Completa il payload e restituisce (timeout in secondi o None, se il log DEBUG è campionato).
+        """
+        if self.keep_alive is not None:
+            payload.setdefault("keep_alive", self.keep_alive)
+
+        # Il riassunto del payload costa CPU: lo calcoliamo solo se il DEBUG è attivo e campionato
+        sampled = log.isEnabledFor(logging.DEBUG) and should_sample()
+        if sampled:
+            log.debug("%s: payload inviato %s", method, summarize_payload(payload))
+        # Un'analisi in background bloccata non deve occupare per sempre un thread del pool
+        timeout = self.background_timeout if method_priority(method) == "background" else None
+        return timeout, sampled
+
+    def end_chat(self, payload, method, chat_id, result, sampled):
+        """Parte comune dopo la risposta: log campionato, statistiche del prompt e registro di uso"""
+        if sampled:
+            log.debug("%s: risposta ricevuta %s", method, summarize_response(result))
+        self._record_prompt_eval(method, chat_id, result)
+        self._record_usage(method, chat_id, payload, result)
+        return result
+
+    def _record_usage(self, method, chat_id, payload, result):
+        """Aggiunge la chiamata al registro di uso, se configurato; un errore non blocca la risposta"""
+        if self.usage_ledger is None:
+            return
+        try:
+            self.usage_ledger.record(method, chat_id, result.get("model") or payload.get("model"),
+                                     method_priority(method), result)
+        except Exception as e:
+            log.warning("Impossibile aggiornare il registro di uso: %s", e)
+
+    def _record_prompt_eval(self, method, chat_id, result):
+        """Accumula per chat i token e il tempo di valutazione del prompt riportati da Ollama"""
+        if "prompt_eval_count" not in result:
+            return
+        tokens = result.get("prompt_eval_count", 0)
+        duration_ms = result.get("prompt_eval_duration", 0) / 1e6
+        LLM_PROMPT_EVAL_TOKENS.inc(method, amount=tokens)
+        LLM_PROMPT_EVAL_SECONDS.inc(method, amount=duration_ms / 1000)
+        with self.stats_lock:
+            stats = self.prompt_eval_stats.pop((method, chat_id), None) or {
+                "calls": 0, "prompt_eval_count": 0, "prompt_eval_ms": 0.0, "last_count": 0
+            }
+            stats["calls"] += 1
+            stats["prompt_eval_count"] += tokens
+            stats["prompt_eval_ms"] += duration_ms
+            stats["last_count"] = tokens
+            self.prompt_eval_stats[(method, chat_id)] = stats
+            while len(self.prompt_eval_stats) > PROMPT_EVAL_MAX_ENTRIES:
+                self.prompt_eval_stats.popitem(last=False)
+        # Con il prefisso in cache Ollama valuta solo i token nuovi: conteggio e durata calano
+        log.debug("%s chat %s: prompt_eval %d token in %.0f ms", method, chat_id, tokens, duration_ms)
+
+    def get_prompt_eval_stats(self):
+        """Restituisce una copia delle statistiche di valutazione del prompt per metodo e chat"""
+        with self.stats_lock:
+            return {key: dict(value) for key, value in self.prompt_eval_stats.items()}
+
+    def prompt_eval_summary(self):
+        """Statistiche di valutazione del prompt sommate per metodo, sulle chat ancora tenute"""
+        summary = {}
+        for (method, _), stats in self.get_prompt_eval_stats().items():
+            total = summary.setdefault(method, {"calls": 0, "prompt_eval_count": 0, "prompt_eval_ms": 0.0})
+            for key in total:
+                total[key] += stats[key]
+        return summary
+
+    def embed_texts(self, texts):
+        """Calcola gli embedding di una lista di testi con l'endpoint embed di Ollama"""
+        payload = {"model": self.embedding_model, "input": texts}
+        try:
+            with LLM_LATENCY.time("embed_texts"):
+                response = requests.post(self.embed_url, json=payload, timeout=self.embed_timeout)
+                response.raise_for_status()
+                return response.json()["embeddings"]
+        except Exception:
+            LLM_ERRORS.inc("embed_texts")
+            raise
+
+    def analyze_user_character(self, user_messages, previous_profile=None, chat_id=None):
+        """Analizza il carattere dell'utente basandosi sui suoi messaggi.
+        
+        Con previous_profile il modello raffina il profilo esistente invece di ripartire da zero.
+        """
         try:
             # Se non abbiamo abbastanza messaggi, ritorna
             if len(user_messages) < 3:
                 return None
+            
+            previous_text = ""
+            if previous_profile:
+                previous_text = f"""
+            Profilo già rilevato in precedenza:
+            {previous_profile}
+            
+            Aggiornalo alla luce dei messaggi qui sotto: mantieni i tratti confermati, correggi quelli smentiti.
+            """
                 
             # Prepariamo la richiesta per l'analisi del carattere
             prompt = f"""
             Analizza il carattere dell'utente basandoti sui seguenti messaggi. 
             Fornisci una breve descrizione (massimo 50 parole) della personalità e del modo di comunicare dell'utente.
             Identifica tratti come formalità/informalità, serietà/giocosità, tecnicità/semplicità, pazienza/impazienza.
-            
+            {previous_text}
             Messaggi dell'utente:
             {json.dumps(user_messages, indent=2)}
             
@@ -67,103 +205,140 @@ class AIService:
                 }
             }
             
-            print(f"Payload inviato: {payload}")
-            
             # Effettua la chiamata API a Ollama locale
-            response = requests.post(self.api_url, json=payload)
-            response.raise_for_status()
-            print(f"Risposta ricevuta: {response.json()}")
-            
-            # Estrai la risposta
-            result = response.json()
+            result = self._post_chat(payload, "analyze_user_character", chat_id=chat_id)
             character_analysis = result["message"]["content"]
             
             return character_analysis
             
         except Exception as e:
-            print(f"Errore durante l'analisi del carattere: {e}")
+            log.error("Errore durante l'analisi del carattere: %s", e)
             return None
     
-    def generate_response(self, messages, system_message=None):
+    def build_response_payload(self, messages, system_message=None):
+        """Costruisce il payload per una risposta dato il system prompt e i messaggi"""
+        if not system_message:
+            from datetime import datetime
+            current_date = datetime.now().strftime("%d %B %Y")
+            system_message = f"Sei un assistente AI italiano molto intelligente, utile e preciso. Oggi è {current_date}, siamo nel 2025."
+        
+        # Istruzione modificata per bilanciare fattualità e utilità
+        system_message = system_message + "\n\nIMPORTANTE: Quando hai informazioni specifiche dal contesto della conversazione, utilizzale come fonte primaria. Quando non hai informazioni dal contesto, utilizza le tue conoscenze generali per fornire risposte utili. Evita di inventare fatti specifici che non puoi verificare, ma condividi liberamente le tue conoscenze generali. Non rispondere 'non ho sufficienti informazioni' a meno che la domanda non richieda dettagli molto specifici che non potresti conoscere."
+        
+        payload_messages = [{"role": "system", "content": system_message}]
+        payload_messages.extend(messages)
+        
+        return {
+            "model": self.model,
+            "messages": payload_messages,
+            "stream": False,
+            "options": {
+                "temperature": 0.5,  # Aumentata per risposte più naturali
+                "num_predict": 1000,  # Aumentata da 300 a 1000 per risposte più lunghe
+                "top_p": 0.8        # Aumentato per maggiore variabilità
+            }
+        }
+    
+    def generate_response(self, messages, system_message=None, chat_id=None):
         """Genera una risposta basata sulla cronologia dei messaggi"""
         try:
-            if not system_message:
-                from datetime import datetime
-                current_date = datetime.now().strftime("%d %B %Y")
-                system_message = f"Sei un assistente AI italiano molto intelligente, utile e preciso. Oggi è {current_date}, siamo nel 2025."
-            
-            # Istruzione modificata per bilanciare fattualità e utilità
-            system_message = system_message + "\n\nIMPORTANTE: Quando hai informazioni specifiche dal contesto della conversazione, utilizzale come fonte primaria. Quando non hai informazioni dal contesto, utilizza le tue conoscenze generali per fornire risposte utili. Evita di inventare fatti specifici che non puoi verificare, ma condividi liberamente le tue conoscenze generali. Non rispondere 'non ho sufficienti informazioni' a meno che la domanda non richieda dettagli molto specifici che non potresti conoscere."
-            
-            payload_messages = [{"role": "system", "content": system_message}]
-            payload_messages.extend(messages)
-            
-            payload = {
-                "model": self.model,
-                "messages": payload_messages,
-                "stream": False,
-                "options": {
-                    "temperature": 0.5,  # Aumentata per risposte più naturali
-                    "num_predict": 1000,  # Aumentata da 300 a 1000 per risposte più lunghe
-                    "top_p": 0.8        # Aumentato per maggiore variabilità
-                }
-            }
-            
-            print(f"Payload inviato: {payload}")
+            payload = self.build_response_payload(messages, system_message)
             
             # Effettua la chiamata API a Ollama locale
-            response = requests.post(self.api_url, json=payload)
-            response.raise_for_status()
-            print(f"Risposta ricevuta: {response.json()}")
-            
-            # Estrai la risposta
-            result = response.json()
+            result = self._post_chat(payload, "generate_response", chat_id=chat_id)
             ai_response = result["message"]["content"]
             
             return ai_response
             
         except Exception as e:
-            print(f"Errore durante la generazione della risposta AI: {e}")
+            log.error("Errore durante la generazione della risposta AI: %s", e)
             return f"Mi dispiace, c'è stato un problema con la mia risposta: {str(e)}"
     
-    def generate_ai_response(self, prompt, chat_id, user_info=None, history_analysis=None, is_directed=True, is_cattivo=False):
+    def format_recent_messages(self, chat_messages, bot_username, max_messages=30, max_chars=200):
+        """Riduce gli ultimi messaggi della chat a righe compatte "HH:MM Nome: testo" per il prompt.
+        
+        I messaggi diretti al bot sono marcati con [AL BOT], come nell'analisi con focus; i testi
+        più lunghi di max_chars vengono troncati.
+        """
+        lines = []
+        for msg in chat_messages[-max_messages:]:
+            text = " ".join(msg['text'].split())
+            if len(text) > max_chars:
+                text = text[:max_chars - 1] + "…"
+            marker = "[AL BOT] " if bot_username and bot_username in msg['text'] else ""
+            lines.append(f"{msg['timestamp'][11:16]} {marker}{msg['user_name']}: {text}")
+        return "\n".join(lines)
+
+    def build_reply_messages(self, prompt, history_analysis=None, is_directed=True, is_cattivo=False,
+                             relevant_messages=None, recent_chat=None, history_turns=None):
+        """Costruisce il system prompt stabile e il messaggio utente variabile di una risposta.
+        
+        Ollama riusa la cache KV solo per il prefisso identico alla richiesta precedente: il system
+        prompt contiene quindi solo parti stabili per chat (persona, riassunto della chat), mentre
+        data, intercalare, appellativo, messaggi recuperati e domanda vanno in coda nel messaggio utente.
+        ``history_turns`` (la finestra di conversation_history) precede il messaggio utente: finché
+        cresce solo in coda resta nel prefisso riutilizzabile, ma quando la finestra scorre e perde i
+        turni più vecchi il prefisso comune si ferma al system prompt e va rivalutata tutta.
+        """
+        from datetime import datetime
+        current_date = datetime.now().strftime("%d %B %Y")
+        
+        # Seleziona persona, intercalari e appellativi in base alla modalità
+        if is_cattivo:
+            intercalare = random.choice(self.intercalari_cattivo) if self.intercalari_cattivo else "mannaggia"
+            appellativo = random.choice(self.appellativi_cattivo) if self.appellativi_cattivo else "genio"
+            log.debug("Modalità cattivo: intercalare='%s', appellativo='%s'", intercalare, appellativo)
+            system_message = "Sei un assistente AI molto cattivo, maleducato e sarcastico. Usa le espressioni e gli appellativi indicati nel messaggio in modo sarcastico e irrispettoso. IMPORTANTE: RISPONDI SEMPRE IN ITALIANO."
+            flavor = f"Usa espressioni come '{intercalare}' e chiama l'utente '{appellativo}' in modo sarcastico e irrispettoso."
+        else:
+            intercalare = random.choice(self.intercalari_non_cattivo) if self.intercalari_non_cattivo else "oh cielo"
+            appellativo = random.choice(self.appellativi_non_cattivo) if self.appellativi_non_cattivo else "amico"
+            log.debug("Modalità non cattivo: intercalare='%s', appellativo='%s'", intercalare, appellativo)
+            system_message = "Sei un assistente AI gentile e rispettoso. Usa le espressioni e gli appellativi indicati nel messaggio in modo amichevole. IMPORTANTE: RISPONDI SEMPRE IN ITALIANO."
+            flavor = f"Usa espressioni come '{intercalare}' e chiama l'utente '{appellativo}' in modo amichevole."
+        
+        # Aggiungi istruzioni per distinguere meglio i messaggi diretti al bot
+        if is_directed:
+            system_message += "\n\nIMPORTANTE: Rispondi specificamente alla domanda attuale senza confonderla con altre conversazioni."
+        
+        # Aggiungi il contesto dalla cronologia della chat se disponibile
+        if history_analysis and history_analysis != "Nessuna informazione rilevante trovata.":
+            system_message += f"\n\nDi seguito il contesto della conversazione:\n\n{history_analysis}\n\nUsa queste informazioni per contestualizzare la tua risposta."
+        
+        # Parte variabile: data, tono, messaggi recuperati per questa domanda e domanda
+        user_content = f"Oggi è {current_date}. {flavor}"
+        if relevant_messages:
+            relevant_text = "\n".join(
+                f"- {msg['timestamp'][:16]} {msg['user_name']}: {msg['text']}"
+                for msg in sorted(relevant_messages, key=lambda m: m['timestamp'])
+            )
+            user_content += f"\n\nMessaggi passati della chat pertinenti alla domanda:\n{relevant_text}"
+        if recent_chat:
+            # Senza riassunto della chat: ultimi messaggi grezzi, così basta una sola generazione
+            user_content += (
+                f"\n\nUltimi messaggi della chat, dal più vecchio ([AL BOT] indica quelli rivolti a te; "
+                f"gli altri sono conversazioni tra utenti, usale solo come contesto):\n{recent_chat}"
+            )
+        if history_turns:
+            user_content += "\n\nI messaggi precedenti sono la conversazione recente (nome: testo per gli utenti)."
+        user_content += f"\n\nDomanda: {prompt}"
+        
+        return system_message, list(history_turns or []) + [{"role": "user", "content": user_content}]
+    
+    def generate_ai_response(self, prompt, chat_id, user_info=None, history_analysis=None, is_directed=True, is_cattivo=False,
+                             relevant_messages=None, recent_chat=None, history_turns=None):
         try:
-            from datetime import datetime
-            current_date = datetime.now().strftime("%d %B %Y")
-            
-            # Seleziona intercalari e appellativi in base alla modalità
-            if is_cattivo:
-                intercalare = random.choice(self.intercalari_cattivo) if self.intercalari_cattivo else "mannaggia"
-                appellativo = random.choice(self.appellativi_cattivo) if self.appellativi_cattivo else "genio"
-                print(f"Modalità cattivo: intercalare='{intercalare}', appellativo='{appellativo}'")
-                system_message = f"Sei un assistente AI molto cattivo, maleducato e sarcastico. Oggi è {current_date}. Usa espressioni come '{intercalare}' e chiama l'utente '{appellativo}' in modo sarcastico e irrispettoso. IMPORTANTE: RISPONDI SEMPRE IN ITALIANO."
-            else:
-                intercalare = random.choice(self.intercalari_non_cattivo) if self.intercalari_non_cattivo else "oh cielo"
-                appellativo = random.choice(self.appellativi_non_cattivo) if self.appellativi_non_cattivo else "amico"
-                print(f"Modalità non cattivo: intercalare='{intercalare}', appellativo='{appellativo}'")
-                system_message = f"Sei un assistente AI gentile e rispettoso. Oggi è {current_date}. Usa espressioni come '{intercalare}' e chiama l'utente '{appellativo}' in modo amichevole. IMPORTANTE: RISPONDI SEMPRE IN ITALIANO."
-            
-            # Aggiungi istruzioni per distinguere meglio i messaggi diretti al bot
-            if is_directed:
-                system_message += "\n\nIMPORTANTE: Rispondi specificamente alla domanda attuale senza confonderla con altre conversazioni."
-            
-            # Aggiungi il contesto dalla cronologia della chat se disponibile
-            if history_analysis and history_analysis != "Nessuna informazione rilevante trovata.":
-                system_message += f"\n\nDi seguito il contesto della conversazione:\n\n{history_analysis}\n\nUsa queste informazioni per contestualizzare la tua risposta."
-            
-            # Crea un singolo messaggio con il prompt
-            messages = [{"role": "user", "content": prompt}]
-            
-            # Log del payload
-            print(f"Payload inviato: {messages}")
+            system_message, messages = self.build_reply_messages(
+                prompt, history_analysis, is_directed, is_cattivo, relevant_messages, recent_chat, history_turns
+            )
             
             # Utilizziamo il metodo generate_response esistente
-            return self.generate_response(messages, system_message)
+            return self.generate_response(messages, system_message, chat_id=chat_id)
         except Exception as e:
-            print(f"Errore durante la generazione della risposta AI: {e}")
+            log.error("Errore durante la generazione della risposta AI: %s", e)
             return f"Mi dispiace, c'è stato un problema con la mia risposta: {str(e)}"
     
-    def analyze_message_history(self, chat_messages, current_topic):
+    def analyze_message_history(self, chat_messages, current_topic, chat_id=None):
         """Analizza la cronologia dei messaggi della chat per trovare contenuti rilevanti"""
         try:
             # Limita a 50 messaggi più recenti per non sovraccaricare il modello
@@ -200,42 +375,34 @@ class AIService:
                 }
             }
             
-            print(f"Payload inviato: {payload}")
-            
-            # Effettua la chiamata API
-            response = requests.post(self.api_url, json=payload)
-            response.raise_for_status()
-            print(f"Risposta ricevuta: {response.json()}")
-            
-            # Estrai la risposta
-            result = response.json()
+            # Effettua la chiamata API a Ollama locale
+            result = self._post_chat(payload, "analyze_message_history", chat_id=chat_id)
             analysis = result["message"]["content"]
             
             return analysis
             
         except Exception as e:
-            print(f"Errore durante l'analisi della cronologia chat: {e}")
+            log.error("Errore durante l'analisi della cronologia chat: %s", e)
             return "Nessuna informazione rilevante trovata."
     
-    def analyze_message_history_with_focus(self, chat_messages, current_topic, bot_username):
-        """Analizza la cronologia dei messaggi con focus sui messaggi diretti al bot"""
-        try:
-            # Limita a 50 messaggi più recenti per non sovraccaricare il modello
-            recent_messages = chat_messages[-50:] if len(chat_messages) > 50 else chat_messages
-            
-            # Costruisci la rappresentazione della cronologia con evidenza dei messaggi diretti al bot
-            messages_text = []
-            for msg in recent_messages:
-                if bot_username in msg['text']:
-                    # Evidenzia i messaggi diretti al bot
-                    messages_text.append(f"- [MESSAGGIO DIRETTO AL BOT] {msg['timestamp']}: {msg['user_name']}: {msg['text']}")
-                else:
-                    # Messaggi normali
-                    messages_text.append(f"- {msg['timestamp']}: {msg['user_name']}: {msg['text']}")
-            
-            messages_history = "\n".join(messages_text)
-            
-            prompt = f"""
+    def build_focus_analysis_payload(self, chat_messages, current_topic, bot_username):
+        """Payload di analyze_message_history_with_focus, condiviso con la versione asincrona"""
+        # Limita a 50 messaggi più recenti per non sovraccaricare il modello
+        recent_messages = chat_messages[-50:] if len(chat_messages) > 50 else chat_messages
+        
+        # Costruisci la rappresentazione della cronologia con evidenza dei messaggi diretti al bot
+        messages_text = []
+        for msg in recent_messages:
+            if bot_username in msg['text']:
+                # Evidenzia i messaggi diretti al bot
+                messages_text.append(f"- [MESSAGGIO DIRETTO AL BOT] {msg['timestamp']}: {msg['user_name']}: {msg['text']}")
+            else:
+                # Messaggi normali
+                messages_text.append(f"- {msg['timestamp']}: {msg['user_name']}: {msg['text']}")
+        
+        messages_history = "\n".join(messages_text)
+        
+        prompt = f"""
             Analizza questa cronologia di messaggi della chat e trova informazioni RILEVANTI per rispondere al messaggio attuale: "{current_topic}".
             
             IMPORTANTE:
@@ -249,40 +416,40 @@ class AIService:
             
             Fornisci un breve riassunto delle informazioni rilevanti, concentrandoti principalmente sui messaggi diretti al bot.
             """
-            
-            payload = {
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": "Sei un assistente analitico che deve distinguere tra messaggi diretti al bot e conversazioni generali."},
-                    {"role": "user", "content": prompt}
-                ],
-                "stream": False,
-                "options": {
-                    "temperature": 0.3
-                }
+        
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": "Sei un assistente analitico che deve distinguere tra messaggi diretti al bot e conversazioni generali."},
+                {"role": "user", "content": prompt}
+            ],
+            "stream": False,
+            "options": {
+                "temperature": 0.3
             }
+        }
+    
+    def analyze_message_history_with_focus(self, chat_messages, current_topic, bot_username, chat_id=None):
+        """Analizza la cronologia dei messaggi con focus sui messaggi diretti al bot"""
+        try:
+            payload = self.build_focus_analysis_payload(chat_messages, current_topic, bot_username)
             
-            print(f"Payload inviato: {payload}")
-            
-            response = requests.post(self.api_url, json=payload)
-            response.raise_for_status()
-            print(f"Risposta ricevuta: {response.json()}")
-            
-            result = response.json()
+            # Effettua la chiamata API a Ollama locale
+            result = self._post_chat(payload, "analyze_message_history_with_focus", chat_id=chat_id)
             return result["message"]["content"]
             
         except Exception as e:
-            print(f"Errore durante l'analisi del contesto messaggi: {e}")
+            log.error("Errore durante l'analisi del contesto messaggi: %s", e)
             return "Nessuna informazione rilevante trovata."
     
-    def analyze_chat_context(self, chat_messages):
+    def analyze_chat_context(self, chat_messages, chat_id=None):
         """Analizza l'intera chat per creare un contesto comprensivo"""
         try:
             # Aumentato drasticamente il numero di messaggi analizzati
             # Usa fino a 5000 messaggi per avere un contesto più completo
             recent_messages = chat_messages[-5000:] if len(chat_messages) > 5000 else chat_messages
             
-            print(f"Analizzando {len(recent_messages)} messaggi per il contesto della chat")
+            log.info("Analizzando %d messaggi per il contesto della chat", len(recent_messages))
             
             # Costruisci la rappresentazione della cronologia
             messages_text = []
@@ -320,24 +487,17 @@ class AIService:
                 }
             }
             
-            print(f"Payload inviato: {payload}")
-            
-            # Effettua la chiamata API
-            response = requests.post(self.api_url, json=payload)
-            response.raise_for_status()
-            print(f"Risposta ricevuta: {response.json()}")
-            
-            # Estrai la risposta
-            result = response.json()
+            # Effettua la chiamata API a Ollama locale
+            result = self._post_chat(payload, "analyze_chat_context", chat_id=chat_id)
             analysis = result["message"]["content"]
             
             return analysis
             
         except Exception as e:
-            print(f"Errore durante l'analisi del contesto chat: {e}")
+            log.error("Errore durante l'analisi del contesto chat: %s", e)
             return "Nessuna informazione rilevante trovata."
     
-    def analyze_chat_context_with_focus(self, chat_messages, bot_username):
+    def analyze_chat_context_with_focus(self, chat_messages, bot_username, chat_id=None):
         """Analizza l'intera chat con focus distinto sui messaggi diretti al bot"""
         try:
             # Limita per non sovraccaricare
@@ -353,6 +513,10 @@ class AIService:
                 else:
                     general_messages.append(f"- {msg['user_name']}: {msg['text']}")
             
+            # Le join sono fuori dalla f-string: prima di Python 3.12 non ammette backslash
+            messages_to_bot_text = "\n".join(messages_to_bot)
+            general_messages_text = "\n".join(general_messages[:300])
+            
             prompt = f"""
             Analizza questa conversazione e crea un riassunto strutturato che distingua chiaramente:
             
@@ -360,10 +524,10 @@ class AIService:
             2. CONVERSAZIONI GENERALI tra gli utenti
             
             MESSAGGI DIRETTI AL BOT:
-            {"\n".join(messages_to_bot)}
+            {messages_to_bot_text}
             
             CONVERSAZIONI GENERALI:
-            {"\n".join(general_messages[:300])}  # Limitati per lunghezza
+            {general_messages_text}  # Limitati per lunghezza
             
             Crea un riassunto organizzato con queste sezioni:
             1. "Riassunto dei messaggi diretti al bot" - cosa gli utenti hanno chiesto al bot
@@ -385,12 +549,9 @@ class AIService:
                 }
             }
                         
-            response = requests.post(self.api_url, json=payload)
-            response.raise_for_status()
-            
-            result = response.json()
+            result = self._post_chat(payload, "analyze_chat_context_with_focus", chat_id=chat_id)
             return result["message"]["content"]
             
         except Exception as e:
-            print(f"Errore durante l'analisi del contesto chat: {e}")
+            log.error("Errore durante l'analisi del contesto chat: %s", e)
             return "Nessuna informazione rilevante trovata."
\ No newline at end of file
@@ -0,0 +1,335 @@
+import asyncio
+import logging
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp serve solo per la modalità asyncio
+    aiohttp = None
+
+import telebot
+
+import bot as app
+from config import BOT_TOKEN
+from coalescer import RequestCoalescer
+from metrics import LLM_LATENCY, LLM_ERRORS, REPLIES_SENT, UPDATES_RECEIVED
+
+log = logging.getLogger(__name__)
+
+class AsyncTelegramClient:
+    """Client asincrono minimale per la Bot API (getMe, getUpdates, sendMessage).
+
+    Le risposte del bot passano comunque dalla coda di invio di bot.py (send_dispatcher).
+    """
+
+    def __init__(self, token, session):
+        self.token = token
+        self.session = session
+
+    def _url(self, method):
+        # Rispetta un eventuale API_URL personalizzato di telebot (es. server Bot API locale)
+        if telebot.apihelper.API_URL:
+            return telebot.apihelper.API_URL.format(self.token, method)
+        return f"https://api.telegram.org/bot{self.token}/{method}"
+
+    async def call(self, method, request_timeout=30, **params):
+        """Invoca un metodo della Bot API e restituisce il campo result"""
+        params = {key: value for key, value in params.items() if value is not None}
+        async with self.session.post(self._url(method), json=params,
+                                     timeout=aiohttp.ClientTimeout(total=request_timeout)) as response:
+            result_json = await response.json(content_type=None)
+        if not result_json.get("ok"):
+            raise telebot.apihelper.ApiTelegramException(method, None, result_json)
+        return result_json["result"]
+
+    async def get_me(self):
+        return telebot.types.User.de_json(await self.call("getMe"))
+
+    async def get_updates(self, offset=None, long_polling_timeout=30):
+        # Il timeout della richiesta HTTP deve superare quello del long polling lato Telegram
+        return await self.call("getUpdates", request_timeout=long_polling_timeout + 10,
+                               offset=offset, timeout=long_polling_timeout)
+
+    async def send_message(self, chat_id, text, reply_to_message_id=None):
+        return await self.call("sendMessage", chat_id=chat_id, text=text, reply_to_message_id=reply_to_message_id)
+
+
+class AsyncAIService:
+    """Versione non bloccante delle chiamate di AIService usate per rispondere.
+
+    Costruzione dei prompt, statistiche e parametri restano quelli di AIService; cambia solo il
+    trasporto HTTP verso Ollama. Le analisi di supporto meno frequenti girano in un thread.
+    """
+
+    def __init__(self, ai_service, session):
+        self.ai_service = ai_service
+        self.session = session
+
+    async def post_chat(self, payload, method, chat_id=None):
+        """Come AIService._post_chat, ma senza occupare un thread durante la generazione"""
+        timeout, sampled = self.ai_service.begin_chat(payload, method)
+        try:
+            with LLM_LATENCY.time(method):
+                async with self.session.post(self.ai_service.api_url, json=payload,
+                                             timeout=aiohttp.ClientTimeout(total=timeout, sock_connect=10)) as response:
+                    response.raise_for_status()
+                    result = await response.json()
+        except Exception:
+            LLM_ERRORS.inc(method)
+            raise
+        return self.ai_service.end_chat(payload, method, chat_id, result, sampled)
+
+    async def analyze_message_history_with_focus(self, chat_messages, current_topic, bot_username, chat_id=None):
+        try:
+            payload = self.ai_service.build_focus_analysis_payload(chat_messages, current_topic, bot_username)
+            result = await self.post_chat(payload, "analyze_message_history_with_focus", chat_id=chat_id)
+            return result["message"]["content"]
+        except Exception as e:
+            log.error("Errore durante l'analisi del contesto messaggi: %s", e)
+            return "Nessuna informazione rilevante trovata."
+
+    async def generate_ai_response(self, prompt, chat_id, user_info=None, history_analysis=None, is_directed=True,
+                                   is_cattivo=False, relevant_messages=None, recent_chat=None, history_turns=None):
+        try:
+            system_message, messages = self.ai_service.build_reply_messages(
+                prompt, history_analysis, is_directed, is_cattivo, relevant_messages, recent_chat, history_turns
+            )
+            payload = self.ai_service.build_response_payload(messages, system_message)
+            result = await self.post_chat(payload, "generate_response", chat_id=chat_id)
+            return result["message"]["content"]
+        except Exception as e:
+            log.error("Errore durante la generazione della risposta AI: %s", e)
+            return f"Mi dispiace, c'è stato un problema con la mia risposta: {str(e)}"
+
+
+class AsyncMessageLogger:
+    """Wrapper di MessageLogger che esegue l'I/O su disco fuori dall'event loop"""
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    async def log_message(self, message):
+        return await asyncio.to_thread(self.logger.log_message, message)
+
+    async def get_recent_logs(self, count=100):
+        return await asyncio.to_thread(self.logger.get_recent_logs, count)
+
+    async def get_chat_message_history(self, chat_id):
+        return await asyncio.to_thread(self.logger.get_chat_message_history, chat_id)
+
+
+class AsyncDataManager:
+    """Wrapper di DataManager che esegue i salvataggi fuori dall'event loop"""
+
+    def __init__(self, data_manager):
+        self.data_manager = data_manager
+
+    async def save_user_data(self, user_data):
+        return await asyncio.to_thread(self.data_manager.save_user_data, user_data)
+
+    async def save_conversations(self, conversations):
+        return await asyncio.to_thread(self.data_manager.save_conversations, conversations)
+
+
+class AsyncRequestCoalescer(RequestCoalescer):
+    """RequestCoalescer per asyncio: un task per chat invece di un thread"""
+
+    def __init__(self, process_batch, window=1.5, max_age=60.0):
+        super().__init__(process_batch, window, max_age)
+        self.tasks = set()
+
+    def submit(self, chat_id, request):
+        self.pending.setdefault(chat_id, []).append(request)
+        if chat_id in self.busy:
+            return
+        self.busy.add(chat_id)
+        task = asyncio.get_running_loop().create_task(self._run_async(chat_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_async(self, chat_id):
+        await asyncio.sleep(self.window)
+        while True:
+            batch = self.pending.pop(chat_id, [])
+            if not batch:
+                self.busy.discard(chat_id)
+                return
+            batch = self._drop_stale(batch)
+            try:
+                await self.process_batch(chat_id, batch)
+            except Exception as e:
+                log.exception("Errore nella risposta al lotto di richieste della chat %s: %s", chat_id, e)
+
+
+class AsyncBot:
+    """Ciclo degli aggiornamenti basato su asyncio, alternativo al polling a thread di telebot.
+
+    Ogni conversazione in attesa del modello è una coroutine, anche durante l'analisi della
+    cronologia. I messaggi normali seguono lo stesso percorso di bot.handle_message
+    (prepare_request, build_reply_context), uno alla volta per chat come in ChatOrderedTeleBot;
+    comandi e messaggi senza testo vengono passati agli handler sincroni di telebot.
+    """
+
+    def __init__(self, long_polling_timeout=30):
+        self.long_polling_timeout = long_polling_timeout
+        self.logger = AsyncMessageLogger(app.logger)
+        self.data_manager = AsyncDataManager(app.data_manager)
+        self.coalescer = AsyncRequestCoalescer(self.answer_requests, app.COALESCE_WINDOW, app.STALE_REQUEST_AGE)
+        self.telegram = None
+        self.ai = None
+        self.bot_info = None
+        self.tasks = set()
+        # chat_id -> [asyncio.Lock, messaggi che lo usano]: messaggi della stessa chat in ordine di arrivo;
+        # il lock si elimina quando nessun messaggio della chat lo tiene o lo attende
+        self.chat_locks = {}
+        # Come il pool ReplyGen di bot.py: al più REPLY_CONCURRENCY risposte in generazione
+        self.reply_slots = asyncio.Semaphore(app.REPLY_CONCURRENCY)
+
+    def _spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send_long_message(self, chat_id, text, reply_to_message_id=None):
+        # Le parti passano dalla coda di invio condivisa, che rispetta i limiti di Telegram
+        await asyncio.wrap_future(app.send_long_message(chat_id, text, reply_to_message_id))
+
+    async def answer_requests(self, chat_id, batch):
+        """Come bot.answer_requests, con generazione e invio non bloccanti"""
+        async with self.reply_slots:
+            await self._answer_requests(chat_id, batch)
+
+    async def _answer_requests(self, chat_id, batch):
+        last_message = batch[-1]["message"]
+        try:
+            # Solo l'I/O su disco va in un thread: l'analisi col modello resta una coroutine
+            context = await asyncio.to_thread(app.gather_reply_context, chat_id, batch)
+            history_analysis = None
+            if context["history_to_analyze"]:
+                history_analysis = await self.ai.analyze_message_history_with_focus(
+                    context["history_to_analyze"], context["search_query"], context["bot_username"], chat_id=chat_id
+                )
+            question, history_analysis, relevant_messages, recent_chat, history_turns = await asyncio.to_thread(
+                app.finish_reply_context, chat_id, context, history_analysis
+            )
+            response = await self.ai.generate_ai_response(
+                question,
+                chat_id,
+                batch[-1]["user_info"],
+                history_analysis,
+                is_directed=True,
+                is_cattivo=app.cattivo_mode.get(chat_id, False),
+                relevant_messages=relevant_messages,
+                recent_chat=recent_chat,
+                history_turns=history_turns
+            )
+            app.record_assistant_turn(chat_id, response)
+            await self.send_long_message(chat_id, response, last_message.message_id)
+            REPLIES_SENT.inc()
+        except Exception as e:
+            log.exception("Errore durante la risposta alle richieste della chat %s: %s", chat_id, e)
+            try:
+                await asyncio.wrap_future(
+                    app.send_dispatcher.reply_to(last_message, "Mi dispiace, c'è stato un problema interno.")
+                )
+            except Exception:
+                pass
+
+    async def _prepare_in_order(self, message):
+        chat_id = message.chat.id
+        entry = self.chat_locks.get(chat_id)
+        if entry is None:
+            entry = self.chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Un messaggio per chat alla volta (l'attesa sul lock è FIFO): log, dati utente e
+            # cronologia nell'ordine di arrivo
+            async with entry[0]:
+                return await asyncio.to_thread(app.prepare_request, message, self.bot_info)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.chat_locks[chat_id]
+
+    async def handle_message(self, message):
+        try:
+            request = await self._prepare_in_order(message)
+            if not request:
+                return
+            if app.ENABLE_COALESCING:
+                self.coalescer.submit(message.chat.id, request)
+            else:
+                await self.answer_requests(message.chat.id, [request])
+        except Exception as e:
+            log.exception("Errore durante l'elaborazione del messaggio: %s", e)
+
+    def dispatch(self, update):
+        """Smista un aggiornamento: testo normale in asyncio, comandi e altri messaggi agli handler di telebot"""
+        message = update.message
+        if message is None:
+            return
+        if message.text is None or message.text.startswith('/'):
+            # Comandi, foto, sticker, ...: li gestisce app.bot (che li conta in ChatOrderedTeleBot._exec_task)
+            self._spawn(asyncio.to_thread(app.bot.process_new_messages, [message]))
+        else:
+            UPDATES_RECEIVED.inc(message.chat.type)
+            self._spawn(self.handle_message(message))
+
+    async def poll_updates(self):
+        offset = None
+        retry_count = 0
+        while True:
+            try:
+                updates = await self.telegram.get_updates(offset, self.long_polling_timeout)
+                retry_count = 0
+            except telebot.apihelper.ApiTelegramException as telegram_ex:
+                if telegram_ex.error_code == 401:
+                    log.critical("ERRORE CRITICO: Token non valido o bot disabilitato: %s", telegram_ex)
+                    return
+                log.error("Errore API Telegram: %s", telegram_ex)
+                updates = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as conn_ex:
+                log.error("Errore di connessione: %s", conn_ex)
+                updates = None
+
+            if updates is None:
+                retry_count += 1
+                await asyncio.sleep(min(5 * (2 ** (retry_count - 1)), 60))
+                continue
+
+            for raw_update in updates:
+                offset = raw_update["update_id"] + 1
+                try:
+                    update = telebot.types.Update.de_json(raw_update)
+                    # Qui i messaggi non passano da app.bot.process_new_updates: il filtro va applicato a mano
+                    if app.update_deduplicator is None or app.update_deduplicator.is_new(update):
+                        self.dispatch(update)
+                except Exception as e:
+                    log.exception("Errore nella lettura dell'aggiornamento %s: %s", raw_update.get("update_id"), e)
+
+    async def run(self):
+        if aiohttp is None:
+            raise RuntimeError("La modalità asyncio richiede aiohttp (pip install aiohttp)")
+        # Nessun timeout totale: le generazioni lunghe non devono essere interrotte
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            self.telegram = AsyncTelegramClient(BOT_TOKEN, session)
+            self.ai = AsyncAIService(app.ai_service, session)
+            self.bot_info = await self.telegram.get_me()
+            log.info("Bot @%s avviato in modalità asyncio", self.bot_info.username)
+            try:
+                await self.poll_updates()
+            finally:
+                log.info("Salvataggio dati in corso...")
+                await self.data_manager.save_user_data(app.user_data)
+                await self.data_manager.save_conversations(app.conversation_history)
+                await asyncio.to_thread(app.chat_stats.save)
+
+
+if __name__ == '__main__':
+    app.setup_logging()
+    app.create_app()
+    app.start_background_threads()
+    try:
+        asyncio.run(AsyncBot().run())
+    except KeyboardInterrupt:
+        pass
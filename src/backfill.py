@@ -0,0 +1,44 @@
+import os
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def message_key(msg):
+    """Identità di un messaggio indicizzato: uguale per la voce del log e per la cronologia"""
+    return (msg.get("timestamp", ""), str(msg.get("user_id", "")), msg.get("text", ""))
+
+
+class BackfillState:
+    """Chat la cui cronologia è già stata indicizzata, con il timestamp dell'ultimo messaggio incluso.
+
+    Un indice può contenere messaggi di una chat (aggiunti dal listener del log) senza averne la
+    cronologia: la presenza del file o il numero di righe non dicono se il backfill è avvenuto.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.chats = {}  # chat_id (stringa) -> timestamp dell'ultimo messaggio della cronologia
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.chats = json.load(f)
+            except Exception as e:
+                log.error("Errore durante il caricamento dello stato del backfill %s: %s", path, e)
+
+    def is_done(self, chat_id):
+        with self.lock:
+            return str(chat_id) in self.chats
+
+    def mark_done(self, chat_id, watermark):
+        with self.lock:
+            self.chats[str(chat_id)] = watermark
+            try:
+                with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(self.chats, f)
+                os.replace(self.path + ".tmp", self.path)
+            except Exception as e:
+                log.error("Errore durante il salvataggio dello stato del backfill %s: %s", self.path, e)
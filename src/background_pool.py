@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import BACKGROUND_TASKS
+
+log = logging.getLogger(__name__)
+
+class BackgroundPool:
+    """Esegue i lavori di background per chat su un numero limitato di thread.
+
+    Al modello arrivano al più ``concurrency`` analisi contemporanee, utili quando Ollama ha più
+    slot paralleli. Per ogni chat si tengono esecuzioni, errori, timeout e durata dell'ultima;
+    ``run_pass`` smette di aspettare una chat che supera ``timeout`` secondi, così una chat lenta
+    non blocca il resto del passaggio.
+    """
+
+    def __init__(self, name, concurrency=2, timeout=300.0):
+        self.name = name
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.running = {}  # chat_id -> istante di inizio del lavoro in corso
+        self.chat_stats = {}  # chat_id -> esecuzioni, errori, timeout, ultima durata ed errore
+        self.last_pass = None
+
+    def _stats(self, chat_id):
+        return self.chat_stats.setdefault(chat_id, {
+            "runs": 0, "errors": 0, "timeouts": 0, "last_seconds": None, "last_error": None, "last_run": None
+        })
+
+    def _run(self, chat_id, func, args):
+        start = time.monotonic()
+        outcome = "error"
+        with self.lock:
+            self.running[chat_id] = start
+        try:
+            result = func(*args)
+            outcome = "ok"
+            return result
+        except Exception as e:
+            log.error("%s: errore per la chat %s: %s", self.name, chat_id, e)
+            with self.lock:
+                self._stats(chat_id)["last_error"] = str(e)
+            raise
+        finally:
+            with self.lock:
+                self.running.pop(chat_id, None)
+                stats = self._stats(chat_id)
+                stats["runs"] += 1
+                stats["last_seconds"] = time.monotonic() - start
+                stats["last_run"] = datetime.now().isoformat()
+                if outcome == "error":
+                    stats["errors"] += 1
+            BACKGROUND_TASKS.inc(self.name, outcome)
+
+    def submit(self, chat_id, func, *args):
+        """Accoda func(*args) per una chat e ne restituisce il Future"""
+        return self.executor.submit(self._run, chat_id, func, args)
+
+    def run_pass(self, tasks):
+        """Esegue un passaggio: ``tasks`` è una sequenza di (chat_id, func, args).
+
+        Restituisce (riepilogo, risultati per chat delle chat completate); il riepilogo (lavori,
+        completati, errori, timeout, ancora in corso, secondi) resta anche in ``last_pass``. Le chat
+        oltre il timeout continuano nel loro thread ma non vengono attese; finché non terminano,
+        i passaggi successivi le saltano invece di avviarne un secondo lavoro in parallelo.
+        """
+        start = time.monotonic()
+        with self.lock:
+            busy = [chat_id for chat_id, _, _ in tasks if chat_id in self.running]
+        for chat_id in busy:
+            log.warning("%s: la chat %s è ancora in corso dal passaggio precedente, saltata", self.name, chat_id)
+            BACKGROUND_TASKS.inc(self.name, "busy")
+        futures = {
+            self.submit(chat_id, func, *args): chat_id for chat_id, func, args in tasks if chat_id not in busy
+        }
+        summary = {"tasks": len(futures), "ok": 0, "errors": 0, "timeouts": 0, "busy": len(busy)}
+        results = {}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception():
+                    summary["errors"] += 1
+                else:
+                    summary["ok"] += 1
+                    results[futures[future]] = future.result()
+            now = time.monotonic()
+            with self.lock:
+                # Il timeout conta dall'inizio del lavoro della chat, non dall'accodamento
+                expired = {
+                    future for future in pending
+                    if futures[future] in self.running and now - self.running[futures[future]] > self.timeout
+                }
+                for future in expired:
+                    self._stats(futures[future])["timeouts"] += 1
+            for future in expired:
+                log.warning("%s: la chat %s supera %.0f s, il passaggio prosegue senza attenderla",
+                            self.name, futures[future], self.timeout)
+                BACKGROUND_TASKS.inc(self.name, "timeout")
+            summary["timeouts"] += len(expired)
+            pending -= expired
+        summary["seconds"] = time.monotonic() - start
+        summary["finished_at"] = datetime.now().isoformat()
+        self.last_pass = summary
+        return summary, results
+
+    def slowest_chats(self, count=5):
+        """Chat con l'ultima esecuzione più lunga, per la diagnostica"""
+        with self.lock:
+            stats = [(chat_id, dict(value)) for chat_id, value in self.chat_stats.items() if value["last_seconds"] is not None]
+        return sorted(stats, key=lambda item: item[1]["last_seconds"], reverse=True)[:count]
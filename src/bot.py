@@ -1,36 +1,259 @@
 import os
+import re
+import logging
+import requests
 import telebot
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
-from config import BOT_TOKEN, SKIP_INITIAL_CHARACTER_ANALYSIS
+from config import (
+    BOT_TOKEN, SKIP_INITIAL_CHARACTER_ANALYSIS,
+    ENABLE_EMBEDDING_INDEX, EMBEDDING_MODEL, OLLAMA_EMBED_URL, EMBEDDING_TOP_K, EMBED_TIMEOUT,
+    ENABLE_BM25_INDEX, CONTEXT_PROVIDER, BM25_TOP_N, OLLAMA_KEEP_ALIVE,
+    ENABLE_COALESCING, COALESCE_WINDOW, STALE_REQUEST_AGE, REPLY_CONCURRENCY,
+    SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_GROUP_PER_MINUTE,
+    WORKER_COUNT, MAX_CHAT_QUEUE, QUEUE_OVERFLOW,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_REGISTER,
+    CONTEXT_REFRESH_MESSAGES, CONTEXT_REFRESH_MINUTES, CONTEXT_REFRESH_MAX_PER_HOUR,
+    CHARACTER_MIN_NEW_MESSAGES, CHARACTER_SAMPLE_SIZE, METRICS_PORT, METRICS_HOST,
+    ENABLE_USAGE_LEDGER, USAGE_LEDGER_PATH, FUSED_RECENT_MESSAGES, FUSED_MESSAGE_CHARS,
+    CONVERSATION_WINDOW_TOKENS, SHARD_COUNT, BACKGROUND_CONCURRENCY, BACKGROUND_CHAT_TIMEOUT,
+    CHAT_STATS_DAYS, ENABLE_DEDUP, DEDUP_TTL_HOURS, DEDUP_MAX_ENTRIES
+)
+from log_setup import setup_logging
 from logger import MessageLogger
 from data_manager import DataManager
 from ai_service import AIService
+from vector_index import EmbeddingIndex
+from lexical_index import BM25Index
+from coalescer import RequestCoalescer
+from send_queue import SendDispatcher
+from chat_workers import ChatWorkerPool, ChatOrderedTeleBot
+from webhook_server import WebhookServer
+from refresh_scheduler import ContextRefreshScheduler
+from background_pool import BackgroundPool
+from trigger_engine import TriggerEngine
+from conversation_window import select_window
+from usage_ledger import UsageLedger, parse_since
+from chat_stats import ChatStats
+from dedup import UpdateDeduplicator
+import tracing
+from tracing import Tracer
+from metrics import (
+    start_metrics_server, REPLIES_SENT, CACHE_REQUESTS, THREAD_CYCLE_SECONDS, QUEUE_DEPTH, WARMUP_READY
+)
 
-# Initialize components
-bot = telebot.TeleBot(BOT_TOKEN)
-logger = MessageLogger()
-data_manager = DataManager()
-ai_service = AIService()
+log = logging.getLogger("bot")
+
+# Componenti del bot, costruiti da create_app(): importare il modulo non avvia nulla
+chat_worker_pool = None
+bot = None
+send_dispatcher = None
+logger = None
+data_manager = None
+ai_service = None
+usage_ledger = None
+chat_stats = None
+update_deduplicator = None
+embedding_index = None
+bm25_index = None
+trigger_engine = None
+reply_coalescer = None
+reply_executor = None
+context_scheduler = None
+context_seeder = None
+context_pool = None
+character_pool = None
+
+# Regole usate se data/triggers.json non esiste
+DEFAULT_TRIGGERS = [{"keywords": ["gaetano", "gae", "gboipelo"], "reply": "Gae scem8"}]
+
+# ID degli utenti autorizzati ai comandi di amministrazione (/logs, /stats)
+# Sostituisci con gli ID effettivi
+ADMIN_IDS = [12345678, 87654321]
+
+# Tracce delle ultime richieste, con le durate di ogni fase, per /stats
+tracer = Tracer()
 
 # Stato "cattivo" per ciascuna chat
 cattivo_mode = {}
 
-# Carica i dati salvati PRIMA di usarli
-print("Caricamento dati precedenti...")
-user_data = data_manager.load_user_data()
-conversation_history = data_manager.load_conversations()
-log_count = logger.load_logs()
+user_data = {}
+conversation_history = {}
+# Turni conservati per chat; le risposte del bot sono aggiunte da un thread diverso da quello della chat
+CONVERSATION_HISTORY_LIMIT = 100
+conversation_lock = threading.Lock()
 
 # Cache per il contesto delle chat
 chat_context_cache = {}
+# Chat il cui contesto iniziale è in preparazione (modalità "fused")
+context_seeding = set()
+context_seeding_lock = threading.Lock()
+
+# Identità del bot (getMe): letta una volta e aggiornata di rado, non a ogni messaggio
+BOT_INFO_REFRESH_SECONDS = 3600
+bot_info_cache = None
+bot_info_fetched_at = 0.0
+bot_info_lock = threading.Lock()
+
+# Impostato quando il riscaldamento in background (log storici, contesti, analisi iniziali) è finito
+warmup_ready = threading.Event()
+warmup_timings = {}
+# Da qui in poi i messaggi nuovi per l'analisi del carattere li conta il listener; i precedenti si rileggono dai log
+activity_counted_since = None
+
+def create_app(shard=None, shard_count=1):
+    """Costruisce i componenti del bot, carica i dati salvati e registra gli handler.
+    
+    Fa solo il lavoro necessario a rispondere; la lettura dei log storici avviene in warm_up().
+    Chiamate successive restituiscono lo stesso bot. In un processo di sharding.py, ``shard`` sceglie
+    le cartelle di dati e log proprie dello shard e il limite globale di invio viene diviso tra gli shard.
+    """
+    global chat_worker_pool, bot, send_dispatcher, logger, data_manager, ai_service, usage_ledger
+    global embedding_index, bm25_index, trigger_engine, reply_coalescer, reply_executor, context_scheduler, context_seeder
+    global context_pool, character_pool, chat_stats, update_deduplicator
+    global user_data, conversation_history, activity_counted_since
+    
+    if bot is not None:
+        return bot
+    
+    # Gli handler girano su code seriali per chat: niente corse su user_data e conversation_history
+    chat_worker_pool = ChatWorkerPool(WORKER_COUNT, MAX_CHAT_QUEUE, QUEUE_OVERFLOW)
+    if shard is None:
+        logger = MessageLogger()
+        data_manager = DataManager()
+    else:
+        logger = MessageLogger(os.path.join("logs", f"shard-{shard}"))
+        data_manager = DataManager(os.path.join("data", f"shard-{shard}"))
+    # Aggiornamenti riconsegnati da Telegram dopo un riavvio: scartati prima di log e generazione
+    if ENABLE_DEDUP:
+        update_deduplicator = UpdateDeduplicator(
+            os.path.join(data_manager.data_dir, "seen_updates.jsonl"), DEDUP_TTL_HOURS * 3600, DEDUP_MAX_ENTRIES
+        )
+        data_manager.add_save_hook(update_deduplicator.compact)
+    bot = ChatOrderedTeleBot(BOT_TOKEN, chat_worker_pool, deduplicator=update_deduplicator)
+    # Tutti gli invii passano da qui: limiti di Telegram rispettati e ordine garantito per chat
+    send_dispatcher = SendDispatcher(bot, SEND_GLOBAL_RATE / shard_count, SEND_CHAT_RATE, SEND_GROUP_PER_MINUTE)
+    if not ENABLE_USAGE_LEDGER:
+        usage_ledger = None
+    elif shard is None:
+        usage_ledger = UsageLedger(USAGE_LEDGER_PATH)
+    else:
+        # Un registro per shard, perché il lock di scrittura non vale tra processi; /usage li legge tutti
+        ledger_name = os.path.basename(USAGE_LEDGER_PATH)
+        usage_ledger = UsageLedger(
+            os.path.join(data_manager.data_dir, ledger_name),
+            [os.path.join("data", f"shard-{index}", ledger_name) for index in range(shard_count)]
+        )
+    ai_service = AIService(embedding_model=EMBEDDING_MODEL, embed_url=OLLAMA_EMBED_URL, keep_alive=OLLAMA_KEEP_ALIVE,
+                           usage_ledger=usage_ledger, background_timeout=BACKGROUND_CHAT_TIMEOUT,
+                           embed_timeout=EMBED_TIMEOUT)
+    
+    # Indice semantico della cronologia, alimentato da ogni messaggio registrato; come gli altri file
+    # di stato sta nella cartella dei dati, che con lo sharding è propria di ogni shard
+    embedding_index = EmbeddingIndex(
+        ai_service, os.path.join(data_manager.data_dir, "vectors")
+    ) if ENABLE_EMBEDDING_INDEX else None
+    if embedding_index:
+        logger.add_listener(embedding_index.enqueue)
+    
+    # Indice lessicale BM25: contesto dalla cronologia senza chiamate al modello
+    bm25_index = BM25Index(
+        os.path.join(data_manager.data_dir, "bm25")
+    ) if ENABLE_BM25_INDEX or CONTEXT_PROVIDER == "bm25" else None
+    if bm25_index:
+        logger.add_listener(bm25_index.add)
+    
+    # Risposte automatiche alle parole chiave, ricaricate quando il file cambia
+    trigger_engine = TriggerEngine("data/triggers.json", DEFAULT_TRIGGERS)
+    
+    # Contatori dei messaggi nuovi per utente, usati dall'analisi incrementale del carattere
+    activity_counted_since = datetime.now().isoformat()
+    logger.add_listener(note_character_activity)
+    
+    # Attività per chat (/stats_chat e priorità dei passaggi in background), senza rileggere i log
+    chat_stats = ChatStats(os.path.join(data_manager.data_dir, "chat_stats.json"), CHAT_STATS_DAYS)
+    logger.add_listener(chat_stats.record)
+    data_manager.add_save_hook(chat_stats.save_if_dirty)
+    
+    # Analisi in background: più chat in parallelo verso il modello, con limite e timeout per chat
+    context_pool = BackgroundPool("context_refresh", BACKGROUND_CONCURRENCY, BACKGROUND_CHAT_TIMEOUT)
+    character_pool = BackgroundPool("character_analysis", BACKGROUND_CONCURRENCY, BACKGROUND_CHAT_TIMEOUT)
+    
+    # Il contesto di una chat si rigenera quando c'è nuova attività, non a orario fisso per tutte
+    context_scheduler = ContextRefreshScheduler(
+        refresh_chat_context, CONTEXT_REFRESH_MESSAGES, CONTEXT_REFRESH_MINUTES * 60, CONTEXT_REFRESH_MAX_PER_HOUR,
+        pool=context_pool
+    )
+    logger.add_listener(context_scheduler.record)
+    # Riassunti iniziali delle chat fredde in modalità "fused", uno alla volta fuori dal percorso di risposta
+    context_seeder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ContextSeed")
+    
+    # Raggruppa le menzioni ravvicinate di una chat: il lavoro del modello è limitato per chat, non per messaggio
+    # Le generazioni girano fuori dai worker delle chat, al più REPLY_CONCURRENCY alla volta,
+    # con o senza raggruppamento
+    reply_executor = ThreadPoolExecutor(max_workers=REPLY_CONCURRENCY, thread_name_prefix="ReplyGen")
+    reply_coalescer = RequestCoalescer(
+        answer_requests, COALESCE_WINDOW, STALE_REQUEST_AGE, reply_executor
+    ) if ENABLE_COALESCING else None
+    
+    # Dati salvati: due file JSON, servono subito agli handler
+    log.info("Caricamento dati precedenti...")
+    # Le chiavi tornano stringhe dal JSON: si riportano agli id numerici usati a runtime
+    user_data = {
+        numeric_key(chat_id): {numeric_key(user_id): info for user_id, info in users.items()}
+        for chat_id, users in data_manager.load_user_data().items()
+    }
+    conversation_history = {
+        numeric_key(chat_id): turns for chat_id, turns in data_manager.load_conversations().items()
+    }
+    
+    # Il bot risponde subito, ma contesti e indici sono completi solo dopo warm_up()
+    WARMUP_READY.set_function(lambda: 1 if warmup_ready.is_set() else 0)
+    # Profondità delle code, calcolate solo quando le metriche vengono lette
+    QUEUE_DEPTH.set_function(chat_worker_pool.queue_depth, "handlers")
+    QUEUE_DEPTH.set_function(send_dispatcher.queue_depth, "send")
+    if reply_coalescer:
+        QUEUE_DEPTH.set_function(reply_coalescer.pending_count, "coalescer")
+    if embedding_index:
+        QUEUE_DEPTH.set_function(embedding_index.pending.qsize, "embeddings")
+    
+    register_handlers(bot)
+    return bot
+
+def numeric_key(key):
+    return int(key) if isinstance(key, str) and key.lstrip('-').isdigit() else key
+
+def get_bot_info():
+    """Identità del bot, letta con getMe al primo uso e poi ogni BOT_INFO_REFRESH_SECONDS"""
+    global bot_info_cache, bot_info_fetched_at
+    if bot_info_cache is None or time.monotonic() - bot_info_fetched_at > BOT_INFO_REFRESH_SECONDS:
+        with bot_info_lock:
+            if bot_info_cache is None or time.monotonic() - bot_info_fetched_at > BOT_INFO_REFRESH_SECONDS:
+                try:
+                    bot_info_cache = bot.get_me()
+                except Exception as e:
+                    # Se Telegram non risponde si continua con l'identità già nota
+                    if bot_info_cache is None:
+                        raise
+                    log.warning("Aggiornamento dell'identità del bot non riuscito: %s", e)
+                bot_info_fetched_at = time.monotonic()
+    return bot_info_cache
+
+@lru_cache(maxsize=8)
+def mention_pattern(bot_username):
+    """Regex precompilata della menzione del bot (gli username Telegram non distinguono le maiuscole)"""
+    return re.compile(re.escape(bot_username), re.IGNORECASE)
 
-# Carica i contesti salvati precedentemente (DOPO aver caricato user_data)
-print("Caricamento contesti salvati...")
-for chat_id in user_data.keys():
-    context_file = f"data/context_cache_{chat_id}.txt"
-    if os.path.exists(context_file):
+def load_context_caches():
+    """Carica i contesti salvati precedentemente (DOPO aver caricato user_data)"""
+    log.info("Caricamento contesti salvati...")
+    for chat_id in list(user_data.keys()):
+        context_file = f"data/context_cache_{chat_id}.txt"
+        if chat_id in chat_context_cache or not os.path.exists(context_file):
+            continue
         try:
             with open(context_file, "r", encoding="utf-8") as f:
                 context_text = f.read()
@@ -39,192 +262,403 @@ for chat_id in user_data.keys():
                     "context": context_text,
                     "message_count": len(context_text.split("\n"))
                 }
-            print(f"Caricato contesto salvato per chat {chat_id}")
+            log.debug("Caricato contesto salvato per chat %s", chat_id)
         except Exception as e:
-            print(f"Errore nel caricamento del contesto per chat {chat_id}: {e}")
-
-# Estrai gli utenti dai log e integra con i dati esistenti
-print("Estrazione utenti dai log...")
-users_from_logs = 0
-characters_from_logs = 0
-log_users = logger.extract_users_from_logs()
-log_messages = logger.extract_messages_from_logs()
-
-# Integra gli utenti dai log nella struttura principale
-for chat_id, users in log_users.items():
-    # Crea la chat se non esiste
-    if chat_id not in user_data:
-        user_data[chat_id] = {}
+            log.error("Errore nel caricamento del contesto per chat %s: %s", chat_id, e)
+
+def integrate_log_users():
+    """Estrae gli utenti dai log e li integra con i dati esistenti.
+    
+    Restituisce (utenti trovati nei log, messaggi per chat e utente).
+    """
+    log.info("Estrazione utenti dai log...")
+    users_from_logs = 0
+    log_users = logger.extract_users_from_logs()
+    log_messages = logger.extract_messages_from_logs()
+    
+    # Integra gli utenti dai log nella struttura principale
+    for chat_id, users in log_users.items():
+        # Crea la chat se non esiste
+        chat_users = user_data.setdefault(chat_id, {})
+        for user_id, user_info in users.items():
+            users_from_logs += 1
+            # Aggiungi l'utente se non esiste (i messaggi arrivati nel frattempo hanno la precedenza)
+            chat_users.setdefault(user_id, user_info)
+    return users_from_logs, log_messages
+
+def initial_chat_characters(chat_id, users, last_seen):
+    """Analizza gli utenti di una chat con abbastanza messaggi nei log e non ancora analizzati.
+    
+    ``last_seen`` dà, per (chat, utente), il timestamp dell'ultimo messaggio nei log: l'analisi
+    arriva fino a lì, i messaggi successivi restano per la prossima.
+    """
+    analyzed = 0
+    for user_id, messages in users.items():
+        user_info = user_data.get(chat_id, {}).get(user_id)
+        if not user_info or 'carattere' in user_info or len(messages) < 5:
+            continue
+        try:
+            log.info("Analisi carattere di %s dai log (%d messaggi)...", user_info['first_name'], len(messages))
+            carattere = ai_service.analyze_user_character(sample_character_messages(messages, []), chat_id=chat_id)
+            if carattere:
+                user_data[chat_id][user_id]['carattere'] = carattere
+                user_data[chat_id][user_id]['carattere_ultimo_messaggio'] = (
+                    last_seen.get((chat_id, user_id)) or activity_counted_since
+                )
+                user_data[chat_id][user_id]['carattere_num_messaggi'] = len(messages)
+                analyzed += 1
+                log.debug("Carattere da log: %.50s...", carattere)
+        except Exception as e:
+            log.error("Errore nell'analisi del carattere dai log: %s", e)
+    return analyzed
+
+def initial_character_analysis(log_messages, last_seen):
+    """Analizza il carattere degli utenti non ancora analizzati, più chat in parallelo su character_pool"""
+    summary, results = character_pool.run_pass([
+        (chat_id, initial_chat_characters, (chat_id, users, last_seen)) for chat_id, users in log_messages.items()
+    ])
+    log.info("Analisi iniziale: %d chat in %.0f s, %d errori, %d oltre il timeout",
+             summary["tasks"], summary["seconds"], summary["errors"], summary["timeouts"])
+    return sum(results.values())
+
+def pending_character_activity():
+    """Rilegge dai log i messaggi non ancora analizzati di ogni utente, che i contatori in memoria perdono al riavvio.
+    
+    Restituisce (messaggi dopo l'ultima analisi per (chat, utente), timestamp dell'ultimo messaggio
+    per (chat, utente)); i messaggi registrati dopo l'avvio li ha già contati il listener.
+    """
+    counts = {}
+    last_seen = {}
+    for log_entry in logger.iter_log_entries():
+        text = log_entry.get("text")
+        timestamp = log_entry.get("timestamp", "")
+        if (not text or text.startswith('/') or log_entry.get("chat_id") is None
+                or log_entry.get("user_id") is None or timestamp >= activity_counted_since):
+            continue
+        key = (log_entry["chat_id"], log_entry["user_id"])
+        if timestamp > last_seen.get(key, ""):
+            last_seen[key] = timestamp
+        user_info = user_data.get(key[0], {}).get(key[1]) or {}
+        if timestamp > user_info.get('carattere_ultimo_messaggio', ""):
+            counts[key] = counts.get(key, 0) + 1
+    return counts, last_seen
+
+def restore_character_activity(counts, last_seen):
+    """Aggiunge ai contatori i messaggi non analizzati trovati nei log (dopo l'analisi iniziale)"""
+    restored = 0
+    with character_activity_lock:
+        for key, count in counts.items():
+            user_info = user_data.get(key[0], {}).get(key[1]) or {}
+            # Utenti appena analizzati dall'analisi iniziale fino al loro ultimo messaggio
+            if user_info.get('carattere_ultimo_messaggio', "") >= last_seen.get(key, ""):
+                continue
+            character_activity[key] = character_activity.get(key, 0) + count
+            restored += 1
+    return restored
+
+def _timed(name, func, *args):
+    """Esegue un passo del riscaldamento registrandone la durata in warmup_timings"""
+    start = time.monotonic()
+    try:
+        return func(*args)
+    finally:
+        warmup_timings[name] = time.monotonic() - start
+
+def warm_up():
+    """Caricamento storico e analisi iniziali, eseguiti in background mentre il bot risponde già"""
+    start = time.monotonic()
+    try:
+        log_count = _timed("log_storici", logger.load_logs)
+        _timed("contesti", load_context_caches)
+        users_from_logs, log_messages = _timed("utenti_dai_log", integrate_log_users)
+        pending_counts, last_seen = _timed("messaggi_da_analizzare", pending_character_activity)
+        if not chat_stats.loaded:
+            # Solo alla prima esecuzione: poi le statistiche si aggiornano a ogni messaggio
+            counted = _timed("statistiche_chat", chat_stats.backfill, logger.iter_log_entries())
+            chat_stats.save()
+            log.info("Statistiche delle chat costruite dai log: %d messaggi", counted)
         
-    for user_id, user_info in users.items():
-        users_from_logs += 1
-        # Aggiungi l'utente se non esiste
-        if user_id not in user_data[chat_id]:
-            user_data[chat_id][user_id] = user_info
+        if bm25_index or (embedding_index and embedding_index.available):
+            threading.Thread(target=index_backfill_thread, daemon=True).start()
         
-        # Analizza il carattere se ci sono abbastanza messaggi e non è già analizzato
-        # E SOLO SE l'analisi iniziale non è disabilitata
-        if (not SKIP_INITIAL_CHARACTER_ANALYSIS and
-            'carattere' not in user_data[chat_id][user_id] and 
-            chat_id in log_messages and 
-            user_id in log_messages[chat_id] and 
-            len(log_messages[chat_id][user_id]) >= 5):
-            
-            try:
-                print(f"Analisi carattere di {user_info['first_name']} dai log ({len(log_messages[chat_id][user_id])} messaggi)...")
-                carattere = ai_service.analyze_user_character(log_messages[chat_id][user_id])
-                if carattere:
-                    user_data[chat_id][user_id]['carattere'] = carattere
-                    characters_from_logs += 1
-                    print(f"Carattere da log: {carattere[:50]}...")
-            except Exception as e:
-                print(f"Errore nell'analisi del carattere dai log: {e}")
-
-# Conta il totale degli utenti dopo l'integrazione
-total_users = sum(len(chat_users) for chat_users in user_data.values())
-users_with_character = sum(1 for chat in user_data.values() for user in chat.values() if 'carattere' in user)
-
-print(f"Dati caricati: {len(user_data)} chat, {total_users} utenti totali")
-print(f"Utenti recuperati dai log: {users_from_logs}, di cui {characters_from_logs} con carattere analizzato")
-print(f"Messaggi nella cronologia: {sum(len(chat) for chat in conversation_history.values() if isinstance(chat, list))}, log storici: {log_count}")
+        # Analizza il carattere SOLO SE l'analisi iniziale non è disabilitata
+        characters_from_logs = 0
+        if SKIP_INITIAL_CHARACTER_ANALYSIS:
+            log.info("Analisi iniziale dei caratteri disattivata - verrà eseguita dopo 30 minuti")
+        else:
+            log.info("Analisi iniziale dei caratteri attiva")
+            characters_from_logs = _timed("analisi_caratteri", initial_character_analysis, log_messages, last_seen)
+        restored = restore_character_activity(pending_counts, last_seen)
+        log.info("Utenti con messaggi non ancora analizzati dai log: %d", restored)
+        
+        # Forza un salvataggio dei dati integrati
+        data_manager.save_user_data(user_data)
+        data_manager.save_conversations(conversation_history)
+        
+        # Conta il totale degli utenti dopo l'integrazione
+        total_users = sum(len(chat_users) for chat_users in user_data.values())
+        log.info("Dati caricati: %d chat, %d utenti totali", len(user_data), total_users)
+        log.info("Utenti recuperati dai log: %d, di cui %d con carattere analizzato", users_from_logs, characters_from_logs)
+        log.info("Messaggi nella cronologia: %d, log storici: %d",
+                 sum(len(chat) for chat in list(conversation_history.values()) if isinstance(chat, list)), log_count)
+    except Exception as e:
+        log.exception("Errore durante il riscaldamento: %s", e)
+    finally:
+        warmup_timings["totale"] = time.monotonic() - start
+        THREAD_CYCLE_SECONDS.observe(warmup_timings["totale"], "warm_up")
+        warmup_ready.set()
+        log.info("Riscaldamento completato: %s",
+                 ", ".join(f"{name} {seconds:.1f}s" for name, seconds in warmup_timings.items()))
+    
+    # I thread periodici partono dopo il riscaldamento, per non ripetere le stesse analisi in parallelo
+    context_scheduler.start()
+    threading.Thread(target=character_analysis_thread, daemon=True).start()
+
+def start_background_threads():
+    """Avvia il salvataggio automatico e il riscaldamento in background"""
+    threading.Thread(target=auto_save_thread, daemon=True).start()
+    threading.Thread(target=warm_up, name="WarmUp", daemon=True).start()
+
+# Indicizza in background la cronologia delle chat non ancora presenti negli indici
+def index_backfill_thread():
+    use_embeddings = embedding_index is not None and embedding_index.available
+    pending_chats = []
+    for chat_id in list(user_data.keys()):
+        need_bm25 = bm25_index is not None and not bm25_index.is_backfilled(chat_id)
+        need_embeddings = use_embeddings and not embedding_index.is_backfilled(chat_id)
+        if need_bm25 or need_embeddings:
+            pending_chats.append((chat_id, need_bm25, need_embeddings))
+    # Prima le chat più attive dell'ultima settimana
+    pending_chats.sort(key=lambda item: chat_stats.recent_messages(item[0], 7), reverse=True)
+    
+    for chat_id, need_bm25, need_embeddings in pending_chats:
+        chat_history = logger.get_chat_message_history(chat_id)
+        if not chat_history:
+            continue
+        if need_bm25:
+            indexed = bm25_index.build_from_history(chat_id, chat_history)
+            log.info("Indice BM25 costruito per chat %s (%d messaggi)", chat_id, indexed)
+        if need_embeddings:
+            log.info("Indicizzazione semantica di %d messaggi della chat %s", len(chat_history), chat_id)
+            embedding_index.enqueue_history(chat_id, chat_history)
+
 
 # Avvia il thread di salvataggio automatico
 def auto_save_thread():
     data_manager.auto_save(user_data, conversation_history)
 
-save_thread = threading.Thread(target=auto_save_thread, daemon=True)
-save_thread.start()
+def refresh_chat_context(chat_id):
+    """Rigenera il contesto di una chat dai log; chiamata da context_scheduler quando la chat è attiva"""
+    # Recupera la cronologia messaggi dell'intera chat
+    with THREAD_CYCLE_SECONDS.time("context_refresh"):
+        chat_history = logger.get_chat_message_history(chat_id)
+        if not chat_history:
+            return
+        
+        log.info("Analisi di %d messaggi nella chat %s per contesto...", len(chat_history), chat_id)
+        # Usa un prompt generico per l'analisi del contesto
+        context_analysis = ai_service.analyze_chat_context(chat_history, chat_id=chat_id)
+    # Salva il contesto analizzato nella cache
+    chat_context_cache[chat_id] = {
+        "last_update": datetime.now(),
+        "context": context_analysis,
+        "message_count": len(chat_history)
+    }
+    # Salva anche su disco per persistenza tra riavvii
+    with open(f"data/context_cache_{chat_id}.txt", "w", encoding="utf-8") as f:
+        f.write(context_analysis)
+    log.info("Contesto aggiornato per chat %s (%d caratteri)", chat_id, len(context_analysis))
 
-# Thread per aggiornare periodicamente il contesto dai log
-def context_update_thread():
-    """Thread per aggiornare periodicamente il contesto dalle chat dai log"""
-    global chat_context_cache
+def seed_chat_context(chat_id, bot_username, chat_history=None):
+    """Prepara in background il riassunto di una chat senza contesto in cache (modalità "fused").
     
-    print("Avviato thread di aggiornamento contesto...")
-    while True:
+    Una sola analisi per chat alla volta, eseguite in serie da context_seeder: la risposta che
+    l'ha richiesta non la aspetta, le successive trovano il contesto in cache. Senza chat_history
+    la cronologia viene letta dai log nel thread di background.
+    """
+    with context_seeding_lock:
+        if chat_id in context_seeding:
+            return
+        context_seeding.add(chat_id)
+    
+    def seed():
+        nonlocal chat_history
         try:
-            print("\n--- Aggiornamento contesto dalle chat ---")
-            # Aggiorna il contesto per ogni chat conosciuta
-            for chat_id in user_data.keys():
-                # Recupera la cronologia messaggi dell'intera chat
-                chat_history = logger.get_chat_message_history(chat_id)
-                
+            with THREAD_CYCLE_SECONDS.time("context_seed"):
+                if chat_history is None:
+                    chat_history = logger.get_chat_message_history(chat_id)
                 if not chat_history:
-                    continue
-                
-                print(f"Analisi di {len(chat_history)} messaggi nella chat {chat_id} per contesto...")
-                # Usa un prompt generico per l'analisi del contesto
-                try:
-                    context_analysis = ai_service.analyze_chat_context(chat_history)
-                    # Salva il contesto analizzato nella cache
-                    chat_context_cache[chat_id] = {
-                        "last_update": datetime.now(),
-                        "context": context_analysis,
-                        "message_count": len(chat_history)
-                    }
-                    # Salva anche su disco per persistenza tra riavvii
-                    with open(f"data/context_cache_{chat_id}.txt", "w", encoding="utf-8") as f:
-                        f.write(context_analysis)
-                    print(f"Contesto aggiornato per chat {chat_id}: {context_analysis[:100]}...")
-                except Exception as e:
-                    print(f"Errore durante l'analisi del contesto per la chat {chat_id}: {e}")
-            
-            # Dormi per 30 minuti (modificato da 2 minuti)
-            time.sleep(1800)
+                    return
+                context_analysis = ai_service.analyze_chat_context_with_focus(chat_history, bot_username, chat_id=chat_id)
+            # In caso di errore il modello restituisce il testo di ripiego: non va messo in cache
+            if context_analysis != "Nessuna informazione rilevante trovata." and chat_id not in chat_context_cache:
+                chat_context_cache[chat_id] = {
+                    "last_update": datetime.now(),
+                    "context": context_analysis,
+                    "message_count": len(chat_history)
+                }
+                with open(f"data/context_cache_{chat_id}.txt", "w", encoding="utf-8") as f:
+                    f.write(context_analysis)
+                log.info("Contesto iniziale preparato per chat %s (%d caratteri)", chat_id, len(context_analysis))
         except Exception as e:
-            print(f"Errore nel thread di aggiornamento contesto: {e}")
-            time.sleep(30)  # Riprova dopo 30 secondi in caso di errore
+            log.error("Errore nella preparazione del contesto per chat %s: %s", chat_id, e)
+        finally:
+            with context_seeding_lock:
+                context_seeding.discard(chat_id)
+    
+    context_seeder.submit(seed)
+
+# Campi di user_data[chat_id][user_id] con il profilo e lo stato della sua ultima analisi
+CHARACTER_KEYS = ('carattere', 'carattere_ultimo_messaggio', 'carattere_num_messaggi')
+
+# Utenti con messaggi nuovi dall'ultima analisi: (chat_id, user_id) -> numero di messaggi
+character_activity = {}
+character_activity_lock = threading.Lock()
+
+def note_character_activity(log_entry):
+    """Listener di MessageLogger: conta i messaggi nuovi di ogni utente per l'analisi del carattere"""
+    text = log_entry.get("text")
+    if not text or text.startswith('/') or log_entry.get("user_id") is None:
+        return
+    key = (log_entry["chat_id"], log_entry["user_id"])
+    with character_activity_lock:
+        character_activity[key] = character_activity.get(key, 0) + 1
+
+def sample_character_messages(new_messages, old_messages, max_messages=CHARACTER_SAMPLE_SIZE):
+    """Campione limitato e rappresentativo dei messaggi di un utente.
+    
+    Tiene i messaggi nuovi più recenti (fino a due terzi del campione) e completa con messaggi
+    più vecchi distribuiti su tutta la cronologia, scartando i duplicati.
+    """
+    seen = set()
+    
+    def unique(messages):
+        result = []
+        for text in messages:
+            key = " ".join(text.casefold().split())
+            if key and key not in seen:
+                seen.add(key)
+                result.append(text)
+        return result
+    
+    recent = unique(reversed(new_messages))[:max(1, max_messages * 2 // 3)][::-1]
+    older = unique(old_messages)
+    slots = max_messages - len(recent)
+    if slots <= 0 or not older:
+        return recent
+    if len(older) > slots:
+        step = len(older) / slots
+        older = [older[int(i * step)] for i in range(slots)]
+    return older + recent
+
+def analyze_user_incrementally(chat_id, user_id, messages):
+    """Rianalizza il carattere di un utente se ha abbastanza messaggi dall'ultima analisi.
+    
+    ``messages`` è la cronologia dell'utente nel formato di get_chat_message_history. Restituisce
+    True se il profilo è stato aggiornato.
+    """
+    user_info = user_data.get(chat_id, {}).get(user_id)
+    if not user_info:
+        return False
+    last_analyzed = user_info.get('carattere_ultimo_messaggio', "")
+    new_messages = [msg for msg in messages if msg['timestamp'] > last_analyzed]
+    # Serve un numero minimo di messaggi nuovi (e in totale, per la prima analisi)
+    if len(new_messages) < CHARACTER_MIN_NEW_MESSAGES:
+        return False
+    old_messages = [msg['text'] for msg in messages if msg['timestamp'] <= last_analyzed]
+    sample = sample_character_messages([msg['text'] for msg in new_messages], old_messages)
+    
+    log.info("Analisi carattere di %s (%d messaggi nuovi, campione di %d)...",
+             user_info['first_name'], len(new_messages), len(sample))
+    carattere = ai_service.analyze_user_character(sample, user_info.get('carattere'), chat_id=chat_id)
+    if not carattere:
+        return False
+    # Il record può essere stato sostituito da prepare_request nel frattempo: si aggiorna quello attuale
+    current = user_data[chat_id].get(user_id, user_info)
+    current['carattere'] = carattere
+    current['carattere_ultimo_messaggio'] = new_messages[-1]['timestamp']
+    current['carattere_num_messaggi'] = len(messages)
+    log.debug("Carattere aggiornato: %.50s...", carattere)
+    return True
 
 # Thread per analizzare il carattere degli utenti periodicamente
+def analyze_chat_characters(chat_id, user_ids):
+    """Rianalizza gli utenti indicati di una chat; restituisce quanti profili sono stati aggiornati"""
+    chat_history = logger.get_chat_message_history(chat_id)
+    updated = 0
+    for user_id in user_ids:
+        # Azzerato prima dell'analisi: i messaggi che arrivano nel frattempo contano per la prossima
+        with character_activity_lock:
+            character_activity.pop((chat_id, user_id), None)
+        messages = [
+            msg for msg in chat_history
+            if msg['user_id'] == user_id and not msg['text'].startswith('/')
+        ]
+        try:
+            if analyze_user_incrementally(chat_id, user_id, messages):
+                updated += 1
+        except Exception as e:
+            log.error("Errore nell'analisi del carattere: %s", e)
+    return updated
+
 def character_analysis_thread():
-    """Thread per analizzare il carattere degli utenti ogni 30 minuti"""
-    global user_data
-    
+    """Thread che ogni 30 minuti rianalizza solo gli utenti con abbastanza messaggi nuovi"""
     if SKIP_INITIAL_CHARACTER_ANALYSIS:
-        print("Analisi iniziale dei caratteri disattivata. Prima analisi tra 30 minuti...")
+        log.info("Analisi iniziale dei caratteri disattivata. Prima analisi tra 30 minuti...")
         time.sleep(1800)  # Dormi per 30 minuti prima della prima analisi
     
-    print("Avviato thread di analisi del carattere...")
+    log.info("Avviato thread di analisi del carattere...")
     while True:
         try:
-            print("\n--- Analisi periodica del carattere degli utenti ---")
-            # Per ogni chat conosciuta
-            for chat_id in user_data.keys():
-                # Recupera tutti i messaggi della chat
-                chat_history = logger.get_chat_message_history(chat_id)
-                
-                if not chat_history:
-                    continue
-                
-                print(f"Analizzando caratteri nella chat {chat_id} con {len(chat_history)} messaggi...")
-                
-                # Raggruppa i messaggi per utente
-                user_messages = {}
-                for msg in chat_history:
-                    user_id = msg['user_id']
-                    if user_id not in user_messages:
-                        user_messages[user_id] = []
-                    user_messages[user_id].append(msg['text'])
-                
-                # Analizza il carattere di ogni utente
-                for user_id, messages in user_messages.items():
-                    # Verifica che ci siano abbastanza messaggi per l'analisi
-                    if len(messages) < 5:
-                        continue
-                    
-                    # Verifica che l'utente sia nel database
-                    if user_id not in user_data[chat_id]:
-                        continue
-                    
-                    user_info = user_data[chat_id][user_id]
-                    try:
-                        print(f"Analisi carattere di {user_info['first_name']} ({len(messages)} messaggi)...")
-                        carattere = ai_service.analyze_user_character(messages)
-                        if carattere:
-                            user_data[chat_id][user_id]['carattere'] = carattere
-                            print(f"Carattere aggiornato: {carattere[:50]}...")
-                    except Exception as e:
-                        print(f"Errore nell'analisi del carattere: {e}")
+            cycle_start = time.monotonic()
+            with character_activity_lock:
+                candidates = [key for key, count in character_activity.items() if count >= CHARACTER_MIN_NEW_MESSAGES]
+            log.info("--- Analisi periodica del carattere: %d utenti con messaggi nuovi ---", len(candidates))
+            
+            # La cronologia si legge una volta per chat, solo per le chat con utenti da rianalizzare
+            users_by_chat = {}
+            for chat_id, user_id in candidates:
+                users_by_chat.setdefault(chat_id, []).append(user_id)
+            
+            # Le chat procedono in parallelo su character_pool: una chat lenta non ferma le altre;
+            # le più attive di oggi partono per prime
+            ordered_chats = sorted(users_by_chat, key=chat_stats.recent_messages, reverse=True)
+            summary, results = character_pool.run_pass([
+                (chat_id, analyze_chat_characters, (chat_id, users_by_chat[chat_id])) for chat_id in ordered_chats
+            ])
+            updated = sum(results.values())
             
             # Salva i dati dopo l'analisi
-            data_manager.save_user_data(user_data)
+            if updated:
+                data_manager.save_user_data(user_data)
             
-            print("Analisi completata. Prossima analisi tra 30 minuti.")
+            cycle_seconds = time.monotonic() - cycle_start
+            THREAD_CYCLE_SECONDS.observe(cycle_seconds, "character_analysis")
+            log.info("Analisi completata: %d chat, %d profili aggiornati, %d errori, %d oltre il timeout in %.0f s. "
+                     "Prossima analisi tra 30 minuti.",
+                     summary["tasks"], updated, summary["errors"], summary["timeouts"], cycle_seconds)
+            if cycle_seconds > 1800:
+                log.warning("L'analisi del carattere dura più del suo intervallo: aumentare BACKGROUND_CONCURRENCY")
             time.sleep(1800)  # 30 minuti in secondi
         except Exception as e:
-            print(f"Errore nel thread di analisi del carattere: {e}")
+            log.exception("Errore nel thread di analisi del carattere: %s", e)
             time.sleep(300)  # 5 minuti in caso di errore
 
-# Avvia il thread per l'aggiornamento del contesto
-context_thread = threading.Thread(target=context_update_thread, daemon=True)
-context_thread.start()
-
-# Avvia il thread per l'analisi del carattere
-character_thread = threading.Thread(target=character_analysis_thread, daemon=True)
-character_thread.start()
-
-# Log informativo
-if SKIP_INITIAL_CHARACTER_ANALYSIS:
-    print("Analisi iniziale dei caratteri disattivata - verrà eseguita dopo 30 minuti")
-else:
-    print("Analisi iniziale dei caratteri attiva")
-
-@bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
     logger.log_message(message)
-    bot.reply_to(message, "Ciao! Sono il tuo bot Telegram alimentato da AI. Menzionami in un gruppo per farmi rispondere!")
+    send_dispatcher.reply_to(message, "Ciao! Sono il tuo bot Telegram alimentato da AI. Menzionami in un gruppo per farmi rispondere!")
 
-@bot.message_handler(commands=['reset'])
 def reset_conversation(message):
     logger.log_message(message)
     chat_id = message.chat.id
     if chat_id in conversation_history:
-        conversation_history[chat_id] = []
-        bot.reply_to(message, "Ho azzerato la memoria della nostra conversazione.")
+        with conversation_lock:
+            conversation_history[chat_id] = []
+        data_manager.mark_dirty("conversations")
+        send_dispatcher.reply_to(message, "Ho azzerato la memoria della nostra conversazione.")
     else:
-        bot.reply_to(message, "Non c'era alcuna conversazione da azzerare.")
+        send_dispatcher.reply_to(message, "Non c'era alcuna conversazione da azzerare.")
 
-@bot.message_handler(commands=['carattere'])
 def view_character(message):
     logger.log_message(message)
     chat_id = message.chat.id
@@ -236,25 +670,24 @@ def view_character(message):
         if chat_id in user_data and target_user_id in user_data[chat_id] and 'carattere' in user_data[chat_id][target_user_id]:
             carattere = user_data[chat_id][target_user_id]['carattere']
             nome = user_data[chat_id][target_user_id]['first_name']
-            bot.reply_to(message, f"Il carattere di {nome} che ho rilevato è: {carattere}")
+            send_dispatcher.reply_to(message, f"Il carattere di {nome} che ho rilevato è: {carattere}")
         else:
-            bot.reply_to(message, "Non ho ancora analizzato abbastanza messaggi di questo utente per determinarne il carattere.")
+            send_dispatcher.reply_to(message, "Non ho ancora analizzato abbastanza messaggi di questo utente per determinarne il carattere.")
     else:
         # Informazioni sul proprio carattere
         if chat_id in user_data and user_id in user_data[chat_id] and 'carattere' in user_data[chat_id][user_id]:
             carattere = user_data[chat_id][user_id]['carattere']
-            bot.reply_to(message, f"Il carattere che ho rilevato per te è: {carattere}")
+            send_dispatcher.reply_to(message, f"Il carattere che ho rilevato per te è: {carattere}")
         else:
-            bot.reply_to(message, "Non ho ancora analizzato abbastanza tuoi messaggi per determinare il tuo carattere.")
+            send_dispatcher.reply_to(message, "Non ho ancora analizzato abbastanza tuoi messaggi per determinare il tuo carattere.")
 
-@bot.message_handler(commands=['utenti'])
 def list_users(message):
     """Mostra la lista degli utenti che hanno interagito col bot nella chat corrente"""
     logger.log_message(message)
     chat_id = message.chat.id
     
     if chat_id not in user_data or len(user_data[chat_id]) == 0:
-        bot.reply_to(message, "Non ho ancora memorizzato alcun utente in questa chat.")
+        send_dispatcher.reply_to(message, "Non ho ancora memorizzato alcun utente in questa chat.")
         return
     
     # Crea una lista formattata degli utenti
@@ -283,38 +716,145 @@ def list_users(message):
     # Aggiungi una nota finale
     footer = "\n\nℹ️ Il carattere degli utenti viene aggiornato automaticamente in base ai loro messaggi."
     
-    # Invia il messaggio con formattazione Markdown
-    try:
-        bot.reply_to(message, header + users_text + footer, parse_mode="Markdown")
-    except Exception as e:
-        # In caso di errore di formattazione, invia senza Markdown
-        print(f"Errore nell'invio del messaggio formattato: {e}")
-        bot.reply_to(message, "Utenti memorizzati:\n\n" + "\n\n".join(user_list))
+    # Invia il messaggio con formattazione Markdown; l'esito arriva in una callback, così il worker
+    # della chat non resta fermo in attesa della coda di invio
+    def send_plain_on_error(future):
+        if future.exception() is not None:
+            # In caso di errore di formattazione, invia senza Markdown
+            log.warning("Errore nell'invio del messaggio formattato: %s", future.exception())
+            send_dispatcher.reply_to(message, "Utenti memorizzati:\n\n" + "\n\n".join(user_list))
+    send_dispatcher.reply_to(message, header + users_text + footer, parse_mode="Markdown").add_done_callback(
+        send_plain_on_error
+    )
 
-@bot.message_handler(commands=['logs'])
 def view_logs(message):
     """Mostra gli ultimi log per gli amministratori"""
     logger.log_message(message)
-    # Lista degli ID utenti autorizzati a vedere i log
-    # Sostituisci con gli ID effettivi
-    admin_ids = [12345678, 87654321]
-    
-    if message.from_user.id not in admin_ids:
-        bot.reply_to(message, "Non sei autorizzato a usare questo comando.")
+    if message.from_user.id not in ADMIN_IDS:
+        send_dispatcher.reply_to(message, "Non sei autorizzato a usare questo comando.")
         return
     
     logs = logger.get_recent_logs(10)
     if not logs:
-        bot.reply_to(message, "Nessun log disponibile.")
+        send_dispatcher.reply_to(message, "Nessun log disponibile.")
         return
     
     logs_text = "Ultimi 10 messaggi registrati:\n\n"
     for log in logs:
         logs_text += f"- {log['timestamp']}: {log['user_first_name']} in {log['chat_type']}: {log['text'][:30]}...\n"
     
-    bot.reply_to(message, logs_text)
+    send_dispatcher.reply_to(message, logs_text)
+
+def view_stats(message):
+    """Mostra agli amministratori i percentili di latenza per fase, le risposte più lente e i passaggi in background"""
+    logger.log_message(message)
+    
+    if message.from_user.id not in ADMIN_IDS:
+        send_dispatcher.reply_to(message, "Non sei autorizzato a usare questo comando.")
+        return
+    
+    summary = tracer.stage_summary()
+    if not summary:
+        send_dispatcher.reply_to(message, "Nessuna traccia disponibile.")
+        return
+    
+    stats_text = "Latenza per fase (ms) - campioni, p50 / p95 / p99:\n"
+    for stage, (count, p50, p95, p99) in sorted(summary.items(), key=lambda item: item[1][2], reverse=True):
+        stats_text += f"- {stage}: {count}, {p50 * 1000:.0f} / {p95 * 1000:.0f} / {p99 * 1000:.0f}\n"
+    
+    slowest = tracer.slowest(5, name="risposta")
+    if slowest:
+        stats_text += "\nRisposte più lente:\n"
+        for trace in slowest:
+            stages = ", ".join(f"{stage} {seconds * 1000:.0f}" for stage, seconds in trace.spans)
+            started = datetime.fromtimestamp(trace.started_at).strftime("%H:%M:%S")
+            stats_text += f"- {started} chat {trace.chat_id}: {trace.total * 1000:.0f} ms ({stages})\n"
+    
+    # Con il prefisso in cache il modello valuta solo i token nuovi: media per chiamata più bassa
+    prompt_eval = ai_service.prompt_eval_summary()
+    if prompt_eval:
+        stats_text += "\nValutazione del prompt per metodo - chiamate, token medi, ms medi:\n"
+        for method, totals in sorted(prompt_eval.items()):
+            calls = totals["calls"]
+            stats_text += (f"- {method}: {calls}, {totals['prompt_eval_count'] / calls:.0f}, "
+                           f"{totals['prompt_eval_ms'] / calls:.0f}\n")
+    
+    for pool in (context_pool, character_pool):
+        if pool.last_pass:
+            last = pool.last_pass
+            stats_text += (f"\nUltimo passaggio {pool.name}: {last['tasks']} chat in {last['seconds']:.0f} s, "
+                           f"{last['errors']} errori, {last['timeouts']} oltre il timeout, "
+                           f"{last['busy']} ancora in corso\n")
+        slow_chats = pool.slowest_chats(3)
+        if slow_chats:
+            stats_text += f"Chat più lente in {pool.name}: " + ", ".join(
+                f"{chat_id} {stats['last_seconds']:.0f} s ({stats['errors']} errori, {stats['timeouts']} timeout)"
+                for chat_id, stats in slow_chats
+            ) + "\n"
+    
+    send_dispatcher.reply_to(message, stats_text)
+
+def view_usage(message):
+    """Mostra agli amministratori dove va il tempo GPU: /usage [method|chat|priority|hour] [24h]"""
+    logger.log_message(message)
+    
+    if message.from_user.id not in ADMIN_IDS:
+        send_dispatcher.reply_to(message, "Non sei autorizzato a usare questo comando.")
+        return
+    if usage_ledger is None:
+        send_dispatcher.reply_to(message, "Il registro di uso è disattivato (ENABLE_USAGE_LEDGER).")
+        return
+    
+    args = message.text.split()[1:]
+    by = tuple(args[0].split(",")) if args else ("method",)
+    try:
+        since = parse_since(args[1] if len(args) > 1 else "24h")
+        report = usage_ledger.report(by, since, top=15)
+    except (KeyError, ValueError):
+        send_dispatcher.reply_to(message, "Uso: /usage [method|chat|model|priority|hour|day] [30m|24h|7d]")
+        return
+    send_dispatcher.reply_to(message, report)
+
+WEEKDAY_NAMES = ["lunedì", "martedì", "mercoledì", "giovedì", "venerdì", "sabato", "domenica"]
+
+def view_chat_stats(message):
+    """Mostra l'attività della chat corrente dai contatori di ChatStats, senza leggere i log"""
+    logger.log_message(message)
+    chat_id = message.chat.id
+    
+    summary = chat_stats.chat_summary(chat_id)
+    if summary is None:
+        send_dispatcher.reply_to(message, "Non ho ancora statistiche per questa chat.")
+        return
+    
+    first = datetime.fromisoformat(summary["first"])
+    last = datetime.fromisoformat(summary["last"])
+    week = chat_stats.messages_per_day(chat_id, 7)
+    week_total = sum(count for _, count in week)
+    stats_text = (f"📊 Attività di questa chat\n\n"
+                  f"Messaggi: {summary['messages']} dal {first.strftime('%d/%m/%Y')}, "
+                  f"ultimo il {last.strftime('%d/%m/%Y alle %H:%M')}\n"
+                  f"Ultimi 7 giorni: {week_total} (media {week_total / 7:.1f} al giorno)\n"
+                  + " ".join(f"{day.strftime('%d/%m')}: {count}" for day, count in week) + "\n")
+    
+    stats_text += f"\nUtenti più attivi ({summary['users']} in totale):\n"
+    for position, (_, name, count, _, user_last) in enumerate(chat_stats.top_users(chat_id, 5), 1):
+        seen = datetime.fromisoformat(user_last).strftime('%d/%m %H:%M')
+        stats_text += f"{position}. {name or 'Utente'}: {count} messaggi (ultimo {seen})\n"
+    
+    busiest_hours = sorted(range(24), key=lambda hour: summary["hours"][hour], reverse=True)[:3]
+    stats_text += "\nOre più attive: " + ", ".join(
+        f"{hour:02d}:00 ({summary['hours'][hour]})" for hour in busiest_hours if summary["hours"][hour]
+    ) + "\n"
+    busiest_day = max(range(7), key=lambda day: summary["weekdays"][day])
+    stats_text += f"Giorno più attivo: {WEEKDAY_NAMES[busiest_day]}\n"
+    
+    if summary["commands"]:
+        commands = sorted(summary["commands"].items(), key=lambda item: item[1], reverse=True)[:5]
+        stats_text += "Comandi più usati: " + ", ".join(f"{command} ({count})" for command, count in commands) + "\n"
+    
+    send_dispatcher.reply_to(message, stats_text)
 
-@bot.message_handler(commands=['cattivo'])
 def toggle_cattivo_mode(message):
     logger.log_message(message)
     chat_id = message.chat.id
@@ -322,31 +862,28 @@ def toggle_cattivo_mode(message):
     cattivo_mode[chat_id] = not cattivo_mode.get(chat_id, False)
     
     if cattivo_mode[chat_id]:
-        bot.reply_to(message, "Modalità cattiva attivata. Ora sarò terribilmente maleducato. 😈")
+        send_dispatcher.reply_to(message, "Modalità cattiva attivata. Ora sarò terribilmente maleducato. 😈")
     else:
-        bot.reply_to(message, "Modalità cattiva disattivata. Torno ad essere gentile. 🙂")
+        send_dispatcher.reply_to(message, "Modalità cattiva disattivata. Torno ad essere gentile. 🙂")
 
-@bot.message_handler(commands=['ripara_contesto'])
 def repair_context(message):
     """Ripara il contesto della chat per migliorare la distinzione tra messaggi"""
     if message.from_user.id in [7905022928]:  # Sostituisci con l'ID dell'amministratore
         chat_id = message.chat.id
-        bot.reply_to(message, "🔄 Rigenerazione del contesto in corso...")
+        send_dispatcher.reply_to(message, "🔄 Rigenerazione del contesto in corso...")
         
         try:
             # Ottieni la cronologia completa
             chat_history = logger.get_chat_message_history(chat_id)
             
             if not chat_history:
-                bot.reply_to(message, "❌ Nessuna cronologia disponibile per questa chat")
+                send_dispatcher.reply_to(message, "❌ Nessuna cronologia disponibile per questa chat")
                 return
                 
-            # Get bot's username
-            bot_info = bot.get_me()
-            bot_username = f"@{bot_info.username}"
+            bot_username = f"@{get_bot_info().username}"
             
             # Rigenerazione del contesto con il nuovo metodo
-            context_analysis = ai_service.analyze_chat_context_with_focus(chat_history, bot_username)
+            context_analysis = ai_service.analyze_chat_context_with_focus(chat_history, bot_username, chat_id=chat_id)
             
             # Salva il nuovo contesto
             chat_context_cache[chat_id] = {
@@ -359,14 +896,13 @@ def repair_context(message):
             with open(f"data/context_cache_{chat_id}.txt", "w", encoding="utf-8") as f:
                 f.write(context_analysis)
                 
-            bot.reply_to(message, "✅ Contesto rigenerato con successo!")
+            send_dispatcher.reply_to(message, "✅ Contesto rigenerato con successo!")
             
         except Exception as e:
-            bot.reply_to(message, f"❌ Errore durante la rigenerazione: {str(e)}")
+            send_dispatcher.reply_to(message, f"❌ Errore durante la rigenerazione: {str(e)}")
     else:
-        bot.reply_to(message, "⛔ Solo gli amministratori possono usare questo comando")
+        send_dispatcher.reply_to(message, "⛔ Solo gli amministratori possono usare questo comando")
 
-@bot.message_handler(commands=['reload_files'])
 def reload_files(message):
     """Ricarica i file di intercalari e appellativi"""
     logger.log_message(message)
@@ -374,7 +910,7 @@ def reload_files(message):
     # Verifica se l'utente è un amministratore
     admin_ids = [7905022928]  # Sostituisci con gli ID degli admin
     if message.from_user.id not in admin_ids:
-        bot.reply_to(message, "Non sei autorizzato a usare questo comando.")
+        send_dispatcher.reply_to(message, "Non sei autorizzato a usare questo comando.")
         return
     
     try:
@@ -383,17 +919,17 @@ def reload_files(message):
         ai_service.appellativi_cattivo = ai_service._load_data_file("data/appellativi_cattivo.json", [])
         ai_service.appellativi_non_cattivo = ai_service._load_data_file("data/appellativi_non_cattivo.json", [])
         
-        bot.reply_to(message, "✅ File ricaricati con successo!")
+        send_dispatcher.reply_to(message, "✅ File ricaricati con successo!")
     except Exception as e:
-        bot.reply_to(message, f"❌ Errore durante il ricaricamento dei file: {e}")
+        send_dispatcher.reply_to(message, f"❌ Errore durante il ricaricamento dei file: {e}")
 
-def send_long_message(chat_id, text, reply_to_message_id=None):
-    """Divide messaggi lunghi in parti per rispettare il limite di Telegram"""
-    MAX_MESSAGE_LENGTH = 4000  # Usando 4000 invece di 4096 per sicurezza
-    
+MAX_MESSAGE_LENGTH = 4000  # Usando 4000 invece di 4096 per sicurezza
+
+def split_long_message(text):
+    """Divide un testo lungo nelle parti (già numerate) da inviare per rispettare il limite di Telegram"""
     if len(text) <= MAX_MESSAGE_LENGTH:
         # Messaggio abbastanza corto, invialo normalmente
-        return bot.send_message(chat_id, text, reply_to_message_id=reply_to_message_id)
+        return [text]
     
     # Dividi il messaggio in parti
     parts = []
@@ -415,143 +951,393 @@ def send_long_message(chat_id, text, reply_to_message_id=None):
         
         parts.append(part)
     
-    # Invia ogni parte, numerandola
+    # Numera ogni parte
     total_parts = len(parts)
+    return [f"[Parte {idx+1}/{total_parts}]\n\n" + part for idx, part in enumerate(parts)]
+
+def send_long_message(chat_id, text, reply_to_message_id=None):
+    """Divide messaggi lunghi in parti per rispettare il limite di Telegram.
+    
+    Le parti passano dalla coda di invio, che ne mantiene l'ordine: restituisce il Future dell'ultima.
+    """
     last_message = None
     
-    for idx, part in enumerate(parts):
-        if total_parts > 1:
-            part_header = f"[Parte {idx+1}/{total_parts}]\n\n"
-            message_text = part_header + part
-        else:
-            message_text = part
-        
+    for idx, message_text in enumerate(split_long_message(text)):
         # Solo il primo messaggio risponde al messaggio originale
         if idx == 0 and reply_to_message_id:
-            last_message = bot.send_message(chat_id, message_text, reply_to_message_id=reply_to_message_id)
+            last_message = send_dispatcher.send_message(chat_id, message_text, reply_to_message_id=reply_to_message_id)
         else:
-            last_message = bot.send_message(chat_id, message_text)
+            last_message = send_dispatcher.send_message(chat_id, message_text)
     
     return last_message
 
-@bot.message_handler(func=lambda message: True)
-def handle_message(message):
+def search_bm25(chat_id, query, exclude_texts):
+    """Cerca nell'indice BM25 i messaggi passati pertinenti, esclusi quelli appena ricevuti"""
     try:
-        # Log del messaggio ricevuto
-        logger.log_message(message)
-        
-        print(f"\n--- Nuovo messaggio ---")
-        print(f"Da: {message.from_user.first_name} ({message.from_user.id})")
-        print(f"Chat ID: {message.chat.id}, Tipo: {message.chat.type}")
-        print(f"Testo: {message.text if message.text else 'Nessun testo'}")
-        
-        user_id = message.from_user.id
-        chat_id = message.chat.id
-        
-        # Get bot's username - SPOSTATO QUI IN ALTO
-        bot_info = bot.get_me()
-        bot_username = f"@{bot_info.username}"
-        
-        # INIZIO NUOVA FUNZIONALITÀ - Risposta ai nomi alternativi
-        # Lista di parole chiave che attivano la risposta speciale
-        trigger_words = ["gaetano", "gae", "gboipelo"]
-        
-        # Verifica se il messaggio contiene una delle parole chiave (case insensitive)
-        if message.text and any(word.lower() in message.text.lower() for word in trigger_words):
-            # Evita di rispondere ai propri messaggi o a comandi
-            if not message.text.startswith('/') and not message.from_user.is_bot:
-                bot.reply_to(message, "Gae scem8")
-                # Se è solo un trigger word senza richieste al bot, termina qui
-                if not (message.chat.type == "private" or 
-                       (bot_username.lower() in message.text.lower()) or
-                       (message.reply_to_message and message.reply_to_message.from_user.id == bot_info.id)):
-                    return
-        # FINE NUOVA FUNZIONALITÀ
-        
-        # Aggiorna o salva dati utente e conversazione come prima
-        user_info = {
-            'id': user_id,
-            'first_name': message.from_user.first_name,
-            'last_name': message.from_user.last_name if message.from_user.last_name else "",
-            'username': message.from_user.username if message.from_user.username else ""
-        }
-        
-        if chat_id not in user_data:
-            user_data[chat_id] = {}
-        
-        if user_id in user_data[chat_id] and 'carattere' in user_data[chat_id][user_id]:
-            user_info['carattere'] = user_data[chat_id][user_id]['carattere']
-        
-        user_data[chat_id][user_id] = user_info
-        
-        if chat_id not in conversation_history:
-            conversation_history[chat_id] = []
-        
-        if message.text:
-            user_message = {"role": "user", "content": message.text, "user_info": user_info}
-            conversation_history[chat_id].append(user_message)
-        
-        if len(conversation_history[chat_id]) > 100:
-            conversation_history[chat_id] = conversation_history[chat_id][-100:]
-        
-        # Determina se il messaggio è diretto al bot
-        is_directed_to_bot = (
-            message.chat.type == "private" or
-            (message.text and bot_username in message.text) or
-            (message.reply_to_message and message.reply_to_message.from_user.id == bot_info.id)
+        with tracing.span("ricerca_bm25"):
+            hits = bm25_index.search(chat_id, query, BM25_TOP_N + len(exclude_texts))
+        return [msg for msg in hits if msg['text'] not in exclude_texts][:BM25_TOP_N]
+    except Exception as e:
+        log.error("Errore nella ricerca BM25 per chat %s: %s", chat_id, e)
+        return []
+
+def gather_reply_context(chat_id, batch):
+    """Prima parte di build_reply_context: tutto tranne la chiamata al modello per l'analisi.
+    
+    Restituisce un dizionario con domanda, contesto e, in ``history_to_analyze``, la cronologia da
+    analizzare col modello (None se non serve); finish_reply_context completa il risultato.
+    """
+    bot_username = batch[-1]["bot_username"]
+    if len(batch) == 1:
+        question = batch[0]["question"]
+    else:
+        # Più domande ravvicinate: una sola risposta che si rivolge a ciascun utente
+        question = "Più utenti ti hanno scritto quasi contemporaneamente. Rispondi a ciascuno, chiamandolo per nome:\n" + "\n".join(
+            f"- {request['user_name']}: {request['question']}" for request in batch
         )
-        
-        # Continua solo se il messaggio è diretto al bot
-        if is_directed_to_bot and message.text:
-            # Rimuovi il nome del bot dal messaggio se presente
-            clean_message = message.text.replace(bot_username, "").strip()
-            if not clean_message:
-                clean_message = message.text
-            
-            # Ottieni informazioni di contesto
-            chat_history = []
-            history_analysis = "Nessuna informazione rilevante trovata."
-            
-            # Scegli il metodo appropriato per ottenere il contesto
-            if chat_id in chat_context_cache:
-                history_analysis = chat_context_cache[chat_id]["context"]
-                print(f"Usando contesto memorizzato: {history_analysis[:50]}...")
-            else:
+        log.info("Chat %s: %d richieste unite in una sola risposta", chat_id, len(batch))
+    search_query = " ".join(request["question"] for request in batch)
+    current_texts = {request["message"].text for request in batch}
+    current_ids = {request["message"].message_id for request in batch}
+    
+    # Ottieni informazioni di contesto
+    chat_history = []
+    history_analysis = "Nessuna informazione rilevante trovata."
+    relevant_messages = []
+    recent_chat = None
+    history_to_analyze = None
+    
+    # Memoria a breve termine: gli ultimi turni di conversation_history, risposte del bot comprese
+    history_turns = []
+    window_covers_history = False
+    if CONVERSATION_WINDOW_TOKENS > 0:
+        with conversation_lock:
+            history = list(conversation_history.get(chat_id, []))
+        history_turns, omitted = select_window(history, CONVERSATION_WINDOW_TOKENS, current_ids)
+        # Il riassunto serve solo per ciò che resta fuori dalla finestra, anche nei log (limite, /reset)
+        window_covers_history = bool(history_turns) and omitted == 0 and history_reaches_first_message(chat_id, history)
+        log.debug("Chat %s: %d messaggi nella finestra, %d turni fuori", chat_id, len(history_turns), omitted)
+    
+    # Recupera dall'indice semantico i messaggi passati più vicini alla domanda
+    if embedding_index:
+        try:
+            with tracing.span("ricerca_semantica"):
+                hits = embedding_index.search(chat_id, search_query, EMBEDDING_TOP_K)
+            relevant_messages = [msg for msg in hits if msg['text'] not in current_texts]
+        except Exception as e:
+            log.error("Errore nella ricerca semantica per chat %s: %s", chat_id, e)
+    
+    # Scegli il metodo appropriato per ottenere il contesto
+    if not window_covers_history:
+        CACHE_REQUESTS.inc("chat_context", "hit" if chat_id in chat_context_cache else "miss")
+    if window_covers_history:
+        log.debug("La finestra copre tutta la conversazione di chat %s: nessun riassunto", chat_id)
+    elif chat_id in chat_context_cache:
+        history_analysis = chat_context_cache[chat_id]["context"]
+        log.debug("Usando contesto memorizzato per chat %s (%d caratteri)", chat_id, len(history_analysis))
+    elif CONTEXT_PROVIDER == "fused":
+        # Una sola generazione: gli ultimi messaggi vanno nel prompt, il riassunto si prepara dopo
+        if history_turns:
+            # La finestra contiene già i messaggi recenti: i log si leggono solo in background
+            seed_chat_context(chat_id, bot_username)
+        else:
+            with tracing.span("get_chat_message_history"):
                 chat_history = logger.get_chat_message_history(chat_id)
-                if chat_history:
-                    # Usa il metodo che chiaramente distingue messaggi per il bot
-                    history_analysis = ai_service.analyze_message_history_with_focus(
-                        chat_history, clean_message, bot_username
-                    )
-                    print(f"Contesto rilevante trovato: {history_analysis[:100]}...")
-            
+            if chat_history:
+                recent_chat = ai_service.format_recent_messages(
+                    chat_history, bot_username, FUSED_RECENT_MESSAGES, FUSED_MESSAGE_CHARS
+                )
+                seed_chat_context(chat_id, bot_username, chat_history)
+            log.debug("Usando %d messaggi recenti nel prompt per chat %s", min(len(chat_history), FUSED_RECENT_MESSAGES), chat_id)
+    elif relevant_messages:
+        # I messaggi recuperati sostituiscono la chiamata LLM di analisi della cronologia
+        log.debug("Usando %d messaggi dall'indice semantico per chat %s", len(relevant_messages), chat_id)
+    elif CONTEXT_PROVIDER == "bm25" and bm25_index:
+        relevant_messages = search_bm25(chat_id, search_query, current_texts)
+        log.debug("Usando %d messaggi dall'indice BM25 per chat %s", len(relevant_messages), chat_id)
+    else:
+        with tracing.span("get_chat_message_history"):
+            chat_history = logger.get_chat_message_history(chat_id)
+        # L'analisi col modello la fa chi chiama: in un thread (bot.py) o in una coroutine (async_bot.py)
+        history_to_analyze = chat_history or None
+    
+    return {
+        "question": question, "search_query": search_query, "current_texts": current_texts,
+        "bot_username": bot_username, "history_analysis": history_analysis,
+        "relevant_messages": relevant_messages, "recent_chat": recent_chat, "history_turns": history_turns,
+        "history_to_analyze": history_to_analyze,
+    }
+
+def history_reaches_first_message(chat_id, history):
+    """Indica se conversation_history parte dal primo messaggio di testo registrato nei log della chat"""
+    message_ids = [turn.get("message_id") for turn in history if turn.get("role") == "user"]
+    # Turni salvati prima che avessero il message_id: non si può sapere da dove partono
+    if not message_ids or None in message_ids:
+        return False
+    first_logged = chat_stats.first_text_message_id(chat_id)
+    return first_logged is not None and min(message_ids) <= first_logged
+
+def finish_reply_context(chat_id, context, history_analysis=None):
+    """Completa gather_reply_context con l'analisi della cronologia, se è stata fatta"""
+    relevant_messages = context["relevant_messages"]
+    if history_analysis is None:
+        history_analysis = context["history_analysis"]
+    else:
+        log.debug("Contesto rilevante trovato per chat %s (%d caratteri)", chat_id, len(history_analysis))
+        # Se il modello non ha risposto (es. server sovraccarico) ripiega sull'indice BM25
+        if history_analysis == "Nessuna informazione rilevante trovata." and bm25_index:
+            relevant_messages = search_bm25(chat_id, context["search_query"], context["current_texts"])
+    return context["question"], history_analysis, relevant_messages, context["recent_chat"], context["history_turns"]
+
+def build_reply_context(chat_id, batch):
+    """Prepara domanda, contesto della chat e messaggi pertinenti per un lotto di richieste.
+    
+    Restituisce (domanda, analisi della cronologia, messaggi pertinenti, ultimi messaggi della chat,
+    finestra della conversazione); gli ultimi messaggi sono valorizzati solo in modalità "fused"
+    quando manca il riassunto e la finestra è vuota.
+    """
+    context = gather_reply_context(chat_id, batch)
+    history_analysis = None
+    if context["history_to_analyze"]:
+        # Usa il metodo che chiaramente distingue messaggi per il bot
+        with tracing.span("analyze_message_history_with_focus"):
+            history_analysis = ai_service.analyze_message_history_with_focus(
+                context["history_to_analyze"], context["search_query"], context["bot_username"], chat_id=chat_id
+            )
+    return finish_reply_context(chat_id, context, history_analysis)
+
+def answer_requests(chat_id, batch):
+    """Risponde con una sola generazione a un lotto di richieste dirette al bot nella stessa chat"""
+    last_message = batch[-1]["message"]
+    # La traccia dell'ultima richiesta segue la risposta; quelle unite a essa si chiudono qui
+    trace = batch[-1].get("trace")
+    for request in batch[:-1]:
+        tracer.finish(request.get("trace"))
+    if trace:
+        trace.add_span("attesa", time.time() - batch[-1]["received_at"])
+    tracing.set_current(trace)
+    try:
+        question, history_analysis, relevant_messages, recent_chat, history_turns = build_reply_context(chat_id, batch)
+        
+        with tracing.span("generate_ai_response"):
             response = ai_service.generate_ai_response(
-                clean_message,
+                question,
                 chat_id, 
-                user_info, 
+                batch[-1]["user_info"], 
                 history_analysis,
                 is_directed=True,  # Parametro nuovo
-                is_cattivo=cattivo_mode.get(chat_id, False)
+                is_cattivo=cattivo_mode.get(chat_id, False),
+                relevant_messages=relevant_messages,
+                recent_chat=recent_chat,
+                history_turns=history_turns
             )
-            
-            # Usa la nuova funzione per inviare messaggi lunghi
-            send_long_message(chat_id, response, message.message_id)
-            
+        record_assistant_turn(chat_id, response)
+        
+        # Usa la nuova funzione per inviare messaggi lunghi
+        queued_at = time.perf_counter()
+        sent = send_long_message(chat_id, response, last_message.message_id)
+        REPLIES_SENT.inc()
+        if trace and sent:
+            # La traccia si chiude quando l'ultima parte è stata consegnata a Telegram
+            def finish_trace(future):
+                trace.add_span("invio", time.perf_counter() - queued_at)
+                tracer.finish(trace)
+            sent.add_done_callback(finish_trace)
+        else:
+            tracer.finish(trace)
     except Exception as e:
-        print(f"Errore durante l'elaborazione del messaggio: {e}")
+        log.exception("Errore durante la risposta alle richieste della chat %s: %s", chat_id, e)
+        tracer.finish(trace)
         try:
-            bot.reply_to(message, "Mi dispiace, c'è stato un problema interno.")
+            send_dispatcher.reply_to(last_message, "Mi dispiace, c'è stato un problema interno.")
         except:
             pass
+    finally:
+        tracing.set_current(None)
 
-if __name__ == '__main__':
-    print("Bot avviato con modello AI!")
-    print(f"Token del bot configurato: {'Sì' if BOT_TOKEN else 'No'}")
+def update_user_record(chat_id, from_user):
+    """Aggiorna il record dell'utente solo se nome o username sono cambiati; restituisce il record.
+    
+    Il record esistente (con il profilo del carattere) viene modificato sul posto e segnato da
+    salvare; per i messaggi di utenti già noti e invariati non si alloca nulla.
+    """
+    last_name = from_user.last_name or ""
+    username = from_user.username or ""
+    users = user_data.get(chat_id)
+    if users is None:
+        users = user_data[chat_id] = {}
+    record = users.get(from_user.id)
+    if record is None:
+        record = users[from_user.id] = {
+            'id': from_user.id, 'first_name': from_user.first_name, 'last_name': last_name, 'username': username
+        }
+        data_manager.mark_dirty("user_data")
+    elif (record.get('first_name') != from_user.first_name or record.get('last_name') != last_name
+          or record.get('username') != username):
+        record.update(first_name=from_user.first_name, last_name=last_name, username=username)
+        data_manager.mark_dirty("user_data")
+    return record
+
+def append_turn(chat_id, turn):
+    """Aggiunge un turno a conversation_history mantenendo solo gli ultimi CONVERSATION_HISTORY_LIMIT"""
+    with conversation_lock:
+        turns = conversation_history.setdefault(chat_id, [])
+        turns.append(turn)
+        if len(turns) > CONVERSATION_HISTORY_LIMIT:
+            conversation_history[chat_id] = turns[-CONVERSATION_HISTORY_LIMIT:]
+    data_manager.mark_dirty("conversations")
+
+def record_assistant_turn(chat_id, response):
+    """Registra la risposta del bot nella cronologia, così la finestra della conversazione la include"""
+    # I messaggi di errore non fanno parte della conversazione
+    if response and not response.startswith("Mi dispiace, c'è stato un problema"):
+        append_turn(chat_id, {"role": "assistant", "content": response})
+
+def prepare_request(message, bot_info):
+    """Registra il messaggio e aggiorna utenti e cronologia.
+    
+    Restituisce la richiesta da passare ad answer_requests se il messaggio è diretto al bot, altrimenti None.
+    """
+    # Log del messaggio ricevuto
+    with tracing.span("log_message"):
+        logger.log_message(message)
+    
+    # Una sola riga DEBUG: a livello INFO il costo è un controllo di livello
+    log.debug("Nuovo messaggio da %s (%s) in chat %s (%s), %d caratteri",
+              message.from_user.first_name, message.from_user.id,
+              message.chat.id, message.chat.type, len(message.text or ""))
+    
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    
+    bot_username = f"@{bot_info.username}"
+    text = message.text or ""
+    
+    # Prima si decide se il messaggio è per il bot: menzione con regex precompilata, nessuna chiamata di rete
+    mention = mention_pattern(bot_username)
+    is_directed_to_bot = bool(text) and (
+        message.chat.type == "private" or
+        mention.search(text) is not None or
+        (message.reply_to_message is not None and message.reply_to_message.from_user.id == bot_info.id)
+    )
+    
+    # INIZIO NUOVA FUNZIONALITÀ - Risposta ai nomi alternativi
+    # Le parole chiave e le risposte sono in data/triggers.json, compilate in un'unica regex
+    triggered = trigger_engine.match(text, chat_id) if text else []
+    if triggered:
+        # Evita di rispondere ai propri messaggi o a comandi
+        if not text.startswith('/') and not message.from_user.is_bot:
+            for rule in triggered:
+                send_dispatcher.reply_to(message, rule["reply"])
+            # Se è solo un trigger word senza richieste al bot, termina qui
+            if not is_directed_to_bot:
+                return None
+    # FINE NUOVA FUNZIONALITÀ
     
-    # Forza un salvataggio iniziale dei dati
-    data_manager.save_user_data(user_data)
-    data_manager.save_conversations(conversation_history)
+    user_info = update_user_record(chat_id, message.from_user)
     
+    if text:
+        # Una copia: il record in user_data cambia dopo (carattere, nomi) e la cronologia lo salva a parte
+        append_turn(chat_id, {"role": "user", "content": text, "user_info": dict(user_info), "message_id": message.message_id})
+    
+    # Continua solo se il messaggio è diretto al bot
+    if is_directed_to_bot:
+        # Rimuovi il nome del bot dal messaggio se presente
+        clean_message = mention.sub("", text).strip()
+        if not clean_message:
+            clean_message = text
+        
+        return {
+            "message": message,
+            "question": clean_message,
+            "user_id": user_id,
+            "user_name": message.from_user.first_name,
+            "user_info": user_info,
+            "bot_username": bot_username,
+            "received_at": time.time()
+        }
+    return None
+
+def handle_message(message):
+    trace = tracer.start("messaggio", message.chat.id)
+    tracing.set_current(trace)
+    try:
+        request = prepare_request(message, get_bot_info())
+        
+        # Le menzioni ravvicinate della stessa chat vengono unite in un'unica generazione
+        if request:
+            # La traccia prosegue con la risposta e viene chiusa da answer_requests
+            trace.name = "risposta"
+            request["trace"] = trace
+            if reply_coalescer:
+                reply_coalescer.submit(message.chat.id, request)
+            else:
+                reply_executor.submit(answer_requests, message.chat.id, [request])
+        else:
+            tracer.finish(trace)
+            
+    except Exception as e:
+        log.exception("Errore durante l'elaborazione del messaggio: %s", e)
+        tracer.finish(trace)
+        try:
+            send_dispatcher.reply_to(message, "Mi dispiace, c'è stato un problema interno.")
+        except:
+            pass
+    finally:
+        tracing.set_current(None)
+
+def register_handlers(bot):
+    """Registra gli handler dei comandi e dei messaggi (il gestore generico per ultimo)"""
+    bot.message_handler(commands=['start', 'help'])(send_welcome)
+    bot.message_handler(commands=['reset'])(reset_conversation)
+    bot.message_handler(commands=['carattere'])(view_character)
+    bot.message_handler(commands=['utenti'])(list_users)
+    bot.message_handler(commands=['logs'])(view_logs)
+    bot.message_handler(commands=['stats'])(view_stats)
+    bot.message_handler(commands=['usage'])(view_usage)
+    bot.message_handler(commands=['stats_chat'])(view_chat_stats)
+    bot.message_handler(commands=['cattivo'])(toggle_cattivo_mode)
+    bot.message_handler(commands=['ripara_contesto'])(repair_context)
+    bot.message_handler(commands=['reload_files'])(reload_files)
+    bot.message_handler(func=lambda message: True)(handle_message)
+
+
+def main():
+    """Avvia il bot: risponde subito, mentre lo storico viene caricato in background"""
+    if SHARD_COUNT > 1:
+        # Questo processo riceve soltanto gli aggiornamenti: le chat sono servite dai processi shard
+        import sharding
+        return sharding.main()
+    setup_logging()
+    create_app()
+    log.info("Bot avviato con modello AI!")
+    log.info("Token del bot configurato: %s", 'Sì' if BOT_TOKEN else 'No')
+    try:
+        log.info("Identità del bot: @%s", get_bot_info().username)
+    except Exception as e:
+        # Si riprova al primo messaggio
+        log.warning("Impossibile leggere l'identità del bot: %s", e)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT, METRICS_HOST)
+    start_background_threads()
+
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("BOT_MODE=webhook richiede WEBHOOK_URL")
+        webhook_server = WebhookServer(bot, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, ready=warmup_ready)
+        webhook_server.serve_forever(register=WEBHOOK_REGISTER)
+        log.info("Salvataggio dati in corso...")
+        data_manager.save_user_data(user_data)
+        data_manager.save_conversations(conversation_history)
+        chat_stats.save()
+        return
+
+    # Con un webhook ancora registrato getUpdates fallirebbe con errore 409
+    try:
+        bot.remove_webhook()
+    except Exception as e:
+        log.warning("Impossibile rimuovere il webhook: %s", e)
+
     # Variabili per backoff esponenziale
     retry_count = 0
     max_retries = 10
@@ -560,31 +1346,35 @@ if __name__ == '__main__':
     while True:
         try:
             retry_count = 0
-            print("Avvio del polling...")
+            log.info("Avvio del polling...")
             # Configurazione più robusta del polling (rimosso il parametro allowed_updates)
             bot.infinity_polling(timeout=30, long_polling_timeout=30)
         except telebot.apihelper.ApiTelegramException as telegram_ex:
             if "Unauthorized" in str(telegram_ex):
-                print(f"ERRORE CRITICO: Token non valido o bot disabilitato: {telegram_ex}")
+                log.critical("ERRORE CRITICO: Token non valido o bot disabilitato: %s", telegram_ex)
                 break  # Esci dal ciclo se il token non è valido
-            print(f"Errore API Telegram: {telegram_ex}")
+            log.error("Errore API Telegram: %s", telegram_ex)
         except requests.exceptions.RequestException as conn_ex:
-            print(f"Errore di connessione: {conn_ex}")
+            log.error("Errore di connessione: %s", conn_ex)
         except Exception as e:
-            print(f"Errore nel polling: {e}")
+            log.exception("Errore nel polling: %s", e)
             
         # Salvataggio dei dati prima del riavvio
-        print("Salvataggio dati in corso...")
+        log.info("Salvataggio dati in corso...")
         data_manager.save_user_data(user_data)
         data_manager.save_conversations(conversation_history)
+        chat_stats.save()
         
         # Backoff esponenziale per i tentativi
         retry_count += 1
         if retry_count > max_retries:
-            print(f"Troppi tentativi falliti (#{retry_count}). Attendi 2 minuti prima di riprovare.")
+            log.warning("Troppi tentativi falliti (#%d). Attendi 2 minuti prima di riprovare.", retry_count)
             time.sleep(120)
             retry_count = 0
         else:
             wait_time = min(base_wait_time * (2 ** (retry_count - 1)), 60)
-            print(f"Tentativo #{retry_count}: riavvio del polling tra {wait_time} secondi...")
-            time.sleep(wait_time)
\ No newline at end of file
+            log.warning("Tentativo #%d: riavvio del polling tra %d secondi...", retry_count, wait_time)
+            time.sleep(wait_time)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""Statistiche di attività per chat, aggiornate a ogni messaggio registrato.
+
+``ChatStats.record`` è un listener di MessageLogger: per ogni chat tiene il totale dei messaggi,
+i messaggi per utente (con primo e ultimo messaggio), gli istogrammi per ora del giorno e giorno
+della settimana, i messaggi degli ultimi ``days`` giorni in un array circolare e l'uso dei comandi.
+Le domande sull'attività (chi scrive di più, quanti messaggi al giorno, ultimo messaggio) si
+risolvono da questi contatori, senza rileggere i log; i log servono una sola volta, per costruire
+le statistiche quando il file non esiste ancora (``backfill``).
+"""
+import os
+import json
+import logging
+import threading
+from datetime import datetime, date
+
+log = logging.getLogger(__name__)
+
+
+def _command_name(text):
+    """Nome del comando di un messaggio ("/stats@bot argomenti" -> "/stats"), None se non è un comando"""
+    if not text.startswith("/"):
+        return None
+    return text.split()[0].split("@")[0].lower()
+
+
+class ChatStats:
+    """Contatori di attività per chat, salvati in un file JSON compatto"""
+
+    def __init__(self, path="data/chat_stats.json", days=30):
+        self.path = path
+        self.days = days
+        self.lock = threading.Lock()
+        self.chats = {}  # chat_id -> contatori (vedi _new_chat)
+        self.dirty = False
+        # Senza file le statistiche partono da qui: i messaggi precedenti arrivano da backfill()
+        self.started_at = datetime.now().isoformat()
+        self.loaded = self.load()
+
+    def _new_chat(self):
+        return {
+            "messages": 0,
+            "first": None,  # timestamp ISO del primo e dell'ultimo messaggio
+            "last": None,
+            "first_text_id": None,  # message_id del primo messaggio di testo che non è un comando
+            "hours": [0] * 24,  # messaggi per ora del giorno
+            "weekdays": [0] * 7,  # messaggi per giorno della settimana, lunedì = 0
+            "daily": [0] * self.days,  # messaggi per giorno, indice = ordinale del giorno % days
+            "daily_last": 0,  # ordinale dell'ultimo giorno presente in "daily"
+            "users": {},  # user_id -> [messaggi, primo, ultimo, nome]
+            "commands": {},  # comando -> utilizzi
+        }
+
+    def load(self):
+        """Carica le statistiche salvate; False se il file non esiste"""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            log.error("Errore durante il caricamento delle statistiche delle chat: %s", e)
+            return False
+        if data.get("days") != self.days:
+            # Cambiata la finestra giornaliera: i totali restano, i giorni ripartono da zero
+            for stats in data["chats"].values():
+                stats["daily"] = [0] * self.days
+        for stats in data["chats"].values():
+            # File precedente a first_text_id: il primo messaggio non è noto, 0 vale "prima di ogni id"
+            stats.setdefault("first_text_id", 0)
+        # Le chiavi JSON sono stringhe: a runtime gli id sono interi
+        self.chats = {
+            int(chat_id): dict(stats, users={int(user_id): value for user_id, value in stats["users"].items()})
+            for chat_id, stats in data["chats"].items()
+        }
+        return True
+
+    def save(self):
+        """Scrive il file delle statistiche (su un file temporaneo, poi rinominato)"""
+        with self.lock:
+            self.dirty = False
+            payload = json.dumps({"days": self.days, "chats": self.chats}, ensure_ascii=False, separators=(",", ":"))
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp_path, self.path)
+            return True
+        except Exception as e:
+            log.error("Errore durante il salvataggio delle statistiche delle chat: %s", e)
+            return False
+
+    def save_if_dirty(self):
+        if self.dirty:
+            self.save()
+
+    def record(self, log_entry):
+        """Conta un messaggio registrato (listener di MessageLogger)"""
+        chat_id = log_entry.get("chat_id")
+        if chat_id is None:
+            return
+        try:
+            moment = datetime.fromisoformat(log_entry["timestamp"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            self._add(chat_id, log_entry, moment)
+            self.dirty = True
+
+    def _add(self, chat_id, log_entry, moment):
+        # Indipendente dall'ordine dei messaggi: il backfill può arrivare dopo i messaggi nuovi
+        stats = self.chats.get(chat_id)
+        if stats is None:
+            stats = self.chats[chat_id] = self._new_chat()
+        timestamp = moment.isoformat(timespec="seconds")
+        stats["messages"] += 1
+        if stats["first"] is None or timestamp < stats["first"]:
+            stats["first"] = timestamp
+        if stats["last"] is None or timestamp > stats["last"]:
+            stats["last"] = timestamp
+        text = log_entry.get("text") or ""
+        message_id = log_entry.get("message_id")
+        if text and not text.startswith("/") and message_id is not None:
+            # Gli id dei messaggi crescono all'interno di una chat
+            if stats.get("first_text_id") is None or message_id < stats["first_text_id"]:
+                stats["first_text_id"] = message_id
+        stats["hours"][moment.hour] += 1
+        stats["weekdays"][moment.weekday()] += 1
+
+        day = moment.toordinal()
+        daily = stats["daily"]
+        if day > stats["daily_last"]:
+            # Si azzerano i giorni saltati (al più una volta tutto l'array)
+            for skipped in range(max(stats["daily_last"] + 1, day - self.days + 1), day + 1):
+                daily[skipped % self.days] = 0
+            stats["daily_last"] = day
+        if day > stats["daily_last"] - self.days:
+            daily[day % self.days] += 1
+
+        user_id = log_entry.get("user_id")
+        if user_id is not None:
+            user = stats["users"].get(user_id)
+            if user is None:
+                user = stats["users"][user_id] = [0, timestamp, timestamp, ""]
+            user[0] += 1
+            user[1] = min(user[1], timestamp)
+            if timestamp >= user[2]:
+                user[2] = timestamp
+                user[3] = log_entry.get("user_first_name") or user[3]
+
+        command = _command_name(text)
+        if command:
+            stats["commands"][command] = stats["commands"].get(command, 0) + 1
+
+    def backfill(self, entries):
+        """Costruisce le statistiche dai log esistenti, solo se il file non c'era.
+
+        ``entries`` sono le voci di log; quelle registrate dopo l'avvio sono già state contate
+        da ``record`` e vengono saltate. Restituisce il numero di messaggi aggiunti.
+        """
+        if self.loaded:
+            return 0
+        added = 0
+        for log_entry in entries:
+            timestamp = log_entry.get("timestamp")
+            if log_entry.get("chat_id") is None or not timestamp or timestamp >= self.started_at:
+                continue
+            try:
+                moment = datetime.fromisoformat(timestamp)
+            except ValueError:
+                continue
+            with self.lock:
+                self._add(log_entry["chat_id"], log_entry, moment)
+            added += 1
+        with self.lock:
+            self.loaded = True
+            self.dirty = True
+        return added
+
+    def _days_total(self, stats, days, today):
+        """Messaggi degli ultimi ``days`` giorni, oggi compreso"""
+        days = min(days, self.days)
+        return sum(
+            stats["daily"][day % self.days]
+            for day in range(today - days + 1, today + 1)
+            if stats["daily_last"] - self.days < day <= stats["daily_last"]
+        )
+
+    def recent_messages(self, chat_id, days=1):
+        """Messaggi della chat negli ultimi ``days`` giorni (al più la finestra ``days`` del costruttore)"""
+        with self.lock:
+            stats = self.chats.get(chat_id)
+            if stats is None:
+                return 0
+            return self._days_total(stats, days, date.today().toordinal())
+
+    def active_chats(self, days=1, min_messages=1):
+        """Chat con almeno ``min_messages`` messaggi negli ultimi ``days`` giorni, le più attive per prime.
+
+        Pensata per gli scheduler in background: restituisce una lista di (chat_id, messaggi).
+        """
+        today = date.today().toordinal()
+        with self.lock:
+            counts = [(chat_id, self._days_total(stats, days, today)) for chat_id, stats in self.chats.items()]
+        return sorted([item for item in counts if item[1] >= min_messages], key=lambda item: item[1], reverse=True)
+
+    def messages_per_day(self, chat_id, days=7):
+        """Messaggi per giorno, dal più vecchio a oggi, come lista di (data, messaggi)"""
+        today = date.today().toordinal()
+        days = min(days, self.days)
+        with self.lock:
+            stats = self.chats.get(chat_id)
+            if stats is None:
+                return []
+            return [(date.fromordinal(day), self._days_total(stats, 1, day)) for day in range(today - days + 1, today + 1)]
+
+    def first_text_message_id(self, chat_id):
+        """message_id del primo messaggio di testo registrato nella chat (None se sconosciuto)"""
+        with self.lock:
+            stats = self.chats.get(chat_id)
+            return stats.get("first_text_id") if stats else None
+
+    def top_users(self, chat_id, count=5):
+        """Utenti che scrivono di più: lista di (user_id, nome, messaggi, primo, ultimo)"""
+        with self.lock:
+            stats = self.chats.get(chat_id)
+            if stats is None:
+                return []
+            users = [(user_id, name, messages, first, last) for user_id, (messages, first, last, name) in stats["users"].items()]
+        return sorted(users, key=lambda user: user[2], reverse=True)[:count]
+
+    def chat_summary(self, chat_id):
+        """Copia dei contatori di una chat (senza l'array giornaliero), None se la chat non ha messaggi"""
+        with self.lock:
+            stats = self.chats.get(chat_id)
+            if stats is None:
+                return None
+            return {
+                "messages": stats["messages"],
+                "first": stats["first"],
+                "last": stats["last"],
+                "users": len(stats["users"]),
+                "hours": list(stats["hours"]),
+                "weekdays": list(stats["weekdays"]),
+                "commands": dict(stats["commands"]),
+            }
@@ -0,0 +1,123 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+
+import telebot
+
+from metrics import UPDATES_RECEIVED
+
+log = logging.getLogger(__name__)
+
+class ChatWorkerPool:
+    """Pool di worker con esecuzione seriale per chat.
+
+    Ogni chat viene assegnata a un worker fisso (hash del chat_id), quindi i suoi messaggi sono
+    elaborati uno alla volta e in ordine di arrivo. All'interno di un worker le chat si alternano
+    a turno, e la coda di ogni chat è limitata: una chat rumorosa non può affamare le altre.
+    Con la coda piena, ``overflow="block"`` fa attendere chi accoda (la ricezione degli aggiornamenti)
+    finché il worker non si libera; "drop_oldest" e "drop_newest" scartano un messaggio.
+    """
+
+    def __init__(self, num_workers=8, max_chat_queue=50, overflow="block"):
+        """Inizializza il pool; overflow è "block", "drop_oldest" o "drop_newest" """
+        self.num_workers = num_workers
+        self.max_chat_queue = max_chat_queue
+        self.overflow = overflow
+        self.dropped_count = 0
+        self.workers = []
+        for i in range(num_workers):
+            worker = {"condition": threading.Condition(), "chats": OrderedDict()}
+            self.workers.append(worker)
+            threading.Thread(target=self._run, args=(worker,), name=f"ChatWorker-{i}", daemon=True).start()
+
+    def _worker_for(self, chat_id):
+        return self.workers[hash(chat_id) % self.num_workers]
+
+    def submit(self, chat_id, task, *args, **kwargs):
+        """Accoda un compito per la chat; restituisce False se è stato scartato per coda piena"""
+        worker = self._worker_for(chat_id)
+        with worker["condition"]:
+            if self.overflow == "block":
+                # Gli aggiornamenti sono già confermati a Telegram: si rallenta la ricezione invece di perderli
+                while len(worker["chats"].get(chat_id, ())) >= self.max_chat_queue:
+                    worker["condition"].wait()
+            chat_queue = worker["chats"].setdefault(chat_id, deque())
+            if len(chat_queue) >= self.max_chat_queue:
+                self.dropped_count += 1
+                if self.overflow == "drop_newest":
+                    log.warning("Coda piena per chat %s: scartato il messaggio appena arrivato (%s)",
+                                chat_id, _describe(args))
+                    return False
+                _, dropped_args, _ = chat_queue.popleft()
+                log.warning("Coda piena per chat %s: scartato il messaggio più vecchio (%s)",
+                            chat_id, _describe(dropped_args))
+            chat_queue.append((task, args, kwargs))
+            # Sveglia il worker e chi attende spazio nella coda
+            worker["condition"].notify_all()
+        return True
+
+    def queue_depth(self, chat_id=None):
+        """Compiti in attesa, per una chat o in totale"""
+        if chat_id is not None:
+            worker = self._worker_for(chat_id)
+            with worker["condition"]:
+                return len(worker["chats"].get(chat_id, ()))
+        total = 0
+        for worker in self.workers:
+            with worker["condition"]:
+                total += sum(len(chat_queue) for chat_queue in worker["chats"].values())
+        return total
+
+    def _run(self, worker):
+        chats = worker["chats"]
+        while True:
+            with worker["condition"]:
+                while not chats:
+                    worker["condition"].wait()
+                # Turno a rotazione: la prima chat esegue un compito e, se ne ha altri, va in fondo
+                chat_id, chat_queue = next(iter(chats.items()))
+                task, args, kwargs = chat_queue.popleft()
+                if chat_queue:
+                    chats.move_to_end(chat_id)
+                else:
+                    del chats[chat_id]
+                if self.overflow == "block":
+                    worker["condition"].notify_all()
+            try:
+                task(*args, **kwargs)
+            except Exception as e:
+                log.exception("Errore nell'esecuzione di un compito della chat %s: %s", chat_id, e)
+
+
+def _describe(args):
+    """Descrizione di un messaggio scartato per il log: id del messaggio e mittente"""
+    message = args[0] if args else None
+    sender = getattr(message, "from_user", None)
+    return f"messaggio {getattr(message, 'message_id', '?')} da {getattr(sender, 'id', '?')}"
+
+
+class ChatOrderedTeleBot(telebot.TeleBot):
+    """TeleBot che esegue gli handler sul ChatWorkerPool invece che sul pool di thread di telebot.
+
+    telebot non ha un punto di estensione pubblico per scegliere dove eseguire gli handler: si
+    ridefinisce ``_exec_task``, privato, per questo pyTelegramBotAPI è fissato in requirements.txt.
+    """
+
+    def __init__(self, token, worker_pool, deduplicator=None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.chat_worker_pool = worker_pool
+        self.deduplicator = deduplicator
+
+    def process_new_updates(self, updates):
+        # Polling, webhook e shard passano tutti da qui: i duplicati non arrivano né al log né al modello
+        if self.deduplicator is not None:
+            updates = self.deduplicator.filter(updates)
+            if not updates:
+                return
+        super().process_new_updates(updates)
+
+    def _exec_task(self, task, *args, **kwargs):
+        chat = getattr(args[0], "chat", None) if args else None
+        chat_id = chat.id if chat is not None else None
+        UPDATES_RECEIVED.inc(chat.type if chat is not None else "none")
+        self.chat_worker_pool.submit(chat_id, task, *args, **kwargs)
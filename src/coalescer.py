@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+class RequestCoalescer:
+    """Raggruppa per chat le richieste al bot arrivate a breve distanza in un'unica generazione.
+
+    La prima richiesta di una chat attende ``window`` secondi, poi tutte le richieste accumulate
+    passano a ``process_batch(chat_id, batch)`` su ``executor``: il numero dei suoi thread limita
+    le generazioni contemporanee di tutte le chat. Le richieste che arrivano mentre la risposta è
+    in generazione (o in attesa di un thread libero) vengono raccolte nel lotto successivo.
+    """
+
+    def __init__(self, process_batch, window=1.5, max_age=60.0, executor=None):
+        """Inizializza il raggruppatore con la funzione che risponde a un lotto di richieste"""
+        self.process_batch = process_batch
+        self.window = window
+        self.max_age = max_age
+        self.executor = executor or ThreadPoolExecutor(max_workers=2, thread_name_prefix="ReplyGen")
+        self.lock = threading.Lock()
+        self.pending = {}  # chat_id -> richieste in attesa
+        self.busy = set()  # chat con un thread di risposta attivo
+
+    def submit(self, chat_id, request):
+        """Accoda una richiesta (dict con almeno 'user_id' e 'received_at') senza bloccare il chiamante"""
+        with self.lock:
+            self.pending.setdefault(chat_id, []).append(request)
+            if chat_id in self.busy:
+                return
+            self.busy.add(chat_id)
+        # Durante la finestra di attesa non si occupa un thread dell'executor
+        timer = threading.Timer(self.window, self.executor.submit, (self._run, chat_id))
+        timer.daemon = True
+        timer.start()
+
+    def pending_count(self, chat_id=None):
+        """Numero di richieste in attesa, per una chat o in totale"""
+        with self.lock:
+            if chat_id is not None:
+                return len(self.pending.get(chat_id, []))
+            return sum(len(batch) for batch in self.pending.values())
+
+    def _run(self, chat_id):
+        """Risponde a un lotto di una chat; se nel frattempo ne è arrivato un altro lo rimette in coda"""
+        with self.lock:
+            batch = self.pending.pop(chat_id, [])
+            if not batch:
+                self.busy.discard(chat_id)
+                return
+        batch = self._drop_stale(batch)
+        try:
+            self.process_batch(chat_id, batch)
+        except Exception as e:
+            log.exception("Errore nella risposta al lotto di richieste della chat %s: %s", chat_id, e)
+        with self.lock:
+            if not self.pending.get(chat_id):
+                self.busy.discard(chat_id)
+                return
+        # In fondo alla coda dell'executor: una chat molto attiva non trattiene un thread per sé
+        self.executor.submit(self._run, chat_id)
+
+    def _drop_stale(self, batch):
+        """Scarta le richieste troppo vecchie superate da una più recente dello stesso utente"""
+        now = time.time()
+        newest = {}
+        for request in batch:
+            user_id = request["user_id"]
+            if user_id not in newest or request["received_at"] > newest[user_id]:
+                newest[user_id] = request["received_at"]
+        kept = [
+            request for request in batch
+            if request["received_at"] == newest[request["user_id"]] or now - request["received_at"] <= self.max_age
+        ]
+        if len(kept) < len(batch):
+            log.info("Scartate %d richieste superate da messaggi più recenti", len(batch) - len(kept))
+        return kept
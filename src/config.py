@@ -9,4 +9,102 @@ DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 HF_API_KEY = os.getenv("HF_API_KEY")
 
 # Converti stringa booleana in valore booleano
-SKIP_INITIAL_CHARACTER_ANALYSIS = os.getenv("SKIP_INITIAL_CHARACTER_ANALYSIS", "false").lower() == "true"
\ No newline at end of file
+SKIP_INITIAL_CHARACTER_ANALYSIS = os.getenv("SKIP_INITIAL_CHARACTER_ANALYSIS", "false").lower() == "true"
+
+# Logging: livello, frazione di chiamate con dettaglio DEBUG, lunghezza anteprime
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.1"))
+LOG_PAYLOAD_PREVIEW_CHARS = int(os.getenv("LOG_PAYLOAD_PREVIEW_CHARS", "200"))
+
+# Indice semantico della cronologia (richiede numpy e un modello di embedding su Ollama)
+ENABLE_EMBEDDING_INDEX = os.getenv("ENABLE_EMBEDDING_INDEX", "false").lower() == "true"
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+OLLAMA_EMBED_URL = os.getenv("OLLAMA_EMBED_URL", "http://localhost:11434/api/embed")
+EMBEDDING_TOP_K = int(os.getenv("EMBEDDING_TOP_K", "8"))
+# Secondi massimi per una chiamata di embedding: quella della domanda è sul percorso della risposta
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "30"))
+
+# Indice lessicale BM25 e sorgente del contesto quando manca il riassunto della chat:
+# "llm" usa analyze_message_history_with_focus (con BM25 come ripiego), "bm25" non chiama il modello,
+# "fused" mette gli ultimi messaggi nel prompt della risposta e prepara il riassunto in background
+ENABLE_BM25_INDEX = os.getenv("ENABLE_BM25_INDEX", "true").lower() == "true"
+CONTEXT_PROVIDER = os.getenv("CONTEXT_PROVIDER", "llm").lower()
+BM25_TOP_N = int(os.getenv("BM25_TOP_N", "8"))
+
+# Modalità "fused": quanti messaggi recenti entrano nel prompt e quanti caratteri al massimo per messaggio
+FUSED_RECENT_MESSAGES = int(os.getenv("FUSED_RECENT_MESSAGES", "30"))
+FUSED_MESSAGE_CHARS = int(os.getenv("FUSED_MESSAGE_CHARS", "200"))
+
+# Quanto a lungo Ollama tiene il modello (e la sua cache KV) in memoria tra le richieste, es. "30m"
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE") or None
+
+# Raggruppamento delle menzioni: finestra di attesa (s) ed età oltre la quale una richiesta
+# superata da un messaggio più recente dello stesso utente viene scartata (s)
+ENABLE_COALESCING = os.getenv("ENABLE_COALESCING", "true").lower() == "true"
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.5"))
+STALE_REQUEST_AGE = float(os.getenv("STALE_REQUEST_AGE", "60"))
+# Generazioni di risposte contemporanee (con o senza raggruppamento), fuori dai worker degli handler
+REPLY_CONCURRENCY = int(os.getenv("REPLY_CONCURRENCY", "2"))
+
+# Limiti della coda di invio verso Telegram: messaggi/s globali, messaggi/s per chat, messaggi/min per gruppo
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_PER_MINUTE = float(os.getenv("SEND_GROUP_PER_MINUTE", "20"))
+
+# Pool di worker per gli handler: numero di worker, messaggi in coda per chat, politica in caso
+# di coda piena ("block" rallenta la ricezione finché c'è spazio, "drop_oldest" scarta il più
+# vecchio, "drop_newest" scarta quello appena arrivato)
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "8"))
+MAX_CHAT_QUEUE = int(os.getenv("MAX_CHAT_QUEUE", "50"))
+QUEUE_OVERFLOW = os.getenv("QUEUE_OVERFLOW", "block")
+
+# Modalità di ricezione degli aggiornamenti: "polling" (predefinita) o "webhook".
+# WEBHOOK_URL è l'indirizzo pubblico registrato su Telegram (il suo percorso è quello servito localmente)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "true").lower() == "true"
+
+# Aggiornamento del contesto delle chat guidato dall'attività: si rigenera dopo N messaggi nuovi,
+# oppure dopo T minuti dall'ultimo aggiornamento se c'è almeno un messaggio nuovo, con un tetto orario globale (0 = nessuno)
+CONTEXT_REFRESH_MESSAGES = int(os.getenv("CONTEXT_REFRESH_MESSAGES", "50"))
+CONTEXT_REFRESH_MINUTES = float(os.getenv("CONTEXT_REFRESH_MINUTES", "30"))
+CONTEXT_REFRESH_MAX_PER_HOUR = int(os.getenv("CONTEXT_REFRESH_MAX_PER_HOUR", "20"))
+
+# Analisi incrementale del carattere: messaggi nuovi necessari per rianalizzare un utente e
+# numero massimo di messaggi inviati al modello per ogni analisi
+CHARACTER_MIN_NEW_MESSAGES = int(os.getenv("CHARACTER_MIN_NEW_MESSAGES", "5"))
+CHARACTER_SAMPLE_SIZE = int(os.getenv("CHARACTER_SAMPLE_SIZE", "40"))
+
+# Endpoint delle metriche in formato Prometheus (http://METRICS_HOST:METRICS_PORT/metrics); 0 lo disattiva
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Registro append-only dell'uso del modello (token e tempo GPU per chiamata), vedi usage_ledger.py
+ENABLE_USAGE_LEDGER = os.getenv("ENABLE_USAGE_LEDGER", "true").lower() == "true"
+USAGE_LEDGER_PATH = os.getenv("USAGE_LEDGER_PATH", "data/usage_ledger.jsonl")
+
+# Memoria a breve termine delle risposte: budget di token (stimati) per gli ultimi turni di
+# conversation_history inviati al modello; 0 la disattiva e lascia solo il riassunto della chat
+CONVERSATION_WINDOW_TOKENS = int(os.getenv("CONVERSATION_WINDOW_TOKENS", "1500"))
+
+# Sharding: con SHARD_COUNT > 1 un processo riceve gli aggiornamenti e li smista per chat a
+# SHARD_COUNT processi bot, ciascuno con i propri dati in data/shard-N e log in logs/shard-N
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))
+
+# Passaggi in background (analisi del carattere, aggiornamento dei contesti): chat elaborate in
+# parallelo e secondi dopo i quali una chat non viene più attesa (anche timeout HTTP verso Ollama)
+BACKGROUND_CONCURRENCY = int(os.getenv("BACKGROUND_CONCURRENCY", "2"))
+BACKGROUND_CHAT_TIMEOUT = float(os.getenv("BACKGROUND_CHAT_TIMEOUT", "300"))
+
+# Statistiche di attività per chat (/stats_chat): giorni di cronologia nei contatori giornalieri
+CHAT_STATS_DAYS = int(os.getenv("CHAT_STATS_DAYS", "30"))
+
+# Filtro degli aggiornamenti riconsegnati da Telegram dopo un riavvio: ore per cui una chiave
+# (chat e id del messaggio, o update_id) resta in memoria e numero massimo di chiavi
+ENABLE_DEDUP = os.getenv("ENABLE_DEDUP", "true").lower() == "true"
+DEDUP_TTL_HOURS = float(os.getenv("DEDUP_TTL_HOURS", "24"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
@@ -0,0 +1,52 @@
+"""Finestra scorrevole della conversazione: gli ultimi turni di conversation_history entro un budget di token."""
+
+# Stima grossolana senza tokenizer: circa 4 caratteri per token, più qualche token per turno
+CHARS_PER_TOKEN = 4
+TOKENS_PER_TURN = 4
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + TOKENS_PER_TURN
+
+
+def turn_text(turn):
+    """Testo di un turno come lo vede il modello: nei turni utente il nome di chi scrive"""
+    if turn.get("role") == "assistant":
+        return turn.get("content", "")
+    name = (turn.get("user_info") or {}).get("first_name") or "Utente"
+    return f"{name}: {turn.get('content', '')}"
+
+
+def select_window(history, max_tokens, exclude_ids=()):
+    """Sceglie i turni più recenti che stanno in ``max_tokens``.
+
+    ``exclude_ids`` sono i message_id dei messaggi a cui si sta rispondendo, già presenti nella domanda.
+    Restituisce (messaggi per /api/chat dal più vecchio, turni rimasti fuori dalla finestra);
+    turni utente consecutivi vengono uniti in un solo messaggio.
+    """
+    turns = [
+        turn for turn in history
+        if turn.get("content") and not (turn.get("role") == "user" and turn.get("message_id") in exclude_ids)
+    ]
+    selected = []
+    used = 0
+    for turn in reversed(turns):
+        text = turn_text(turn)
+        cost = estimate_tokens(text)
+        if used + cost > max_tokens:
+            break
+        selected.append((turn.get("role", "user"), text))
+        used += cost
+    omitted = len(turns) - len(selected)
+
+    messages = []
+    for role, text in reversed(selected):
+        if messages and messages[-1]["role"] == role == "user":
+            messages[-1]["content"] += "\n" + text
+        else:
+            messages.append({"role": role, "content": text})
+    # La conversazione inviata non può iniziare con una risposta del bot senza la domanda
+    while messages and messages[0]["role"] == "assistant":
+        messages.pop(0)
+        omitted += 1
+    return messages, omitted
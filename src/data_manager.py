@@ -1,20 +1,37 @@
 import os
 import json
+import logging
 import time
 
+from metrics import SAVE_SECONDS, SAVE_BYTES
+
+log = logging.getLogger(__name__)
+
 class DataManager:
     def __init__(self, data_dir="data"):
         """Inizializza il gestore dei dati"""
         self.data_dir = data_dir
         self.user_data_file = os.path.join(data_dir, "user_data.json")
         self.conversation_file = os.path.join(data_dir, "conversations.json")
+        # File con modifiche non ancora salvate ("user_data", "conversations"): auto_save salva solo questi
+        self.dirty = set()
+        # Altri salvataggi eseguiti insieme al salvataggio automatico (es. ChatStats.save_if_dirty)
+        self.save_hooks = []
         self.ensure_data_directory()
+    
+    def mark_dirty(self, name):
+        """Segna come modificati i dati di un file, da salvare al prossimo salvataggio automatico"""
+        self.dirty.add(name)
+    
+    def add_save_hook(self, callback):
+        """Registra una funzione chiamata a ogni salvataggio automatico"""
+        self.save_hooks.append(callback)
         
     def ensure_data_directory(self):
         """Assicura che la directory dei dati esista"""
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
-            print(f"Creata directory dei dati: {self.data_dir}")
+            log.info("Creata directory dei dati: %s", self.data_dir)
     
     def load_user_data(self):
         """Carica i dati degli utenti dal file"""
@@ -24,17 +41,21 @@ class DataManager:
                     return json.load(f)
             return {}
         except Exception as e:
-            print(f"Errore durante il caricamento dei dati utenti: {e}")
+            log.error("Errore durante il caricamento dei dati utenti: %s", e)
             return {}
     
     def save_user_data(self, user_data):
         """Salva i dati degli utenti nel file"""
+        # Tolto prima di scrivere: una modifica durante il salvataggio lo rimette
+        self.dirty.discard("user_data")
         try:
-            with open(self.user_data_file, "w", encoding="utf-8") as f:
-                json.dump(user_data, f, ensure_ascii=False, indent=2)
+            with SAVE_SECONDS.time("user_data"):
+                with open(self.user_data_file, "w", encoding="utf-8") as f:
+                    json.dump(user_data, f, ensure_ascii=False, indent=2)
+            SAVE_BYTES.set(os.path.getsize(self.user_data_file), "user_data")
             return True
         except Exception as e:
-            print(f"Errore durante il salvataggio dei dati utenti: {e}")
+            log.error("Errore durante il salvataggio dei dati utenti: %s", e)
             return False
     
     def load_conversations(self):
@@ -45,17 +66,20 @@ class DataManager:
                     return json.load(f)
             return {}
         except Exception as e:
-            print(f"Errore durante il caricamento delle conversazioni: {e}")
+            log.error("Errore durante il caricamento delle conversazioni: %s", e)
             return {}
     
     def save_conversations(self, conversations):
         """Salva la cronologia delle conversazioni nel file"""
+        self.dirty.discard("conversations")
         try:
-            with open(self.conversation_file, "w", encoding="utf-8") as f:
-                json.dump(conversations, f, ensure_ascii=False, indent=2)
+            with SAVE_SECONDS.time("conversations"):
+                with open(self.conversation_file, "w", encoding="utf-8") as f:
+                    json.dump(conversations, f, ensure_ascii=False, indent=2)
+            SAVE_BYTES.set(os.path.getsize(self.conversation_file), "conversations")
             return True
         except Exception as e:
-            print(f"Errore durante il salvataggio delle conversazioni: {e}")
+            log.error("Errore durante il salvataggio delle conversazioni: %s", e)
             return False
     
     def auto_save(self, user_data, conversations, interval=600):
@@ -64,8 +88,17 @@ class DataManager:
         while True:
             current_time = time.time()
             if current_time - last_save >= interval:
-                print("Salvataggio automatico dei dati...")
-                self.save_user_data(user_data)
-                self.save_conversations(conversations)
+                # Senza modifiche dall'ultimo salvataggio non si riscrive nulla
+                if self.dirty:
+                    log.info("Salvataggio automatico dei dati (%s)...", ", ".join(sorted(self.dirty)))
+                if "user_data" in self.dirty:
+                    self.save_user_data(user_data)
+                if "conversations" in self.dirty:
+                    self.save_conversations(conversations)
+                for callback in self.save_hooks:
+                    try:
+                        callback()
+                    except Exception as e:
+                        log.error("Errore in un salvataggio automatico aggiuntivo: %s", e)
                 last_save = current_time
             time.sleep(60)  # Controlla ogni minuto
\ No newline at end of file
@@ -0,0 +1,114 @@
+"""Filtro degli aggiornamenti di Telegram già elaborati.
+
+Dopo un riavvio del polling o un nuovo tentativo del webhook Telegram può consegnare di nuovo
+aggiornamenti già visti: senza filtro ognuno verrebbe registrato di nuovo nei log e una menzione
+produrrebbe un'altra generazione e un'altra risposta. ``UpdateDeduplicator`` ricorda le chiavi
+viste nelle ultime ``ttl`` ore (al più ``max_entries``) e le annota in un file JSONL, così il
+filtro sopravvive ai riavvii del processo.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import DUPLICATE_UPDATES
+
+log = logging.getLogger(__name__)
+
+
+def update_key(update):
+    """Chiave di un aggiornamento (oggetto telebot): chat e id del messaggio, altrimenti update_id"""
+    message = getattr(update, "message", None)
+    if message is not None:
+        return f"{message.chat.id}:{message.message_id}"
+    return f"u{update.update_id}"
+
+
+class UpdateDeduplicator:
+    """Insieme limitato e a scadenza delle chiavi già viste, annotate su file"""
+
+    def __init__(self, path="data/seen_updates.jsonl", ttl=86400.0, max_entries=100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.seen = OrderedDict()  # chiave -> istante (epoch) del primo arrivo, dal più vecchio
+        self.journal_lines = 0
+        self.duplicates = 0
+        self.load()
+        self.journal = open(self.path, "a", encoding="utf-8")
+
+    def load(self):
+        """Rilegge le chiavi ancora valide e riscrive il file senza quelle scadute"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if not os.path.exists(self.path):
+            return
+        cutoff = time.time() - self.ttl
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        seen_at, key = json.loads(line)
+                    except ValueError:
+                        continue
+                    if seen_at >= cutoff:
+                        self.seen[key] = seen_at
+        except Exception as e:
+            log.error("Errore durante il caricamento degli aggiornamenti già visti: %s", e)
+        self._prune(time.time())
+        try:
+            self._rewrite()
+        except Exception as e:
+            log.error("Errore durante la riscrittura degli aggiornamenti già visti: %s", e)
+        log.info("Filtro duplicati: %d aggiornamenti recenti già visti", len(self.seen))
+
+    def _prune(self, now):
+        cutoff = now - self.ttl
+        while self.seen and (len(self.seen) > self.max_entries or next(iter(self.seen.values())) < cutoff):
+            self.seen.popitem(last=False)
+
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, seen_at in self.seen.items():
+                f.write(json.dumps([seen_at, key]) + "\n")
+        os.replace(tmp_path, self.path)
+        self.journal_lines = len(self.seen)
+
+    def is_new(self, update):
+        """True la prima volta che un aggiornamento arriva (e lo annota), False per i duplicati"""
+        key = update_key(update)
+        now = time.time()
+        with self.lock:
+            if key in self.seen:
+                self.duplicates += 1
+                DUPLICATE_UPDATES.inc()
+                log.info("Aggiornamento %s già elaborato (%s): ignorato", update.update_id, key)
+                return False
+            self.seen[key] = now
+            self._prune(now)
+            try:
+                self.journal.write(json.dumps([now, key]) + "\n")
+                self.journal.flush()
+                self.journal_lines += 1
+            except Exception as e:
+                log.error("Errore durante la scrittura degli aggiornamenti già visti: %s", e)
+        return True
+
+    def filter(self, updates):
+        """Gli aggiornamenti della lista non ancora visti, nello stesso ordine"""
+        return [update for update in updates if self.is_new(update)]
+
+    def compact(self):
+        """Riscrive il file quando le righe scadute superano quelle valide (salvataggio automatico)"""
+        with self.lock:
+            self._prune(time.time())
+            if self.journal_lines <= 2 * len(self.seen) + 1000:
+                return
+            self.journal.close()
+            try:
+                self._rewrite()
+            finally:
+                self.journal = open(self.path, "a", encoding="utf-8")
@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import math
+import heapq
+import logging
+import threading
+import unicodedata
+
+from backfill import BackfillState, message_key
+
+log = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Parole italiane troppo frequenti per distinguere un messaggio dall'altro
+STOPWORDS = frozenset("""
+a ad al allo alla ai agli alle all anche ancora avere ha hai hanno ho che chi ci come con col coi
+cosa cui da dal dallo dalla dai dagli dalle de del dello della dei degli delle di do dove e ed era
+erano essere gli ha il in io la le lei li lo loro lui ma me mi mia mie miei mio ne nei negli nel
+nello nella nelle no noi non nostro o od per perche piu poi qua quale quando quanto quella quelle
+quelli quello questa queste questi questo qui se sei si sia siamo siete sono su sua sue sugli sui
+sul sullo sulla sulle suo suoi ti tra tu tua tue tuo tuoi tutti tutto un una uno vi voi vostro
+gia sto sta stai fa fai fare molto poco allora boh eh ok oh ah
+""".split())
+
+
+def tokenize(text):
+    """Normalizza un testo italiano in token: minuscole, senza accenti, senza stopword, stem leggero"""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    tokens = []
+    for token in TOKEN_RE.findall(text):
+        if len(token) < 2 or token in STOPWORDS:
+            continue
+        # Stem leggero: toglie la vocale finale (pizza/pizze/pizzi -> pizz)
+        if len(token) > 3 and token[-1] in "aeio":
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+    """Indice invertito incrementale per chat con punteggio BM25, senza chiamate al modello.
+
+    Ogni chat ha un file ``<chat_id>.jsonl`` nella directory dell'indice con i messaggi indicizzati;
+    liste di posting e lunghezze dei documenti vengono ricostruite in memoria al primo accesso.
+    Le chat la cui cronologia è già nell'indice sono elencate in ``backfill.json``.
+    """
+
+    def __init__(self, index_dir="data/bm25", k1=1.5, b=0.75):
+        """Inizializza l'indice lessicale"""
+        self.index_dir = index_dir
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self.chat_locks = {}
+        self.chats = {}  # chat_id -> {"docs", "doc_lens", "postings", "total_len"}
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.backfill = BackfillState(os.path.join(self.index_dir, "backfill.json"))
+
+    def _path(self, chat_id):
+        return os.path.join(self.index_dir, f"{chat_id}.jsonl")
+
+    def _chat_lock(self, chat_id):
+        with self.lock:
+            if chat_id not in self.chat_locks:
+                self.chat_locks[chat_id] = threading.Lock()
+            return self.chat_locks[chat_id]
+
+    def _empty_chat(self):
+        return {"docs": [], "doc_lens": [], "postings": {}, "total_len": 0}
+
+    def _index_doc(self, chat, doc):
+        """Aggiunge un documento alle strutture in memoria di una chat"""
+        tokens = tokenize(doc["text"])
+        doc_id = len(chat["docs"])
+        chat["docs"].append(doc)
+        chat["doc_lens"].append(len(tokens))
+        chat["total_len"] += len(tokens)
+        frequencies = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+        postings = chat["postings"]
+        for token, tf in frequencies.items():
+            if token in postings:
+                postings[token].append((doc_id, tf))
+            else:
+                postings[token] = [(doc_id, tf)]
+
+    def _load_chat(self, chat_id):
+        """Carica l'indice di una chat dal disco (da chiamare col lock della chat)"""
+        if chat_id in self.chats:
+            return self.chats[chat_id]
+        chat = self._empty_chat()
+        path = self._path(chat_id)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._index_doc(chat, json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        self.chats[chat_id] = chat
+        return chat
+
+    def is_backfilled(self, chat_id):
+        """Indica se la cronologia della chat è già stata indicizzata (non solo i messaggi nuovi)"""
+        return self.backfill.is_done(chat_id)
+
+    def add(self, log_entry):
+        """Indicizza un messaggio registrato da MessageLogger e lo aggiunge al file della chat"""
+        text = log_entry.get("text")
+        if not text or text.startswith('/') or log_entry.get("chat_id") is None:
+            return
+        # Le chiavi di user_data possono essere stringhe (da JSON) o interi (da Telegram)
+        chat_id = str(log_entry["chat_id"])
+        doc = {
+            "timestamp": log_entry.get("timestamp", ""),
+            "user_id": log_entry.get("user_id", ""),
+            "user_name": log_entry.get("user_first_name", ""),
+            "username": log_entry.get("username", ""),
+            "text": text
+        }
+        with self._chat_lock(chat_id):
+            chat = self._load_chat(chat_id)
+            with open(self._path(chat_id), "a", encoding="utf-8") as f:
+                f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+            self._index_doc(chat, doc)
+
+    def build_from_history(self, chat_id, chat_messages):
+        """Ricostruisce l'indice di una chat dalla cronologia (formato get_chat_message_history).
+
+        I messaggi aggiunti da ``add`` nel frattempo restano: quelli già presenti nella cronologia
+        vengono scartati, gli altri seguono la cronologia. Restituisce il numero di messaggi indicizzati.
+        """
+        chat_id = str(chat_id)
+        chat = self._empty_chat()
+        path = self._path(chat_id)
+        docs = [
+            {key: msg.get(key, "") for key in ("timestamp", "user_id", "user_name", "username", "text")}
+            for msg in chat_messages
+            if msg.get("text") and not msg["text"].startswith('/')
+        ]
+        history_keys = {message_key(doc) for doc in docs}
+        watermark = max((doc["timestamp"] for doc in docs), default="")
+        # Sotto il lock della chat: add() attende e scrive sul file nuovo
+        with self._chat_lock(chat_id):
+            live_docs = self._load_chat(chat_id)["docs"]
+            docs.extend(doc for doc in live_docs if message_key(doc) not in history_keys)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                for doc in docs:
+                    f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+                    self._index_doc(chat, doc)
+            os.replace(path + ".tmp", path)
+            self.chats[chat_id] = chat
+            self.backfill.mark_done(chat_id, watermark)
+        return len(chat["docs"])
+
+    def search(self, chat_id, query, top_n=8):
+        """Restituisce i top_n messaggi della chat con il punteggio BM25 più alto per la domanda"""
+        query_terms = set(tokenize(query or ""))
+        if not query_terms:
+            return []
+        chat_id = str(chat_id)
+        with self._chat_lock(chat_id):
+            chat = self._load_chat(chat_id)
+            n_docs = len(chat["docs"])
+            if n_docs == 0:
+                return []
+            avg_len = chat["total_len"] / n_docs or 1.0
+            doc_lens = chat["doc_lens"]
+            scores = {}
+            for term in query_terms:
+                postings = chat["postings"].get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings:
+                    norm = self.k1 * (1 - self.b + self.b * doc_lens[doc_id] / avg_len)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+            best = heapq.nlargest(top_n, scores.items(), key=lambda item: item[1])
+            return [dict(chat["docs"][doc_id], score=score) for doc_id, score in best]
@@ -0,0 +1,56 @@
+import hashlib
+import logging
+import random
+
+from config import LOG_LEVEL, LOG_DEBUG_SAMPLE_RATE, LOG_PAYLOAD_PREVIEW_CHARS
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def setup_logging(level=None):
+    """Configura il logging del processo (livello, formato, librerie rumorose)"""
+    level_name = (level or LOG_LEVEL).upper()
+    logging.basicConfig(level=getattr(logging, level_name, logging.INFO), format=LOG_FORMAT)
+    # urllib3 registra ogni connessione a livello DEBUG: la teniamo a WARNING
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+
+def should_sample():
+    """Decide se registrare il dettaglio DEBUG per questa chiamata"""
+    if LOG_DEBUG_SAMPLE_RATE >= 1.0:
+        return True
+    return random.random() < LOG_DEBUG_SAMPLE_RATE
+
+
+def summarize_text(text, preview_chars=None):
+    """Riassume un testo con lunghezza, hash e una breve anteprima"""
+    if text is None:
+        return "None"
+    preview_chars = LOG_PAYLOAD_PREVIEW_CHARS if preview_chars is None else preview_chars
+    digest = hashlib.sha1(text.encode("utf-8", "replace")).hexdigest()[:10]
+    preview = text[:preview_chars].replace("\n", " ")
+    suffix = "..." if len(text) > preview_chars else ""
+    return f"len={len(text)} sha1={digest} '{preview}{suffix}'"
+
+
+def summarize_payload(payload):
+    """Riassume un payload per Ollama senza riportarne il contenuto completo"""
+    messages = payload.get("messages", [])
+    roles = {}
+    total_chars = 0
+    for msg in messages:
+        roles[msg.get("role")] = roles.get(msg.get("role"), 0) + 1
+        total_chars += len(msg.get("content") or "")
+    last_content = messages[-1].get("content") if messages else None
+    return (
+        f"model={payload.get('model')} messages={len(messages)} roles={roles} "
+        f"chars={total_chars} options={payload.get('options', {})} "
+        f"last=({summarize_text(last_content)})"
+    )
+
+
+def summarize_response(result):
+    """Riassume la risposta di Ollama (statistiche e testo generato)"""
+    content = (result.get("message") or {}).get("content")
+    stats = {key: result[key] for key in ("prompt_eval_count", "eval_count", "total_duration") if key in result}
+    return f"stats={stats} content=({summarize_text(content)})"
@@ -1,22 +1,32 @@
 import os
 import json
+import logging
 from datetime import datetime
 
+from metrics import LOG_SCAN_SECONDS, timed
+
+log = logging.getLogger(__name__)
+
 class MessageLogger:
     def __init__(self, log_dir="logs"):
         """Inizializza il logger dei messaggi"""
         self.log_dir = log_dir
         self.current_log_file = None
+        self.listeners = []
         self.ensure_log_directory()
         
     def ensure_log_directory(self):
         """Assicura che la directory dei log esista"""
         if not os.path.exists(self.log_dir):
             os.makedirs(self.log_dir)
-            print(f"Creata directory dei log: {self.log_dir}")
+            log.info("Creata directory dei log: %s", self.log_dir)
 
             
     
+    def add_listener(self, callback):
+        """Registra una funzione chiamata con ogni voce di log appena scritta"""
+        self.listeners.append(callback)
+    
     def get_current_log_file(self):
         """Ottiene il nome del file di log corrente basato sulla data"""
         today = datetime.now().strftime("%Y-%m-%d")
@@ -46,12 +56,20 @@ class MessageLogger:
             # Aggiungi il messaggio al file di log in formato JSONL (JSON Lines)
             with open(log_file, "a", encoding="utf-8") as f:
                 f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
+            
+            # Notifica gli indici e i contatori che si aggiornano a ogni messaggio
+            for callback in self.listeners:
+                try:
+                    callback(log_entry)
+                except Exception as e:
+                    log.error("Errore in un listener del log: %s", e)
                 
             return True
         except Exception as e:
-            print(f"Errore durante il salvataggio del log: {e}")
+            log.error("Errore durante il salvataggio del log: %s", e)
             return False
     
+    @timed(LOG_SCAN_SECONDS, "get_recent_logs")
     def get_recent_logs(self, count=100):
         """Legge i log più recenti"""
         try:
@@ -65,9 +83,10 @@ class MessageLogger:
                 logs = [json.loads(line) for line in lines]
                 return logs
         except Exception as e:
-            print(f"Errore durante la lettura dei log: {e}")
+            log.error("Errore durante la lettura dei log: %s", e)
             return []
     
+    @timed(LOG_SCAN_SECONDS, "load_logs")
     def load_logs(self):
         """Carica i log precedenti all'avvio del bot"""
         try:
@@ -80,7 +99,7 @@ class MessageLogger:
                         log_files.append(os.path.join(self.log_dir, file))
             
             if not log_files:
-                print("Nessun file di log precedente trovato.")
+                log.info("Nessun file di log precedente trovato.")
                 return 0
                 
             total_logs = 0
@@ -91,16 +110,17 @@ class MessageLogger:
                         lines = f.readlines()
                         log_count = len(lines)
                         total_logs += log_count
-                        print(f"File di log {os.path.basename(log_file)}: {log_count} messaggi")
+                        log.debug("File di log %s: %s messaggi", os.path.basename(log_file), log_count)
                 except Exception as e:
-                    print(f"Errore durante la lettura del file di log {log_file}: {e}")
+                    log.error("Errore durante la lettura del file di log %s: %s", log_file, e)
                     
-            print(f"Totale messaggi nei log: {total_logs}")
+            log.info("Totale messaggi nei log: %s", total_logs)
             return total_logs
         except Exception as e:
-            print(f"Errore durante il caricamento dei log: {e}")
+            log.error("Errore durante il caricamento dei log: %s", e)
             return 0
     
+    @timed(LOG_SCAN_SECONDS, "extract_users_from_logs")
     def extract_users_from_logs(self):
         """Estrae gli utenti dai file di log"""
         try:
@@ -108,7 +128,7 @@ class MessageLogger:
             
             # Controlla se la directory esiste
             if not os.path.exists(self.log_dir):
-                print("Directory dei log non trovata.")
+                log.info("Directory dei log non trovata.")
                 return users
                 
             # Trova tutti i file di log nella directory
@@ -118,10 +138,10 @@ class MessageLogger:
                     log_files.append(os.path.join(self.log_dir, file))
             
             if not log_files:
-                print("Nessun file di log trovato per estrarre utenti.")
+                log.info("Nessun file di log trovato per estrarre utenti.")
                 return users
                 
-            print(f"Estrazione utenti da {len(log_files)} file di log...")
+            log.info("Estrazione utenti da %s file di log...", len(log_files))
             
             # Processa ogni file di log
             for log_file in log_files:
@@ -153,18 +173,19 @@ class MessageLogger:
                             except json.JSONDecodeError:
                                 continue
                 except Exception as e:
-                    print(f"Errore durante la lettura del file {log_file}: {e}")
+                    log.error("Errore durante la lettura del file %s: %s", log_file, e)
                     continue
                     
             # Conta il numero di utenti estratti
             total_users = sum(len(chat_users) for chat_users in users.values())
-            print(f"Estratti {total_users} utenti unici dai log")
+            log.info("Estratti %s utenti unici dai log", total_users)
             
             return users
         except Exception as e:
-            print(f"Errore durante l'estrazione degli utenti dai log: {e}")
+            log.error("Errore durante l'estrazione degli utenti dai log: %s", e)
             return {}
     
+    @timed(LOG_SCAN_SECONDS, "extract_messages_from_logs")
     def extract_messages_from_logs(self):
         """Estrae i messaggi degli utenti dai file di log"""
         try:
@@ -172,7 +193,7 @@ class MessageLogger:
             
             # Controlla se la directory esiste
             if not os.path.exists(self.log_dir):
-                print("Directory dei log non trovata.")
+                log.info("Directory dei log non trovata.")
                 return user_messages
                 
             # Trova tutti i file di log nella directory
@@ -182,10 +203,10 @@ class MessageLogger:
                     log_files.append(os.path.join(self.log_dir, file))
             
             if not log_files:
-                print("Nessun file di log trovato per estrarre messaggi.")
+                log.info("Nessun file di log trovato per estrarre messaggi.")
                 return user_messages
                 
-            print(f"Estrazione messaggi da {len(log_files)} file di log...")
+            log.info("Estrazione messaggi da %s file di log...", len(log_files))
             
             # Processa ogni file di log
             for log_file in log_files:
@@ -216,18 +237,19 @@ class MessageLogger:
                             except json.JSONDecodeError:
                                 continue
                 except Exception as e:
-                    print(f"Errore durante la lettura del file {log_file}: {e}")
+                    log.error("Errore durante la lettura del file %s: %s", log_file, e)
                     continue
             
             # Conta il numero totale di messaggi estratti
             total_messages = sum(len(messages) for chat_msgs in user_messages.values() for messages in chat_msgs.values())
-            print(f"Estratti {total_messages} messaggi da {len(user_messages)} chat")
+            log.info("Estratti %s messaggi da %s chat", total_messages, len(user_messages))
             
             return user_messages
         except Exception as e:
-            print(f"Errore durante l'estrazione dei messaggi dai log: {e}")
+            log.error("Errore durante l'estrazione dei messaggi dai log: %s", e)
             return {}
     
+    @timed(LOG_SCAN_SECONDS, "get_user_message_history")
     def get_user_message_history(self, chat_id, user_id):
         """Estrae tutti i messaggi di un utente specifico dai log"""
         user_messages = []
@@ -265,7 +287,7 @@ class MessageLogger:
                         except json.JSONDecodeError:
                             continue
             except Exception as e:
-                print(f"Errore durante la lettura del file {log_file}: {e}")
+                log.error("Errore durante la lettura del file %s: %s", log_file, e)
                 continue
 
             
@@ -275,6 +297,7 @@ class MessageLogger:
         
         return user_messages
     
+    @timed(LOG_SCAN_SECONDS, "get_chat_message_history")
     def get_chat_message_history(self, chat_id):
         """Estrae tutti i messaggi di una chat specifica dai log, organizzati per utente"""
         chat_messages = []
@@ -319,12 +342,31 @@ class MessageLogger:
                         except json.JSONDecodeError:
                             continue
             except Exception as e:
-                print(f"Errore durante la lettura del file {log_file}: {e}")
+                log.error("Errore durante la lettura del file %s: %s", log_file, e)
                 continue
         
         # Ordina i messaggi per timestamp
         chat_messages.sort(key=lambda x: x["timestamp"])
         
-        print(f"Estratti {messages_count} messaggi totali dalla chat {chat_id}")
+        log.debug("Estratti %s messaggi totali dalla chat %s", messages_count, chat_id)
         
-        return chat_messages
\ No newline at end of file
+        return chat_messages
+
+    def iter_log_entries(self):
+        """Scorre tutte le voci di log, dal file più vecchio al più recente, un file alla volta"""
+        if not os.path.exists(self.log_dir):
+            return
+        log_files = sorted(
+            os.path.join(self.log_dir, file) for file in os.listdir(self.log_dir)
+            if file.startswith("telegram_log_") and file.endswith(".jsonl")
+        )
+        for log_file in log_files:
+            try:
+                with open(log_file, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            yield json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+            except OSError as e:
+                log.error("Errore durante la lettura del file %s: %s", log_file, e)
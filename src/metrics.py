@@ -0,0 +1,202 @@
+import time
+import logging
+import threading
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+# Metriche registrate, nell'ordine in cui compaiono nell'output
+REGISTRY = []
+
+# Limiti dei bucket in secondi: dalle chiamate veloci alle generazioni lunghe del modello
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # tupla di etichette -> valore
+        REGISTRY.append(self)
+
+    def _samples(self):
+        with self.lock:
+            return [(self.name, labels, (), value) for labels, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, labels, extra)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Contatore monotono, con un valore per combinazione di etichette"""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self.values[()] = 0
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """Valore istantaneo; con set_function viene calcolato solo quando le metriche sono lette"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = {}
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def set_function(self, function, *labels):
+        """Registra una funzione senza argomenti che restituisce il valore corrente"""
+        with self.lock:
+            self.functions[labels] = function
+
+    def _samples(self):
+        samples = super()._samples()
+        with self.lock:
+            functions = list(self.functions.items())
+        for labels, function in functions:
+            try:
+                samples.append((self.name, labels, (), function()))
+            except Exception as e:
+                log.debug("Metrica %s non disponibile: %s", self.name, e)
+        return samples
+
+
+class Histogram(_Metric):
+    """Distribuzione di durate o dimensioni in bucket cumulativi, con somma e conteggio"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labels):
+        """Context manager che osserva la durata del blocco in secondi"""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        samples = []
+        with self.lock:
+            items = [(labels, list(state[0]), state[1], state[2]) for labels, state in self.values.items()]
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", labels, (("le", bound),), cumulative))
+            samples.append((f"{self.name}_bucket", labels, (("le", "+Inf"),), count))
+            samples.append((f"{self.name}_sum", labels, (), total))
+            samples.append((f"{self.name}_count", labels, (), count))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+def timed(histogram, *labels):
+    """Decoratore che registra nell'istogramma la durata di ogni chiamata"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(*labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render_metrics():
+    """Tutte le metriche nel formato testuale di Prometheus"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Espone /metrics su un server HTTP in un thread separato"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    log.info("Metriche disponibili su http://%s:%d/metrics", host, port)
+    return server
+
+
+# Metriche del bot
+UPDATES_RECEIVED = Counter("bot_updates_received_total", "Messaggi ricevuti dagli handler", ["chat_type"])
+REPLIES_SENT = Counter("bot_replies_sent_total", "Risposte generate e accodate per l'invio")
+LLM_LATENCY = Histogram("bot_llm_request_seconds", "Durata delle chiamate al modello", ["method"])
+LLM_ERRORS = Counter("bot_llm_errors_total", "Chiamate al modello fallite", ["method"])
+# Con il prefisso in cache Ollama valuta solo i token nuovi: token e secondi per chiamata calano
+LLM_PROMPT_EVAL_TOKENS = Counter("bot_llm_prompt_eval_tokens_total", "Token del prompt valutati dal modello", ["method"])
+LLM_PROMPT_EVAL_SECONDS = Counter("bot_llm_prompt_eval_seconds_total", "Tempo di valutazione del prompt", ["method"])
+LOG_SCAN_SECONDS = Histogram("bot_log_scan_seconds", "Durata delle letture dei file di log", ["operation"])
+SAVE_SECONDS = Histogram("bot_save_seconds", "Durata dei salvataggi di DataManager", ["file"])
+SAVE_BYTES = Gauge("bot_save_bytes", "Dimensione dell'ultimo file salvato", ["file"])
+THREAD_CYCLE_SECONDS = Histogram("bot_thread_cycle_seconds", "Durata di un ciclo dei thread in background",
+                                 ["thread"], buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+CACHE_REQUESTS = Counter("bot_cache_requests_total", "Accessi alle cache per esito", ["cache", "result"])
+WARMUP_READY = Gauge("bot_warmup_ready", "1 quando il caricamento dello storico è completato, altrimenti 0")
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Elementi in attesa nelle code interne", ["queue"])
+BACKGROUND_TASKS = Counter("bot_background_tasks_total", "Lavori per chat dei passaggi in background per esito",
+                           ["pool", "result"])
+SHARD_UPDATES = Counter("bot_shard_updates_total", "Aggiornamenti smistati dal processo di ingresso per shard ed esito",
+                        ["shard", "result"])
+DUPLICATE_UPDATES = Counter("bot_duplicate_updates_total", "Aggiornamenti di Telegram già elaborati e ignorati")
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+
+from send_queue import TokenBucket
+from background_pool import BackgroundPool
+
+log = logging.getLogger(__name__)
+
+class ContextRefreshScheduler:
+    """Decide quando rigenerare il contesto di una chat in base alla sua attività.
+
+    I contatori per chat sono aggiornati da ``record`` (listener di MessageLogger). Una chat viene
+    aggiornata quando accumula ``min_new_messages`` nuovi messaggi, oppure quando sono passati
+    ``max_interval`` secondi dall'ultimo aggiornamento e ha almeno un messaggio nuovo. Un limite
+    globale di ``max_per_hour`` aggiornamenti protegge il modello (0 lo disattiva); le chat inattive non costano nulla.
+    Gli aggiornamenti girano su ``pool`` (un BackgroundPool): più chat in parallelo, mai la stessa due volte.
+    """
+
+    def __init__(self, refresh_chat, min_new_messages=50, max_interval=1800, max_per_hour=20, poll_interval=30,
+                 pool=None):
+        """Inizializza lo scheduler; refresh_chat(chat_id) esegue l'aggiornamento vero e proprio"""
+        self.refresh_chat = refresh_chat
+        self.pool = pool or BackgroundPool("context_refresh", 1)
+        self.in_flight = set()
+        self.min_new_messages = min_new_messages
+        self.max_interval = max_interval
+        self.poll_interval = poll_interval
+        # Con un tasso nullo il secchiello non si riempirebbe mai: 0 significa nessun tetto orario
+        self.bucket = TokenBucket(max_per_hour / 3600.0, min(3, max_per_hour)) if max_per_hour > 0 else None
+        self.condition = threading.Condition()
+        self.new_messages = {}  # chat_id -> messaggi dall'ultimo aggiornamento
+        self.last_refresh = {}  # chat_id -> istante dell'ultimo aggiornamento (o del primo messaggio visto)
+        self.refresh_count = 0
+        self.thread = None
+
+    def record(self, log_entry):
+        """Conta un messaggio registrato; sveglia lo scheduler se la chat ha raggiunto la soglia"""
+        chat_id = log_entry.get("chat_id")
+        if chat_id is None or not log_entry.get("text"):
+            return
+        with self.condition:
+            count = self.new_messages.get(chat_id, 0) + 1
+            self.new_messages[chat_id] = count
+            self.last_refresh.setdefault(chat_id, time.monotonic())
+            if count == self.min_new_messages:
+                self.condition.notify()
+
+    def due_chats(self, now):
+        """Chat da aggiornare, le più attive per prime (da chiamare col lock)"""
+        due = [
+            chat_id for chat_id, count in self.new_messages.items()
+            if chat_id not in self.in_flight
+            and (count >= self.min_new_messages or (count > 0 and now - self.last_refresh[chat_id] >= self.max_interval))
+        ]
+        return sorted(due, key=lambda chat_id: self.new_messages[chat_id], reverse=True)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="ContextRefresh", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        log.info("Avviato scheduler di aggiornamento contesto...")
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                if len(self.in_flight) >= self.pool.concurrency:
+                    # Tutti i thread del pool sono occupati: si riprova quando uno finisce
+                    self.condition.wait(self.poll_interval)
+                    continue
+                due = self.due_chats(now)
+                if not due:
+                    self.condition.wait(self.poll_interval)
+                    continue
+                wait = self.bucket.wait_time(now) if self.bucket else 0.0
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                chat_id = due[0]
+                if self.bucket:
+                    self.bucket.consume(now)
+                pending = self.new_messages.pop(chat_id)
+                self.last_refresh[chat_id] = now
+                self.in_flight.add(chat_id)
+            # I messaggi che arrivano durante l'aggiornamento contano per il prossimo
+            log.info("Aggiornamento contesto per chat %s (%d messaggi nuovi)", chat_id, pending)
+            future = self.pool.submit(chat_id, self.refresh_chat, chat_id)
+            future.add_done_callback(lambda future, chat_id=chat_id: self._refresh_done(chat_id, future))
+
+    def _refresh_done(self, chat_id, future):
+        # Gli errori sono già registrati dal pool, per chat
+        with self.condition:
+            self.in_flight.discard(chat_id)
+            if future.exception() is None:
+                self.refresh_count += 1
+            self.condition.notify()
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import telebot
+
+log = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Secchiello di token: ``rate`` token al secondo, al massimo ``capacity`` accumulati"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Secondi da attendere prima che sia disponibile un token"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        """True se il secchiello è pieno: dimenticarlo equivale a ricrearlo"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendDispatcher:
+    """Coda di invio verso la Bot API con limiti globali e per chat.
+
+    Ogni chat ha una coda FIFO: i messaggi di una chat escono nell'ordine di invio e mai in
+    parallelo. I limiti seguono quelli di Telegram (circa 30 messaggi/s in totale, 1/s per chat,
+    20/min per gruppo); in caso di errore 429 il messaggio torna in testa alla coda e la chat
+    resta ferma per il ``retry_after`` indicato da Telegram.
+    """
+
+    def __init__(self, bot, global_rate=30, chat_rate=1, group_per_minute=20, workers=4, prune_interval=60.0):
+        """Inizializza la coda e avvia i thread di invio"""
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_per_minute = group_per_minute
+        self.condition = threading.Condition()
+        self.queues = {}  # chat_id -> deque di (funzione, argomenti, future)
+        self.buckets = {}  # chat_id -> lista di TokenBucket
+        self.blocked_until = {}  # chat_id -> istante fino al quale rispettare un retry_after
+        self.in_flight = set()  # chat con un invio in corso
+        self.prune_interval = prune_interval
+        self.last_prune = time.monotonic()
+        self.sent_count = 0
+        self.throttled_count = 0
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"SendDispatcher-{i}", daemon=True).start()
+
+    def _chat_buckets(self, chat_id):
+        if chat_id not in self.buckets:
+            buckets = [TokenBucket(self.chat_rate, 3)]
+            # Gli id negativi sono gruppi e canali, con un limite aggiuntivo al minuto
+            if isinstance(chat_id, int) and chat_id < 0:
+                buckets.append(TokenBucket(self.group_per_minute / 60.0, self.group_per_minute))
+            self.buckets[chat_id] = buckets
+        return self.buckets[chat_id]
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """Accoda una chiamata alla Bot API per la chat e restituisce un Future col risultato"""
+        future = Future()
+        with self.condition:
+            self.queues.setdefault(chat_id, deque()).append((func, args, kwargs, future))
+            self.condition.notify()
+        return future
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    def queue_depth(self, chat_id=None):
+        """Messaggi in attesa di invio, per una chat o in totale"""
+        with self.condition:
+            if chat_id is not None:
+                return len(self.queues.get(chat_id, ()))
+            return sum(len(queue) for queue in self.queues.values())
+
+    def _next_ready(self, now):
+        """Sceglie una chat pronta per l'invio; altrimenti restituisce il tempo minimo di attesa"""
+        min_wait = None
+        global_wait = self.global_bucket.wait_time(now)
+        for chat_id, queue in self.queues.items():
+            if not queue or chat_id in self.in_flight:
+                continue
+            wait = max([global_wait, self.blocked_until.get(chat_id, 0) - now] +
+                       [bucket.wait_time(now) for bucket in self._chat_buckets(chat_id)])
+            if wait <= 0:
+                return chat_id, 0
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, min_wait
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    chat_id, wait = self._next_ready(now)
+                    if chat_id is not None:
+                        break
+                    self.condition.wait(wait)
+                func, args, kwargs, future = self.queues[chat_id].popleft()
+                if not self.queues[chat_id]:
+                    del self.queues[chat_id]
+                self.global_bucket.consume(now)
+                for bucket in self._chat_buckets(chat_id):
+                    bucket.consume(now)
+                self.in_flight.add(chat_id)
+
+            requeue = False
+            try:
+                result = func(*args, **kwargs)
+                future.set_result(result)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = e.result_json.get("parameters", {}).get("retry_after", 1)
+                    log.warning("Limite di invio raggiunto per chat %s: riprovo tra %s s", chat_id, retry_after)
+                    requeue = True
+                else:
+                    log.error("Errore nell'invio alla chat %s: %s", chat_id, e)
+                    future.set_exception(e)
+            except Exception as e:
+                log.error("Errore nell'invio alla chat %s: %s", chat_id, e)
+                future.set_exception(e)
+
+            with self.condition:
+                self.in_flight.discard(chat_id)
+                if future.done() and future.exception() is None:
+                    self.sent_count += 1
+                if requeue:
+                    self.throttled_count += 1
+                    # Torna in testa alla coda per non alterare l'ordine della chat
+                    self.queues.setdefault(chat_id, deque()).appendleft((func, args, kwargs, future))
+                    self.blocked_until[chat_id] = time.monotonic() + retry_after
+                now = time.monotonic()
+                if now - self.last_prune >= self.prune_interval:
+                    self._prune(now)
+                self.condition.notify_all()
+
+    def _prune(self, now):
+        """Dimentica secchielli e blocchi delle chat inattive (da chiamare col lock)"""
+        self.last_prune = now
+        for chat_id, until in list(self.blocked_until.items()):
+            if until <= now and chat_id not in self.queues:
+                del self.blocked_until[chat_id]
+        for chat_id, buckets in list(self.buckets.items()):
+            if (chat_id not in self.queues and chat_id not in self.in_flight and chat_id not in self.blocked_until
+                    and all(bucket.is_full(now) for bucket in buckets)):
+                del self.buckets[chat_id]
@@ -0,0 +1,305 @@
+"""Esecuzione su più processi: un processo di ingresso smista gli aggiornamenti di Telegram per chat.
+
+Il processo di ingresso riceve gli aggiornamenti (polling o webhook, come bot.py) senza
+deserializzarli e li inoltra allo shard ``hash(chat_id) % SHARD_COUNT`` tramite una coda
+multiprocessing. Ogni shard è un processo bot completo (bot.create_app) che possiede i dati,
+la cronologia, il contesto e i thread di background delle sue chat, in data/shard-N e logs/shard-N.
+
+Avvio: SHARD_COUNT=4 python src/bot.py (oppure python src/sharding.py).
+"""
+import os
+import json
+import time
+import queue
+import shutil
+import logging
+import threading
+import multiprocessing
+
+import telebot
+
+from config import (
+    BOT_TOKEN, BOT_MODE, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_REGISTER,
+    SHARD_COUNT, SHARD_QUEUE_SIZE, METRICS_PORT, METRICS_HOST
+)
+from log_setup import setup_logging
+from metrics import SHARD_UPDATES, start_metrics_server
+from webhook_server import WebhookServer
+
+log = logging.getLogger(__name__)
+
+
+def update_chat_id(update):
+    """Chat di un aggiornamento grezzo; per quelli senza chat (es. inline) l'utente che l'ha generato"""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if value.get("from"):
+            return value["from"]["id"]
+    return 0
+
+
+def shard_for(chat_id, shard_count):
+    # hash di un intero non dipende da PYTHONHASHSEED: lo stesso in ogni processo e riavvio
+    return hash(chat_id) % shard_count
+
+
+def run_shard(shard, shard_count, updates):
+    """Corpo di un processo shard: un bot completo che elabora gli aggiornamenti della sua coda"""
+    import bot as app
+
+    setup_logging()
+    app.create_app(shard=shard, shard_count=shard_count)
+    if METRICS_PORT:
+        # Una porta per shard: METRICS_PORT + 1 + shard
+        start_metrics_server(METRICS_PORT + 1 + shard, METRICS_HOST)
+    app.start_background_threads()
+    log.info("Shard %d/%d avviato (pid %d)", shard, shard_count, os.getpid())
+
+    while True:
+        raw_update = updates.get()
+        if raw_update is None:
+            break
+        try:
+            app.bot.process_new_updates([telebot.types.Update.de_json(raw_update)])
+        except Exception as e:
+            log.exception("Shard %d: errore nell'elaborazione dell'aggiornamento %s: %s",
+                          shard, raw_update.get("update_id"), e)
+
+    # Si lascia ai gestori il tempo di finire i messaggi già accodati prima di salvare
+    deadline = time.monotonic() + 10
+    while app.chat_worker_pool.queue_depth() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    log.info("Shard %d: salvataggio dati in corso...", shard)
+    app.data_manager.save_user_data(app.user_data)
+    app.data_manager.save_conversations(app.conversation_history)
+    app.chat_stats.save()
+
+
+class ShardRouter:
+    """Avvia i processi shard, inoltra a ciascuno gli aggiornamenti delle sue chat e li riavvia se cadono"""
+
+    def __init__(self, shard_count, queue_size=1000, check_interval=5.0, put_timeout=5.0):
+        self.shard_count = shard_count
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue(queue_size) for _ in range(shard_count)]
+        self.processes = [None] * shard_count
+        self.routed_count = [0] * shard_count
+        self.full_count = 0  # aggiornamenti non accodati entro put_timeout, da riprovare
+        self.check_interval = check_interval
+        self.put_timeout = put_timeout
+        self.stopping = threading.Event()
+
+    def _start_shard(self, shard):
+        process = self.context.Process(
+            target=run_shard, args=(shard, self.shard_count, self.queues[shard]), name=f"shard-{shard}"
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def start(self):
+        for shard in range(self.shard_count):
+            self._start_shard(shard)
+        threading.Thread(target=self._monitor, name="ShardMonitor", daemon=True).start()
+
+    def _monitor(self):
+        # La coda dello shard sopravvive al processo: gli aggiornamenti in attesa non vanno persi
+        while not self.stopping.wait(self.check_interval):
+            for shard, process in enumerate(self.processes):
+                if not process.is_alive():
+                    log.error("Shard %d terminato (codice %s): riavvio", shard, process.exitcode)
+                    self._start_shard(shard)
+
+    def route(self, update):
+        """Accoda un aggiornamento grezzo allo shard della sua chat.
+
+        Con la coda piena attende fino a ``put_timeout`` secondi; se non si libera restituisce False
+        e l'aggiornamento non viene accodato: è il chiamante a riprovarlo, nulla va perso.
+        """
+        shard = shard_for(update_chat_id(update), self.shard_count)
+        try:
+            self.queues[shard].put(update, timeout=self.put_timeout)
+        except queue.Full:
+            self.full_count += 1
+            SHARD_UPDATES.inc(shard, "full")
+            log.warning("Coda dello shard %d piena da %.0f s: aggiornamento %s da riprovare",
+                        shard, self.put_timeout, update.get("update_id"))
+            return False
+        self.routed_count[shard] += 1
+        SHARD_UPDATES.inc(shard, "routed")
+        return True
+
+    def stop(self, timeout=30.0):
+        """Chiede agli shard di salvare e terminare"""
+        self.stopping.set()
+        for shard_queue in self.queues:
+            shard_queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+class ShardedWebhookServer(WebhookServer):
+    """WebhookServer che inoltra gli aggiornamenti agli shard invece di elaborarli"""
+
+    def __init__(self, router, bot, webhook_url, secret=None, listen="0.0.0.0", port=8443):
+        super().__init__(bot, webhook_url, secret, listen, port)
+        self.router = router
+
+    def _process_updates(self):
+        # L'aggiornamento è già confermato a Telegram: si riprova finché lo shard non lo accetta
+        while True:
+            update = self.updates.get()
+            while not self.router.route(update):
+                pass
+
+
+def split_existing_data(shard_count):
+    """Al primo avvio divide per shard i dati e i log di un'installazione a processo singolo"""
+    for shard in range(shard_count):
+        if os.path.exists(os.path.join("data", f"shard-{shard}")) or os.path.exists(os.path.join("logs", f"shard-{shard}")):
+            return
+    log.info("Prima esecuzione con %d shard: suddivisione di dati e log esistenti...", shard_count)
+
+    for file_name in ("user_data.json", "conversations.json"):
+        path = os.path.join("data", file_name)
+        if not os.path.exists(path):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        parts = [{} for _ in range(shard_count)]
+        for chat_id, value in data.items():
+            parts[shard_for(int(chat_id), shard_count)][chat_id] = value
+        for shard, part in enumerate(parts):
+            os.makedirs(os.path.join("data", f"shard-{shard}"), exist_ok=True)
+            with open(os.path.join("data", f"shard-{shard}", file_name), "w", encoding="utf-8") as f:
+                json.dump(part, f, ensure_ascii=False, indent=2)
+
+    if os.path.exists("logs"):
+        for file_name in sorted(os.listdir("logs")):
+            if not (file_name.startswith("telegram_log_") and file_name.endswith(".jsonl")):
+                continue
+            outputs = []
+            for shard in range(shard_count):
+                os.makedirs(os.path.join("logs", f"shard-{shard}"), exist_ok=True)
+                outputs.append(open(os.path.join("logs", f"shard-{shard}", file_name), "w", encoding="utf-8"))
+            try:
+                with open(os.path.join("logs", file_name), "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            chat_id = json.loads(line).get("chat_id") or 0
+                        except json.JSONDecodeError:
+                            continue
+                        outputs[shard_for(chat_id, shard_count)].write(line)
+            finally:
+                for output in outputs:
+                    output.close()
+
+    for index_name in ("vectors", "bm25"):
+        _split_index(index_name, shard_count)
+    for shard in range(shard_count):
+        os.makedirs(os.path.join("data", f"shard-{shard}"), exist_ok=True)
+
+
+def _split_index(index_name, shard_count):
+    """Copia i file per chat di un indice (data/vectors, data/bm25) nella cartella dello shard della chat"""
+    source = os.path.join("data", index_name)
+    if not os.path.isdir(source):
+        return
+    targets = [os.path.join("data", f"shard-{shard}", index_name) for shard in range(shard_count)]
+    for target in targets:
+        os.makedirs(target, exist_ok=True)
+    for file_name in os.listdir(source):
+        path = os.path.join(source, file_name)
+        if file_name == "backfill.json":
+            # Lo stato del backfill si divide per chat, come i file che descrive
+            with open(path, "r", encoding="utf-8") as f:
+                chats = json.load(f)
+            parts = [{} for _ in range(shard_count)]
+            for chat_id, watermark in chats.items():
+                parts[shard_for(int(chat_id), shard_count)][chat_id] = watermark
+            for target, part in zip(targets, parts):
+                with open(os.path.join(target, file_name), "w", encoding="utf-8") as f:
+                    json.dump(part, f)
+            continue
+        # <chat_id>.jsonl, .f32, .json; i .tmp di scritture interrotte si lasciano
+        try:
+            chat_id = int(file_name.split(".", 1)[0])
+        except ValueError:
+            continue
+        if not file_name.endswith(".tmp"):
+            shutil.copy2(path, os.path.join(targets[shard_for(chat_id, shard_count)], file_name))
+
+
+def poll_updates(router, bot):
+    """Long polling di getUpdates: gli aggiornamenti passano agli shard così come arrivano"""
+    # Con un webhook ancora registrato getUpdates fallirebbe con errore 409
+    try:
+        bot.remove_webhook()
+    except Exception as e:
+        log.warning("Impossibile rimuovere il webhook: %s", e)
+
+    offset = None
+    retry_count = 0
+    log.info("Avvio del polling per %d shard...", router.shard_count)
+    while True:
+        try:
+            updates = telebot.apihelper.get_updates(BOT_TOKEN, offset, 100, timeout=40, long_polling_timeout=30)
+            retry_count = 0
+        except telebot.apihelper.ApiTelegramException as telegram_ex:
+            if "Unauthorized" in str(telegram_ex):
+                log.critical("ERRORE CRITICO: Token non valido o bot disabilitato: %s", telegram_ex)
+                return
+            log.error("Errore API Telegram: %s", telegram_ex)
+            updates = None
+        except Exception as e:
+            log.error("Errore nel polling: %s", e)
+            updates = None
+        if updates is None:
+            retry_count += 1
+            wait_time = min(5 * (2 ** (retry_count - 1)), 60)
+            log.warning("Tentativo #%d: riavvio del polling tra %d secondi...", retry_count, wait_time)
+            time.sleep(wait_time)
+            continue
+        # L'offset avanza solo oltre gli aggiornamenti accodati: Telegram ripropone gli altri
+        for update in updates:
+            if not router.route(update):
+                break
+            offset = update["update_id"] + 1
+
+
+def main():
+    setup_logging()
+    if SHARD_COUNT < 2:
+        raise SystemExit("sharding.py richiede SHARD_COUNT >= 2")
+    split_existing_data(SHARD_COUNT)
+
+    router = ShardRouter(SHARD_COUNT, SHARD_QUEUE_SIZE)
+    router.start()
+    if METRICS_PORT:
+        # Il processo di ingresso usa METRICS_PORT, gli shard le porte successive
+        start_metrics_server(METRICS_PORT, METRICS_HOST)
+    # Il bot del processo di ingresso serve solo per le chiamate di gestione del webhook
+    bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+    try:
+        if BOT_MODE == "webhook":
+            if not WEBHOOK_URL:
+                raise SystemExit("BOT_MODE=webhook richiede WEBHOOK_URL")
+            server = ShardedWebhookServer(router, bot, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT)
+            server.serve_forever(register=WEBHOOK_REGISTER)
+        else:
+            poll_updates(router, bot)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info("Arresto degli shard (aggiornamenti smistati: %s, code piene: %d)...",
+                 router.routed_count, router.full_count)
+        router.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import math
+import time
+import threading
+from collections import deque
+
+# Traccia attiva nel thread corrente, usata da span()
+_current = threading.local()
+
+
+class Trace:
+    """Durate delle fasi di elaborazione di un messaggio, dalla ricezione all'invio della risposta"""
+
+    def __init__(self, name, chat_id=None):
+        self.name = name
+        self.chat_id = chat_id
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans = []  # lista di (fase, secondi)
+        self.total = None
+
+    def add_span(self, stage, seconds):
+        self.spans.append((stage, seconds))
+
+
+class _Span:
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            self.trace.add_span(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def span(stage):
+    """Misura un blocco come fase della traccia attiva nel thread (senza traccia non fa nulla)"""
+    return _Span(getattr(_current, "trace", None), stage)
+
+
+def set_current(trace):
+    """Imposta la traccia attiva nel thread corrente (None per rimuoverla)"""
+    _current.trace = trace
+
+
+def current():
+    return getattr(_current, "trace", None)
+
+
+def percentile(sorted_values, fraction):
+    """Percentile con il metodo nearest-rank su una lista già ordinata"""
+    if not sorted_values:
+        return 0.0
+    # Rango = ceil(fraction * n); round() arrotonda i .5 al pari e sbaglierebbe di uno p95 con 100 valori
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Tracer:
+    """Buffer circolare delle tracce più recenti con riepiloghi per fase"""
+
+    def __init__(self, capacity=500):
+        self.lock = threading.Lock()
+        self.traces = deque(maxlen=capacity)
+
+    def start(self, name, chat_id=None):
+        return Trace(name, chat_id)
+
+    def finish(self, trace):
+        """Chiude una traccia e la aggiunge al buffer (le chiamate successive sono ignorate)"""
+        if trace is None or trace.total is not None:
+            return
+        trace.total = time.perf_counter() - trace.start
+        with self.lock:
+            self.traces.append(trace)
+
+    def stage_summary(self):
+        """Per ogni fase: (numero di campioni, p50, p95, p99) in secondi, più la fase "totale" """
+        with self.lock:
+            traces = list(self.traces)
+        durations = {}
+        for trace in traces:
+            for stage, seconds in trace.spans:
+                durations.setdefault(stage, []).append(seconds)
+            durations.setdefault("totale", []).append(trace.total)
+        summary = {}
+        for stage, values in durations.items():
+            values.sort()
+            summary[stage] = (len(values), percentile(values, 0.50), percentile(values, 0.95), percentile(values, 0.99))
+        return summary
+
+    def slowest(self, count=5, name=None):
+        """Le tracce più lente nel buffer, eventualmente solo quelle con un certo nome"""
+        with self.lock:
+            traces = [trace for trace in self.traces if name is None or trace.name == name]
+        return sorted(traces, key=lambda trace: trace.total, reverse=True)[:count]
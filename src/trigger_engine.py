@@ -0,0 +1,122 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+class TriggerEngine:
+    """Regole parola chiave -> risposta lette da un file JSON e compilate in una regex per chat.
+
+    Ogni regola ha la forma::
+
+        {"keywords": ["gaetano", "gae"], "reply": "Gae scem8",
+         "whole_word": true, "case_sensitive": false, "chats": []}
+
+    ``chats`` vuoto significa tutte le chat. Il file viene ricaricato quando cambia il suo mtime.
+    Per ogni gruppo di chat le regole valide lì sono compilate in una regex a parte: un messaggio
+    senza trigger viene esaminato con una sola passata, qualunque sia il numero di regole.
+    """
+
+    def __init__(self, filepath="data/triggers.json", default_rules=None, reload_interval=5.0):
+        """Inizializza il motore; default_rules si usa se il file non esiste"""
+        self.filepath = filepath
+        self.default_rules = default_rules or []
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.last_check = 0.0
+        # chat_id (stringa), o None per le chat senza regole dedicate -> (regole, regex, regex per regola)
+        self.compiled = {None: ([], None, [])}
+        self._load()
+
+    def _rule_pattern(self, rule):
+        keywords = [keyword for keyword in rule.get("keywords", []) if keyword]
+        # Le parole più lunghe per prime, così "gaetano" vince su "gae"
+        alternatives = "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True))
+        if rule.get("whole_word", True):
+            # Non \b: deve valere anche per parole che iniziano o finiscono con simboli ("c++", "!ping")
+            alternatives = rf"(?<!\w)(?:{alternatives})(?!\w)"
+        if not rule.get("case_sensitive", False):
+            alternatives = f"(?i:{alternatives})"
+        return alternatives
+
+    def _compile_scope(self, rules, sources):
+        """Compila le regole di una chat in una regex con un gruppo nominato per regola"""
+        groups = [f"(?P<r{index}>{source})" for index, source in enumerate(sources)]
+        pattern = re.compile("|".join(groups)) if groups else None
+        return rules, pattern, [re.compile(source) for source in sources]
+
+    def _compile(self, rules):
+        """Compila le regole per chat: una regex per ogni chat citata nelle regole, più una per le altre"""
+        valid_rules = []
+        for rule in rules:
+            keywords = [keyword for keyword in rule.get("keywords", []) if keyword]
+            if not keywords or not rule.get("reply"):
+                log.warning("Regola di trigger ignorata (servono keywords e reply): %s", rule)
+                continue
+            # Gli id delle chat nel file possono essere numeri o stringhe
+            valid_rules.append((rule, self._rule_pattern(rule), {str(chat) for chat in rule.get("chats") or []}))
+        scoped_chats = set().union(*(chats for _, _, chats in valid_rules))
+        compiled = {}
+        for chat_id in scoped_chats | {None}:
+            scope = [(rule, source) for rule, source, chats in valid_rules if not chats or chat_id in chats]
+            compiled[chat_id] = self._compile_scope([rule for rule, _ in scope], [source for _, source in scope])
+        return len(valid_rules), compiled
+
+    def _load(self):
+        try:
+            if os.path.exists(self.filepath):
+                mtime = os.path.getmtime(self.filepath)
+                with open(self.filepath, "r", encoding="utf-8") as f:
+                    rules = json.load(f)
+            else:
+                log.warning("⚠️ File %s non trovato. Uso regole predefinite.", self.filepath)
+                mtime = None
+                rules = self.default_rules
+            rule_count, compiled = self._compile(rules)
+        except (json.JSONDecodeError, re.error) as e:
+            # Un file modificato male non cancella le regole già attive
+            log.error("❌ Errore nel caricamento dei trigger da %s: %s", self.filepath, e)
+            self.mtime = os.path.getmtime(self.filepath) if os.path.exists(self.filepath) else None
+            return
+        self.compiled = compiled
+        self.mtime = mtime
+        log.info("Caricate %d regole di trigger", rule_count)
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if now - self.last_check < self.reload_interval:
+            return
+        with self.lock:
+            if now - self.last_check < self.reload_interval:
+                return
+            self.last_check = now
+            mtime = os.path.getmtime(self.filepath) if os.path.exists(self.filepath) else None
+            if mtime != self.mtime:
+                self._load()
+
+    def match(self, text, chat_id=None):
+        """Restituisce le regole attivate dal testo (una volta ciascuna, in ordine di apparizione)"""
+        if not text:
+            return []
+        self._reload_if_changed()
+        compiled = self.compiled
+        rules, pattern, rule_patterns = compiled.get(str(chat_id), compiled[None])
+        if pattern is None:
+            return []
+        positions = {}  # indice della regola -> posizione della prima occorrenza
+        for found in pattern.finditer(text):
+            positions.setdefault(int(found.lastgroup[1:]), found.start())
+        if not positions:
+            return []
+        # Nella regex unica un'occorrenza va a una sola regola: se due regole condividono
+        # una parola, le altre si cercano una per una (solo per i messaggi con un trigger)
+        for index, rule_pattern in enumerate(rule_patterns):
+            if index not in positions:
+                found = rule_pattern.search(text)
+                if found:
+                    positions[index] = found.start()
+        return [rules[index] for index in sorted(positions, key=lambda index: (positions[index], index))]
@@ -0,0 +1,127 @@
+"""Registro append-only dell'uso del modello, dalle statistiche restituite da Ollama.
+
+Report da riga di comando (dalla cartella src):
+    python usage_ledger.py --by method --since 24h
+    python usage_ledger.py --by chat,priority --since 7d --top 20
+    python usage_ledger.py --path data/shard-*/usage_ledger.jsonl   # con lo sharding
+"""
+import os
+import json
+import time
+import argparse
+import threading
+from datetime import datetime
+
+# Campi compatti di ogni riga del registro
+#   t: istante (epoch s), m: metodo, c: chat_id, model: modello, p: priorità
+#   pe/e: token di prompt/generati, pd/ed/ld: ms di valutazione prompt, generazione e caricamento
+ROLLUP_KEYS = {
+    "chat": lambda entry: entry.get("c"),
+    "method": lambda entry: entry.get("m"),
+    "model": lambda entry: entry.get("model"),
+    "priority": lambda entry: entry.get("p"),
+    "hour": lambda entry: datetime.fromtimestamp(entry["t"]).strftime("%Y-%m-%d %H:00"),
+    "day": lambda entry: datetime.fromtimestamp(entry["t"]).strftime("%Y-%m-%d"),
+}
+
+
+def _ms(result, key):
+    # Ollama riporta le durate in nanosecondi
+    return round(result.get(key, 0) / 1e6, 1)
+
+
+class UsageLedger:
+    """Registra una riga JSON per ogni chiamata al modello e ne calcola i riepiloghi.
+
+    Ogni processo scrive solo in ``path`` (il lock vale dentro il processo); i riepiloghi leggono
+    ``read_paths``, per esempio i registri di tutti gli shard.
+    """
+
+    def __init__(self, path="data/usage_ledger.jsonl", read_paths=None):
+        self.path = path
+        self.read_paths = list(read_paths) if read_paths else [path]
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def record(self, method, chat_id, model, priority, result):
+        """Aggiunge al registro le statistiche di una risposta di /api/chat"""
+        entry = {
+            "t": int(time.time()),
+            "m": method,
+            "c": chat_id,
+            "model": model,
+            "p": priority,
+            "pe": result.get("prompt_eval_count", 0),
+            "pd": _ms(result, "prompt_eval_duration"),
+            "e": result.get("eval_count", 0),
+            "ed": _ms(result, "eval_duration"),
+            "ld": _ms(result, "load_duration"),
+        }
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def entries(self, since=None):
+        """Legge le righe dei registri, opzionalmente solo quelle dopo l'istante ``since``"""
+        for path in self.read_paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if since is None or entry["t"] >= since:
+                        yield entry
+
+    def rollup(self, by=("method",), since=None):
+        """Totali per combinazione delle chiavi ``by`` (chat, method, model, priority, hour, day)"""
+        totals = {}
+        for entry in self.entries(since):
+            key = tuple(ROLLUP_KEYS[name](entry) for name in by)
+            total = totals.setdefault(key, {"calls": 0, "prompt_tokens": 0, "eval_tokens": 0, "gpu_ms": 0.0})
+            total["calls"] += 1
+            total["prompt_tokens"] += entry.get("pe", 0)
+            total["eval_tokens"] += entry.get("e", 0)
+            total["gpu_ms"] += entry.get("pd", 0) + entry.get("ed", 0) + entry.get("ld", 0)
+        return totals
+
+    def report(self, by=("method",), since=None, top=None):
+        """Tabella testuale dei totali, ordinata per tempo GPU"""
+        totals = self.rollup(by, since)
+        if not totals:
+            return "Nessuna chiamata registrata."
+        grand_total = sum(total["gpu_ms"] for total in totals.values()) or 1.0
+        rows = sorted(totals.items(), key=lambda item: item[1]["gpu_ms"], reverse=True)
+        if top:
+            rows = rows[:top]
+        lines = [f"{' / '.join(by)}: chiamate, token prompt, token generati, tempo GPU"]
+        for key, total in rows:
+            label = " / ".join(str(value) for value in key)
+            lines.append(
+                f"- {label}: {total['calls']}, {total['prompt_tokens']}, {total['eval_tokens']}, "
+                f"{total['gpu_ms'] / 1000:.1f} s ({100 * total['gpu_ms'] / grand_total:.0f}%)"
+            )
+        return "\n".join(lines)
+
+
+def parse_since(value):
+    """Converte una durata come 30m, 24h o 7d nell'istante di inizio corrispondente"""
+    if not value:
+        return None
+    units = {"m": 60, "h": 3600, "d": 86400}
+    return int(time.time() - float(value[:-1]) * units[value[-1]]) if value[-1] in units else int(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Riepilogo del registro di uso del modello")
+    parser.add_argument("--path", nargs="+", default=["data/usage_ledger.jsonl"], help="uno o più registri")
+    parser.add_argument("--by", default="method", help="chiavi separate da virgole: " + ", ".join(ROLLUP_KEYS))
+    parser.add_argument("--since", help="solo le chiamate recenti, es. 30m, 24h, 7d")
+    parser.add_argument("--top", type=int, help="mostra solo le prime N righe")
+    args = parser.parse_args()
+    print(UsageLedger(args.path[0], args.path).report(tuple(args.by.split(",")), parse_since(args.since), args.top))
@@ -0,0 +1,256 @@
+import os
+import json
+import logging
+import queue
+import threading
+
+from backfill import BackfillState, message_key
+
+try:
+    import numpy as np
+except ImportError:  # numpy è opzionale: senza, l'indice semantico resta disattivato
+    np = None
+
+log = logging.getLogger(__name__)
+
+class EmbeddingIndex:
+    """Indice vettoriale per chat: embedding dei messaggi su disco e ricerca per similarità coseno.
+
+    Per ogni chat vengono mantenuti tre file nella directory dell'indice:
+    - ``<chat_id>.f32``: matrice float32 (righe normalizzate) in append, letta via memory map
+    - ``<chat_id>.jsonl``: i metadati dei messaggi, una riga per ogni riga della matrice
+    - ``<chat_id>.json``: dimensione e modello degli embedding
+    Le chat la cui cronologia è già stata indicizzata sono elencate in ``backfill.json``.
+    """
+
+    def __init__(self, ai_service, index_dir="data/vectors", batch_size=32):
+        """Inizializza l'indice e avvia il thread che calcola gli embedding in background"""
+        self.ai_service = ai_service
+        self.index_dir = index_dir
+        self.batch_size = batch_size
+        self.available = np is not None
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.chat_locks = {}
+        self.metadata = {}  # chat_id -> lista dei messaggi indicizzati
+        self.keys = {}  # chat_id -> chiavi dei messaggi indicizzati, per non indicizzarli due volte
+        self.failed_chats = set()  # chat con embedding falliti dall'inizio del loro backfill
+        self.matrices = {}  # chat_id -> (numero di righe, memmap)
+        self.dims = {}
+
+        if not self.available:
+            log.warning("numpy non installato: indice semantico disattivato")
+            return
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.backfill = BackfillState(os.path.join(self.index_dir, "backfill.json"))
+        self.worker = threading.Thread(target=self._embedding_worker, daemon=True)
+        self.worker.start()
+
+    def _paths(self, chat_id):
+        base = os.path.join(self.index_dir, str(chat_id))
+        return base + ".f32", base + ".jsonl", base + ".json"
+
+    def _chat_lock(self, chat_id):
+        with self.lock:
+            if chat_id not in self.chat_locks:
+                self.chat_locks[chat_id] = threading.Lock()
+            return self.chat_locks[chat_id]
+
+    def _load_chat(self, chat_id):
+        """Carica metadati e dimensione di una chat (da chiamare col lock della chat)"""
+        if chat_id in self.metadata:
+            return
+        vectors_file, meta_file, header_file = self._paths(chat_id)
+        entries = []
+        if os.path.exists(header_file):
+            with open(header_file, "r", encoding="utf-8") as f:
+                self.dims[chat_id] = json.load(f)["dim"]
+            if os.path.exists(meta_file):
+                with open(meta_file, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entries.append(json.loads(line))
+                        except json.JSONDecodeError:
+                            continue
+            # Se un'append è stata interrotta, allinea metadati e matrice
+            row_bytes = 4 * self.dims[chat_id]
+            rows = os.path.getsize(vectors_file) // row_bytes if os.path.exists(vectors_file) else 0
+            entries = entries[:rows]
+            if rows > len(entries):
+                with open(vectors_file, "r+b") as f:
+                    f.truncate(len(entries) * row_bytes)
+        self.metadata[chat_id] = entries
+        self.keys[chat_id] = {message_key(entry) for entry in entries}
+
+    def _matrix(self, chat_id):
+        """Restituisce la matrice della chat mappata in memoria (da chiamare col lock della chat)"""
+        rows = len(self.metadata[chat_id])
+        cached = self.matrices.get(chat_id)
+        if cached and cached[0] == rows:
+            return cached[1]
+        vectors_file = self._paths(chat_id)[0]
+        matrix = np.memmap(vectors_file, dtype=np.float32, mode="r", shape=(rows, self.dims[chat_id]))
+        self.matrices[chat_id] = (rows, matrix)
+        return matrix
+
+    def size(self, chat_id):
+        """Numero di messaggi indicizzati per una chat"""
+        if not self.available:
+            return 0
+        chat_id = str(chat_id)
+        with self._chat_lock(chat_id):
+            self._load_chat(chat_id)
+            return len(self.metadata[chat_id])
+
+    def is_backfilled(self, chat_id):
+        """Indica se la cronologia della chat è già stata indicizzata (non solo i messaggi nuovi)"""
+        return self.available and self.backfill.is_done(chat_id)
+
+    def enqueue(self, log_entry):
+        """Accoda un messaggio registrato da MessageLogger per il calcolo dell'embedding"""
+        if not self.available:
+            return
+        text = log_entry.get("text")
+        if not text or text.startswith('/') or log_entry.get("chat_id") is None:
+            return
+        self.pending.put({
+            # Le chiavi di user_data possono essere stringhe (da JSON) o interi (da Telegram)
+            "chat_id": str(log_entry["chat_id"]),
+            "timestamp": log_entry.get("timestamp", ""),
+            "user_id": log_entry.get("user_id", ""),
+            "user_name": log_entry.get("user_first_name", ""),
+            "username": log_entry.get("username", ""),
+            "text": text
+        })
+
+    def enqueue_history(self, chat_id, chat_messages):
+        """Accoda la cronologia esistente di una chat (formato get_chat_message_history).
+
+        I messaggi già indicizzati vengono saltati in ``_append``; dopo l'ultimo messaggio la chat
+        viene segnata come completa, se nessun embedding è fallito nel frattempo.
+        """
+        if not self.available:
+            return
+        with self.lock:
+            self.failed_chats.discard(str(chat_id))
+        for msg in chat_messages:
+            self.enqueue({
+                "chat_id": chat_id,
+                "timestamp": msg.get("timestamp", ""),
+                "user_id": msg.get("user_id", ""),
+                "user_first_name": msg.get("user_name", ""),
+                "username": msg.get("username", ""),
+                "text": msg.get("text", "")
+            })
+        watermark = max((msg.get("timestamp", "") for msg in chat_messages), default="")
+        self.pending.put({"chat_id": str(chat_id), "backfill_watermark": watermark})
+
+    def _embedding_worker(self):
+        """Thread che raccoglie i messaggi in coda a blocchi e ne calcola gli embedding"""
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            # Le fini dei backfill si gestiscono dopo i messaggi che le precedono
+            markers = [entry for entry in batch if "backfill_watermark" in entry]
+            batch = [entry for entry in batch if "backfill_watermark" not in entry]
+
+            vectors = []
+            if batch:
+                try:
+                    vectors = self.ai_service.embed_texts([entry["text"] for entry in batch])
+                except Exception as e:
+                    log.error("Errore nel calcolo degli embedding (%d messaggi scartati): %s", len(batch), e)
+                    with self.lock:
+                        self.failed_chats.update(entry["chat_id"] for entry in batch)
+                    batch = []
+
+            by_chat = {}
+            for entry, vector in zip(batch, vectors):
+                by_chat.setdefault(entry.pop("chat_id"), []).append((entry, vector))
+            for chat_id, items in by_chat.items():
+                try:
+                    self._append(chat_id, items)
+                except Exception as e:
+                    log.error("Errore nel salvataggio degli embedding per chat %s: %s", chat_id, e)
+                    with self.lock:
+                        self.failed_chats.add(chat_id)
+
+            for marker in markers:
+                self._finish_backfill(marker["chat_id"], marker["backfill_watermark"])
+
+    def _finish_backfill(self, chat_id, watermark):
+        with self.lock:
+            failed = chat_id in self.failed_chats
+            self.failed_chats.discard(chat_id)
+        if failed:
+            log.warning("Backfill semantico incompleto per chat %s: verrà ripetuto al prossimo avvio", chat_id)
+            return
+        self.backfill.mark_done(chat_id, watermark)
+        log.info("Backfill semantico completato per chat %s: %d messaggi indicizzati", chat_id, self.size(chat_id))
+
+    def _append(self, chat_id, items):
+        """Aggiunge vettori normalizzati e metadati ai file della chat"""
+        vectors = np.asarray([vector for _, vector in items], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.maximum(norms, 1e-12)
+        vectors_file, meta_file, header_file = self._paths(chat_id)
+
+        with self._chat_lock(chat_id):
+            self._load_chat(chat_id)
+            # Un messaggio può arrivare sia dal listener sia dalla cronologia: si indicizza una volta
+            keys = self.keys[chat_id]
+            keep = []
+            for index, (entry, _) in enumerate(items):
+                key = message_key(entry)
+                if key not in keys:
+                    keys.add(key)
+                    keep.append(index)
+            if not keep:
+                return
+            items = [items[index] for index in keep]
+            vectors = vectors[keep]
+            dim = self.dims.get(chat_id)
+            if dim is None:
+                dim = vectors.shape[1]
+                with open(header_file, "w", encoding="utf-8") as f:
+                    json.dump({"dim": dim, "model": self.ai_service.embedding_model}, f)
+                self.dims[chat_id] = dim
+            elif dim != vectors.shape[1]:
+                raise ValueError(f"dimensione embedding {vectors.shape[1]} diversa da quella dell'indice ({dim})")
+
+            # Prima i vettori, poi i metadati: le righe lette sono sempre complete
+            with open(vectors_file, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(meta_file, "a", encoding="utf-8") as f:
+                for entry, _ in items:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.metadata[chat_id].extend(entry for entry, _ in items)
+
+    def search(self, chat_id, query, k=5):
+        """Restituisce i k messaggi passati della chat più simili alla domanda"""
+        if not self.available or not query:
+            return []
+        chat_id = str(chat_id)
+        if self.size(chat_id) == 0:
+            return []
+
+        query_vector = np.asarray(self.ai_service.embed_texts([query])[0], dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+
+        with self._chat_lock(chat_id):
+            if query_vector.shape[0] != self.dims[chat_id]:
+                log.warning("Embedding della domanda incompatibile con l'indice della chat %s", chat_id)
+                return []
+            matrix = self._matrix(chat_id)
+            entries = self.metadata[chat_id]
+            # Le righe sono normalizzate: il prodotto scalare è la similarità coseno
+            scores = matrix @ query_vector
+            k = min(k, len(entries))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [dict(entries[i], score=float(scores[i])) for i in top]
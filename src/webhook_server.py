@@ -0,0 +1,143 @@
+import hmac
+import json
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import telebot
+
+log = logging.getLogger(__name__)
+
+# Aggiornamenti più grandi di così non arrivano da Telegram: li rifiutiamo senza leggerli
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookServer:
+    """Ricevitore HTTP per i webhook di Telegram.
+
+    Ogni POST viene validato (percorso e header ``X-Telegram-Bot-Api-Secret-Token``), accodato e
+    confermato subito con 200; un thread separato passa gli aggiornamenti a
+    ``bot.process_new_updates``, quindi agli stessi handler usati in polling.
+    ``GET /health`` risponde 503 finché l'evento ``ready`` (il riscaldamento del bot) non è impostato.
+    """
+
+    def __init__(self, bot, webhook_url, secret=None, listen="0.0.0.0", port=8443, ready=None):
+        """Inizializza il server; webhook_url è l'indirizzo pubblico registrato su Telegram"""
+        self.bot = bot
+        self.webhook_url = webhook_url
+        self.path = urlparse(webhook_url).path or "/"
+        self.secret = secret
+        self.listen = listen
+        self.port = port
+        self.ready = ready
+        self.updates = queue.Queue()
+        # Aggiornati dai thread di ThreadingHTTPServer
+        self.counts_lock = threading.Lock()
+        self.received_count = 0
+        self.rejected_count = 0
+        self.httpd = None
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.handle_post(self)
+
+            def do_GET(self):
+                # Utile per i controlli di salute del proxy davanti al bot
+                if self.path != "/health":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                ready = server.ready is None or server.ready.is_set()
+                body = b"ok" if ready else b"warming up"
+                self.send_response(200 if ready else 503)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug("%s - %s", self.address_string(), format % args)
+
+        return Handler
+
+    def handle_post(self, request):
+        """Valida e accoda un aggiornamento; la risposta parte prima dell'elaborazione"""
+        if request.path != self.path:
+            request.send_response(404)
+            request.end_headers()
+            return
+        # compare_digest accetta stringhe solo ASCII: un'intestazione con altri caratteri va rifiutata, non fallire
+        received_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode("utf-8", "surrogatepass")
+        if self.secret and not hmac.compare_digest(received_secret, self.secret.encode("utf-8")):
+            with self.counts_lock:
+                self.rejected_count += 1
+            log.warning("Webhook rifiutato da %s: secret token non valido", request.client_address[0])
+            request.send_response(403)
+            request.end_headers()
+            return
+        try:
+            length = int(request.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = 0
+        if length <= 0 or length > MAX_BODY_SIZE:
+            request.send_response(413 if length > MAX_BODY_SIZE else 400)
+            request.end_headers()
+            return
+        try:
+            update = json.loads(request.rfile.read(length))
+        except (ValueError, UnicodeDecodeError):
+            request.send_response(400)
+            request.end_headers()
+            return
+        with self.counts_lock:
+            self.received_count += 1
+        self.updates.put(update)
+        request.send_response(200)
+        request.send_header("Content-Length", "0")
+        request.end_headers()
+
+    def _process_updates(self):
+        while True:
+            raw_update = self.updates.get()
+            try:
+                self.bot.process_new_updates([telebot.types.Update.de_json(raw_update)])
+            except Exception as e:
+                log.exception("Errore nell'elaborazione dell'aggiornamento %s: %s", raw_update.get("update_id"), e)
+
+    def register(self):
+        """Registra il webhook su Telegram, con il secret token se configurato"""
+        # set_webhook di questa versione di telebot non supporta secret_token
+        params = {"url": self.webhook_url}
+        if self.secret:
+            params["secret_token"] = self.secret
+        telebot.apihelper._make_request(self.bot.token, "setWebhook", params=params, method="post")
+        log.info("Webhook registrato su %s", self.webhook_url)
+
+    def unregister(self):
+        try:
+            self.bot.remove_webhook()
+            log.info("Webhook rimosso")
+        except Exception as e:
+            log.error("Errore nella rimozione del webhook: %s", e)
+
+    def serve_forever(self, register=True):
+        """Avvia il server HTTP e lo tiene attivo fino a KeyboardInterrupt"""
+        if not self.secret:
+            log.warning("WEBHOOK_SECRET non impostato: le richieste al webhook non vengono autenticate")
+        threading.Thread(target=self._process_updates, name="WebhookUpdates", daemon=True).start()
+        self.httpd = ThreadingHTTPServer((self.listen, self.port), self._make_handler())
+        if register:
+            self.register()
+        log.info("Ricevitore webhook in ascolto su %s:%d%s", self.listen, self.port, self.path)
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if register:
+                self.unregister()
+            self.httpd.server_close()
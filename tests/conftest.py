@@ -0,0 +1,5 @@
+import os
+import sys
+
+# I moduli del bot sono in src/ e si importano per nome, come fa bot.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
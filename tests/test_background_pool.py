@@ -0,0 +1,31 @@
+import threading
+
+from background_pool import BackgroundPool
+
+
+def test_run_pass_returns_results_per_chat():
+    pool = BackgroundPool("test", concurrency=2, timeout=5)
+    summary, results = pool.run_pass([(1, lambda x: x * 2, (3,)), (2, lambda x: x + 1, (3,))])
+    assert results == {1: 6, 2: 4}
+    assert summary["ok"] == 2 and summary["busy"] == 0
+
+
+def test_chat_over_timeout_is_not_run_twice():
+    pool = BackgroundPool("test", concurrency=2, timeout=0.1)
+    release = threading.Event()
+    calls = []
+
+    def slow(chat_id):
+        calls.append(chat_id)
+        release.wait(10)
+        return chat_id
+
+    summary, _ = pool.run_pass([(1, slow, (1,))])
+    assert summary["timeouts"] == 1
+    # La chat 1 è ancora in corso: il passaggio successivo la salta
+    summary, results = pool.run_pass([(1, slow, (1,)), (2, lambda: "ok", ())])
+    assert summary["busy"] == 1
+    assert results == {2: "ok"}
+    assert calls == [1]
+    release.set()
+    pool.executor.shutdown(wait=True)
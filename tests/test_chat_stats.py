@@ -0,0 +1,70 @@
+import json
+import types
+from datetime import datetime, timedelta
+
+from chat_stats import ChatStats
+from logger import MessageLogger
+
+
+def log_entry(moment, text="ciao", user_id=1, name="Anna", chat_id=-100, message_id=1):
+    return {"timestamp": moment.isoformat(), "chat_id": chat_id, "user_id": user_id,
+            "user_first_name": name, "text": text, "message_id": message_id}
+
+
+def test_record_updates_counters(tmp_path):
+    stats = ChatStats(str(tmp_path / "chat_stats.json"))
+    now = datetime.now().replace(hour=21)
+    stats.record(log_entry(now, "ciao"))
+    stats.record(log_entry(now, "/stats@bot 7d", message_id=2))
+    stats.record(log_entry(now, "eccomi", user_id=2, name="Bo", message_id=3))
+
+    summary = stats.chat_summary(-100)
+    assert summary["messages"] == 3
+    assert summary["users"] == 2
+    assert summary["hours"][21] == 3
+    assert summary["weekdays"][now.weekday()] == 3
+    assert summary["commands"] == {"/stats": 1}
+    assert stats.top_users(-100, 1)[0][:3] == (1, "Anna", 2)
+    assert stats.recent_messages(-100) == 3
+    assert stats.active_chats() == [(-100, 3)]
+
+
+def test_daily_ring_forgets_days_outside_the_window(tmp_path):
+    stats = ChatStats(str(tmp_path / "chat_stats.json"), days=7)
+    now = datetime.now()
+    stats.record(log_entry(now - timedelta(days=10)))
+    stats.record(log_entry(now - timedelta(days=1)))
+    stats.record(log_entry(now))
+    assert stats.recent_messages(-100, days=7) == 2
+    assert [count for _, count in stats.messages_per_day(-100, 3)] == [0, 1, 1]
+    assert stats.chat_summary(-100)["messages"] == 3
+
+
+def test_save_and_reload_keep_integer_ids(tmp_path):
+    path = str(tmp_path / "chat_stats.json")
+    stats = ChatStats(path)
+    stats.record(log_entry(datetime.now()))
+    stats.save()
+    reloaded = ChatStats(path)
+    assert reloaded.loaded
+    assert reloaded.top_users(-100)[0][0] == 1
+    assert reloaded.first_text_message_id(-100) == 1
+
+
+def test_backfill_streams_logs_and_skips_entries_recorded_live(tmp_path):
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+    old = datetime.now() - timedelta(days=2)
+    with open(log_dir / "telegram_log_2026-01-01.jsonl", "w", encoding="utf-8") as f:
+        for i in range(5):
+            f.write(json.dumps(log_entry(old + timedelta(minutes=i), message_id=i + 1)) + "\n")
+        f.write("riga non valida\n")
+
+    stats = ChatStats(str(tmp_path / "chat_stats.json"))
+    # Registrato dal listener dopo l'avvio: il backfill non lo conta di nuovo
+    stats.record(log_entry(datetime.now(), message_id=6))
+    entries = MessageLogger(str(log_dir)).iter_log_entries()
+    assert isinstance(entries, types.GeneratorType)
+    assert stats.backfill(entries) == 5
+    assert stats.chat_summary(-100)["messages"] == 6
+    assert stats.first_text_message_id(-100) == 1
@@ -0,0 +1,59 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import telebot
+
+from chat_workers import ChatWorkerPool
+
+
+def test_override_point_exists_in_pinned_telebot():
+    # ChatOrderedTeleBot ridefinisce questo metodo privato
+    assert callable(getattr(telebot.TeleBot, "_exec_task", None))
+
+
+def test_messages_of_a_chat_run_in_order():
+    pool = ChatWorkerPool(num_workers=2, max_chat_queue=100)
+    seen = []
+    done = threading.Event()
+    for i in range(20):
+        pool.submit(1, seen.append, i)
+    pool.submit(1, lambda: done.set())
+    assert done.wait(5)
+    assert seen == list(range(20))
+
+
+def blocked_pool(overflow):
+    pool = ChatWorkerPool(num_workers=1, max_chat_queue=2, overflow=overflow)
+    release = threading.Event()
+    started = threading.Event()
+    pool.submit(1, lambda: (started.set(), release.wait(5)))
+    assert started.wait(5)
+    return pool, release
+
+
+def test_block_waits_for_room_instead_of_dropping():
+    pool, release = blocked_pool("block")
+    seen = []
+    pool.submit(1, seen.append, 1)
+    pool.submit(1, seen.append, 2)
+    submitted = threading.Event()
+    threading.Thread(target=lambda: (pool.submit(1, seen.append, 3), submitted.set()), daemon=True).start()
+    assert not submitted.wait(0.2)
+    release.set()
+    assert submitted.wait(5)
+    deadline = time.time() + 5
+    while len(seen) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert seen == [1, 2, 3]
+    assert pool.dropped_count == 0
+
+
+def test_drop_oldest_logs_the_dropped_message(caplog):
+    pool, release = blocked_pool("drop_oldest")
+    seen = []
+    for message_id in (1, 2, 3):
+        pool.submit(1, seen.append, SimpleNamespace(message_id=message_id, from_user=SimpleNamespace(id=9)))
+    assert pool.dropped_count == 1
+    assert "messaggio 1 da 9" in caplog.text
+    release.set()
@@ -0,0 +1,87 @@
+import threading
+import time
+
+from coalescer import RequestCoalescer
+
+
+def request(user_id, received_at=None):
+    return {"user_id": user_id, "received_at": received_at or time.time()}
+
+
+def test_requests_in_window_are_answered_together():
+    batches = []
+    done = threading.Event()
+
+    def process(chat_id, batch):
+        batches.append((chat_id, [r["user_id"] for r in batch]))
+        done.set()
+
+    coalescer = RequestCoalescer(process, window=0.2)
+    coalescer.submit(1, request(10))
+    coalescer.submit(1, request(11))
+    assert done.wait(5)
+    assert batches == [(1, [10, 11])]
+
+
+def test_requests_during_generation_go_to_next_batch_without_second_thread():
+    batches = []
+    started = threading.Event()
+    release = threading.Event()
+    active = []
+
+    def process(chat_id, batch):
+        active.append(chat_id)
+        # Mai due generazioni contemporanee per la stessa chat
+        assert active.count(chat_id) == 1
+        batches.append([r["user_id"] for r in batch])
+        started.set()
+        release.wait(5)
+        active.remove(chat_id)
+
+    coalescer = RequestCoalescer(process, window=0.05)
+    coalescer.submit(1, request(10))
+    assert started.wait(5)
+    coalescer.submit(1, request(11))
+    coalescer.submit(1, request(12))
+    assert coalescer.pending_count(1) == 2
+    release.set()
+    deadline = time.time() + 5
+    while (coalescer.busy or len(batches) < 2) and time.time() < deadline:
+        time.sleep(0.01)
+    assert batches == [[10], [11, 12]]
+    assert not coalescer.busy
+
+
+def test_stale_request_superseded_by_same_user_is_dropped():
+    coalescer = RequestCoalescer(lambda chat_id, batch: None, max_age=60)
+    now = time.time()
+    batch = [request(10, now - 120), request(11, now - 120), request(10, now)]
+    kept = coalescer._drop_stale(batch)
+    assert [(r["user_id"], r["received_at"]) for r in kept] == [(11, now - 120), (10, now)]
+
+
+def test_generations_across_chats_are_bounded_by_the_executor():
+    from concurrent.futures import ThreadPoolExecutor
+
+    lock = threading.Lock()
+    running = []
+    peak = []
+    finished = []
+
+    def process(chat_id, batch):
+        with lock:
+            running.append(chat_id)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(chat_id)
+            finished.append(chat_id)
+
+    coalescer = RequestCoalescer(process, window=0.01, executor=ThreadPoolExecutor(max_workers=2))
+    for chat_id in range(8):
+        coalescer.submit(chat_id, request(chat_id))
+    deadline = time.time() + 5
+    while len(finished) < 8 and time.time() < deadline:
+        time.sleep(0.01)
+    assert sorted(finished) == list(range(8))
+    assert max(peak) <= 2
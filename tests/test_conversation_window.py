@@ -0,0 +1,34 @@
+from conversation_window import estimate_tokens, select_window
+
+
+def user_turn(text, message_id, name="Anna"):
+    return {"role": "user", "content": text, "user_info": {"first_name": name}, "message_id": message_id}
+
+
+def test_window_keeps_recent_turns_within_budget():
+    history = [user_turn("x" * 400, 1), {"role": "assistant", "content": "ok"}, user_turn("ciao", 3)]
+    messages, omitted = select_window(history, estimate_tokens("Anna: ciao") + estimate_tokens("ok"))
+    assert messages == [{"role": "user", "content": "Anna: ciao"}]
+    # Il turno troppo lungo resta fuori, la risposta del bot in testa viene scartata
+    assert omitted == 2
+
+
+def test_consecutive_user_turns_are_merged():
+    history = [user_turn("primo", 1), user_turn("secondo", 2, name="Bo")]
+    messages, omitted = select_window(history, 1000)
+    assert messages == [{"role": "user", "content": "Anna: primo\nBo: secondo"}]
+    assert omitted == 0
+
+
+def test_only_the_current_message_is_excluded_not_identical_earlier_ones():
+    history = [
+        user_turn("buongiorno", 1),
+        {"role": "assistant", "content": "buongiorno a te"},
+        user_turn("buongiorno", 3),
+    ]
+    messages, omitted = select_window(history, 1000, exclude_ids={3})
+    assert messages == [
+        {"role": "user", "content": "Anna: buongiorno"},
+        {"role": "assistant", "content": "buongiorno a te"},
+    ]
+    assert omitted == 0
@@ -0,0 +1,39 @@
+import json
+import time
+from types import SimpleNamespace
+
+from dedup import UpdateDeduplicator, update_key
+
+
+def message_update(update_id, chat_id, message_id):
+    return SimpleNamespace(update_id=update_id, message=SimpleNamespace(chat=SimpleNamespace(id=chat_id),
+                                                                         message_id=message_id))
+
+
+def test_update_key_uses_chat_and_message():
+    assert update_key(message_update(1, -5, 7)) == "-5:7"
+    assert update_key(SimpleNamespace(update_id=9, message=None)) == "u9"
+
+
+def test_duplicates_are_filtered_across_restarts(tmp_path):
+    path = str(tmp_path / "seen.jsonl")
+    dedup = UpdateDeduplicator(path)
+    first, retry, other = message_update(1, 1, 1), message_update(2, 1, 1), message_update(3, 1, 2)
+    # Un nuovo tentativo di consegna ha un altro update_id ma lo stesso messaggio
+    assert dedup.filter([first, retry, other]) == [first, other]
+    assert not dedup.is_new(first)
+    assert dedup.duplicates == 2
+    dedup.journal.close()
+
+    restarted = UpdateDeduplicator(path)
+    assert not restarted.is_new(message_update(4, 1, 2))
+    assert restarted.is_new(message_update(5, 1, 3))
+    restarted.journal.close()
+
+
+def test_expired_keys_are_forgotten(tmp_path):
+    path = tmp_path / "seen.jsonl"
+    path.write_text(json.dumps([time.time() - 7200, "1:1"]) + "\n", encoding="utf-8")
+    dedup = UpdateDeduplicator(str(path), ttl=3600)
+    assert dedup.is_new(message_update(1, 1, 1))
+    dedup.journal.close()
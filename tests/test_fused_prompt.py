@@ -0,0 +1,65 @@
+import pytest
+
+from ai_service import AIService
+
+
+@pytest.fixture
+def ai_service(tmp_path, monkeypatch):
+    # Senza i file di intercalari e appellativi si usano quelli predefiniti
+    monkeypatch.chdir(tmp_path)
+    return AIService(log_dir=str(tmp_path))
+
+
+def message(timestamp, user_name, text):
+    return {"timestamp": timestamp, "user_name": user_name, "text": text}
+
+
+def test_recent_messages_are_compact_marked_and_truncated(ai_service):
+    chat = [
+        message("2025-03-01T10:00:00", "Anna", "vecchio"),
+        message("2025-03-01T10:05:00", "Bo", "@bot  come   stai?"),
+        message("2025-03-01T10:06:00", "Anna", "x" * 30),
+    ]
+    recent = ai_service.format_recent_messages(chat, "@bot", max_messages=2, max_chars=16)
+    assert recent.splitlines() == [
+        "10:05 [AL BOT] Bo: @bot come stai?",
+        "10:06 Anna: " + "x" * 15 + "…",
+    ]
+
+
+def test_fused_layout_puts_recent_chat_in_the_user_message(ai_service):
+    system_message, messages = ai_service.build_reply_messages("che si dice?", recent_chat="10:05 Bo: ciao")
+    assert "contesto della conversazione" not in system_message
+    assert "10:05 Bo: ciao" not in system_message
+    assert len(messages) == 1
+    user_content = messages[0]["content"]
+    assert messages[0]["role"] == "user"
+    assert user_content.startswith("Oggi è ")
+    assert "Ultimi messaggi della chat" in user_content
+    assert "Messaggi passati della chat pertinenti" not in user_content
+    assert "I messaggi precedenti sono la conversazione recente" not in user_content
+    # La domanda chiude il messaggio, dopo i messaggi recenti
+    assert user_content.index("10:05 Bo: ciao") < user_content.index("Domanda: che si dice?")
+    assert user_content.endswith("Domanda: che si dice?")
+
+
+def test_summary_stays_in_the_system_prompt(ai_service):
+    system_message, messages = ai_service.build_reply_messages("e quindi?", history_analysis="Parlano di calcio.")
+    assert "Parlano di calcio." in system_message
+    assert "Oggi è" not in system_message
+    user_content = messages[0]["content"]
+    assert "Parlano di calcio." not in user_content
+    assert "Ultimi messaggi della chat" not in user_content
+
+
+def test_window_turns_precede_the_user_message(ai_service):
+    turns = [{"role": "user", "content": "Anna: ciao"}, {"role": "assistant", "content": "ciao Anna"}]
+    relevant = [message("2025-03-01T09:00:00", "Bo", "la partita è domani")]
+    system_message, messages = ai_service.build_reply_messages(
+        "quando?", relevant_messages=relevant, history_turns=turns
+    )
+    assert messages[:2] == turns
+    user_content = messages[2]["content"]
+    assert "- 2025-03-01T09:00 Bo: la partita è domani" in user_content
+    assert "I messaggi precedenti sono la conversazione recente" in user_content
+    assert "Ultimi messaggi della chat" not in user_content
@@ -0,0 +1,52 @@
+from lexical_index import BM25Index, tokenize
+
+
+def log_entry(timestamp, text, user_id=1, chat_id=-100):
+    return {"timestamp": timestamp, "chat_id": chat_id, "user_id": user_id, "user_first_name": "Anna", "text": text}
+
+
+def history_message(timestamp, text, user_id=1):
+    return {"timestamp": timestamp, "user_id": user_id, "user_name": "Anna", "username": "", "text": text}
+
+
+def test_tokenize_strips_accents_stopwords_and_final_vowel():
+    assert tokenize("Le pizze di Napoli sono già finite") == ["pizz", "napol", "finit"]
+
+
+def test_search_ranks_matching_messages(tmp_path):
+    index = BM25Index(index_dir=str(tmp_path))
+    for text in ("stasera pizza da Mario", "domani si va al mare", "la pizza di ieri era buona"):
+        index.add(log_entry("2026-10-01T10:00:00", text))
+    results = index.search(-100, "pizza", top_n=5)
+    assert {result["text"] for result in results} == {"stasera pizza da Mario", "la pizza di ieri era buona"}
+
+
+def test_message_before_backfill_does_not_skip_history(tmp_path):
+    index = BM25Index(index_dir=str(tmp_path))
+    # Un messaggio arriva durante il riscaldamento, prima del backfill della chat
+    index.add(log_entry("2026-10-02T09:00:00", "qualcuno ha visto il concerto?"))
+    assert not index.is_backfilled(-100)
+
+    history = [
+        history_message("2026-09-01T20:00:00", "la chitarra del concerto era stonata"),
+        history_message("2026-10-02T09:00:00", "qualcuno ha visto il concerto?"),
+    ]
+    assert index.build_from_history(-100, history) == 2
+    assert index.is_backfilled(-100)
+    assert any("chitarra" in result["text"] for result in index.search(-100, "chitarra"))
+
+    reloaded = BM25Index(index_dir=str(tmp_path))
+    assert reloaded.is_backfilled(-100)
+    assert len(reloaded.search(-100, "concerto", top_n=10)) == 2
+
+
+def test_live_messages_not_in_history_survive_rebuild(tmp_path):
+    index = BM25Index(index_dir=str(tmp_path))
+    history = [history_message("2026-09-01T20:00:00", "vecchio messaggio sulla montagna")]
+    # Arrivato dopo la lettura dei log ma prima della ricostruzione: non è nella cronologia
+    index.add(log_entry("2026-10-02T09:00:00", "nuovo messaggio sulla montagna"))
+    index.build_from_history(-100, history)
+
+    reloaded = BM25Index(index_dir=str(tmp_path))
+    texts = {result["text"] for result in reloaded.search(-100, "montagna", top_n=10)}
+    assert texts == {"vecchio messaggio sulla montagna", "nuovo messaggio sulla montagna"}
@@ -0,0 +1,60 @@
+import pytest
+
+import metrics
+from metrics import Counter, Gauge, Histogram, render_metrics
+
+
+@pytest.fixture
+def registry():
+    # Le metriche dei test non restano nel registro globale del bot
+    before = list(metrics.REGISTRY)
+    yield
+    metrics.REGISTRY[:] = before
+
+
+def test_counter_renders_help_type_and_escaped_labels(registry):
+    counter = Counter("test_requests_total", "Richieste di prova", ["method"])
+    counter.inc('a"b\\c')
+    counter.inc("x", amount=2)
+    assert counter.render().splitlines() == [
+        "# HELP test_requests_total Richieste di prova",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{method="a\\"b\\\\c"} 1',
+        'test_requests_total{method="x"} 2',
+    ]
+
+
+def test_unlabelled_counter_starts_at_zero(registry):
+    assert Counter("test_plain_total", "Senza etichette").render().splitlines()[-1] == "test_plain_total 0"
+
+
+def test_gauge_functions_are_read_at_render_and_failures_skipped(registry):
+    gauge = Gauge("test_depth", "Profondità", ["queue"])
+    values = iter([3, 5])
+    gauge.set_function(lambda: next(values), "send")
+    gauge.set_function(lambda: 1 / 0, "broken")
+    assert 'test_depth{queue="send"} 3' in gauge.render()
+    assert 'test_depth{queue="send"} 5' in gauge.render()
+    assert "broken" not in gauge.render()
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    histogram = Histogram("test_seconds", "Durate", ["op"], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 2):
+        histogram.observe(value, "x")
+    lines = histogram.render().splitlines()[2:]
+    assert lines == [
+        'test_seconds_bucket{op="x",le="0.1"} 1',
+        'test_seconds_bucket{op="x",le="1"} 2',
+        'test_seconds_bucket{op="x",le="+Inf"} 3',
+        'test_seconds_sum{op="x"} 2.55',
+        'test_seconds_count{op="x"} 3',
+    ]
+
+
+def test_render_metrics_includes_registered_metrics(registry):
+    Counter("test_listed_total", "Presente nell'output")
+    output = render_metrics()
+    assert output.endswith("\n")
+    assert "# TYPE test_listed_total counter" in output
+    assert "# TYPE bot_updates_received_total counter" in output
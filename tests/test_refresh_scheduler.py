@@ -0,0 +1,31 @@
+import threading
+
+from refresh_scheduler import ContextRefreshScheduler
+
+
+def test_zero_hourly_cap_means_no_cap():
+    refreshed = threading.Event()
+    scheduler = ContextRefreshScheduler(lambda chat_id: refreshed.set(), min_new_messages=1, max_per_hour=0,
+                                        poll_interval=0.05)
+    assert scheduler.bucket is None
+    scheduler.start()
+    scheduler.record({"chat_id": 1, "text": "ciao"})
+    assert refreshed.wait(5)
+    assert scheduler.thread.is_alive()
+
+
+def test_busy_chat_is_refreshed_after_threshold():
+    done = []
+    event = threading.Event()
+
+    def refresh(chat_id):
+        done.append(chat_id)
+        event.set()
+
+    scheduler = ContextRefreshScheduler(refresh, min_new_messages=2, max_per_hour=10, poll_interval=0.05)
+    scheduler.start()
+    scheduler.record({"chat_id": 7, "text": "a"})
+    assert not event.wait(0.2)
+    scheduler.record({"chat_id": 7, "text": "b"})
+    assert event.wait(5)
+    assert done == [7]
@@ -0,0 +1,65 @@
+import threading
+import time
+
+import telebot
+
+from send_queue import SendDispatcher, TokenBucket
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = bucket.updated
+    bucket.consume(now)
+    bucket.consume(now)
+    assert bucket.wait_time(now) == 0.5
+    assert bucket.wait_time(now + 0.5) == 0.0
+    assert not bucket.is_full(now + 0.5)
+    assert bucket.is_full(now + 1.0)
+
+
+class FakeBot:
+    def __init__(self, fail_first=0, retry_after=0.2):
+        self.lock = threading.Lock()
+        self.sent = []
+        self.failures = fail_first
+        self.retry_after = retry_after
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise telebot.apihelper.ApiTelegramException("sendMessage", None, {
+                    "error_code": 429, "description": "Too Many Requests",
+                    "parameters": {"retry_after": self.retry_after}
+                })
+            self.sent.append((chat_id, text, time.monotonic()))
+        return text
+
+
+def test_429_requeues_at_head_and_waits_retry_after():
+    bot = FakeBot(fail_first=1, retry_after=0.2)
+    dispatcher = SendDispatcher(bot, global_rate=100, chat_rate=100, workers=2)
+    start = time.monotonic()
+    first = dispatcher.send_message(1, "uno")
+    second = dispatcher.send_message(1, "due")
+    assert first.result(5) == "uno"
+    assert second.result(5) == "due"
+    assert [text for _, text, _ in bot.sent] == ["uno", "due"]
+    assert bot.sent[0][2] - start >= 0.2
+    assert dispatcher.throttled_count == 1
+
+
+def test_idle_chats_are_pruned():
+    bot = FakeBot()
+    dispatcher = SendDispatcher(bot, global_rate=100, chat_rate=100, group_per_minute=6000, workers=1,
+                                prune_interval=0)
+    for chat_id in (1, -2, 3):
+        dispatcher.send_message(chat_id, "ciao").result(5)
+    time.sleep(0.1)
+    # Il prossimo invio fa scattare la pulizia: restano al più i secchielli della chat appena servita
+    dispatcher.send_message(4, "ciao").result(5)
+    deadline = time.monotonic() + 5
+    while len(dispatcher.buckets) > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert set(dispatcher.buckets) <= {4}
+    assert not dispatcher.blocked_until
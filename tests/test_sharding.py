@@ -0,0 +1,45 @@
+import json
+
+from sharding import ShardRouter, shard_for, split_existing_data, update_chat_id
+
+
+def test_update_chat_id_for_messages_and_callbacks():
+    assert update_chat_id({"update_id": 1, "message": {"chat": {"id": -100}, "from": {"id": 7}}}) == -100
+    assert update_chat_id({"update_id": 2, "callback_query": {"from": {"id": 7}, "message": {"chat": {"id": 5}}}}) == 5
+    assert update_chat_id({"update_id": 3, "inline_query": {"from": {"id": 7}}}) == 7
+    assert update_chat_id({"update_id": 4}) == 0
+
+
+def test_shard_for_is_stable_and_in_range():
+    assert shard_for(-1001234567890, 4) == shard_for(-1001234567890, 4)
+    assert all(0 <= shard_for(chat_id, 3) < 3 for chat_id in (-100, 0, 1, 42, 10 ** 12))
+
+
+def test_route_reports_full_queue_instead_of_dropping():
+    router = ShardRouter(1, queue_size=1, put_timeout=0.1)
+    update = {"update_id": 1, "message": {"chat": {"id": 1}}}
+    assert router.route(update)
+    assert not router.route(dict(update, update_id=2))
+    assert router.routed_count == [1]
+    assert router.full_count == 1
+    assert router.queues[0].get(timeout=5) == update
+
+
+def test_split_existing_data_moves_indexes_to_shard_dirs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bm25 = tmp_path / "data" / "bm25"
+    bm25.mkdir(parents=True)
+    chats = [-100, 1, 2, 3]
+    for chat_id in chats:
+        (bm25 / f"{chat_id}.jsonl").write_text("{}\n", encoding="utf-8")
+    (bm25 / "backfill.json").write_text(json.dumps({str(chat_id): "t" for chat_id in chats}), encoding="utf-8")
+
+    split_existing_data(2)
+
+    for chat_id in chats:
+        shard_dir = tmp_path / "data" / f"shard-{shard_for(chat_id, 2)}" / "bm25"
+        assert (shard_dir / f"{chat_id}.jsonl").exists()
+        assert json.loads((shard_dir / "backfill.json").read_text(encoding="utf-8"))[str(chat_id)] == "t"
+    for shard in range(2):
+        backfill = json.loads((tmp_path / "data" / f"shard-{shard}" / "bm25" / "backfill.json").read_text())
+        assert all(shard_for(int(chat_id), 2) == shard for chat_id in backfill)
@@ -0,0 +1,38 @@
+import tracing
+from tracing import Tracer, percentile
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.50) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 0.99) == 99
+    assert percentile([7], 0.99) == 7
+    assert percentile([], 0.5) == 0.0
+
+
+def test_stage_summary_and_spans():
+    tracer = Tracer(capacity=10)
+    for seconds in (0.1, 0.2, 0.3):
+        trace = tracer.start("risposta", 1)
+        trace.add_span("generazione", seconds)
+        tracer.finish(trace)
+    trace = tracer.start("risposta", 1)
+    tracing.set_current(trace)
+    with tracing.span("contesto"):
+        pass
+    tracing.set_current(None)
+    tracer.finish(trace)
+    tracer.finish(trace)  # una seconda chiusura non la conta due volte
+
+    summary = tracer.stage_summary()
+    assert summary["generazione"] == (3, 0.2, 0.3, 0.3)
+    assert summary["contesto"][0] == 1
+    assert summary["totale"][0] == 4
+    assert len(tracer.slowest(2)) == 2
+
+
+def test_span_without_trace_is_a_no_op():
+    tracing.set_current(None)
+    with tracing.span("niente"):
+        pass
@@ -0,0 +1,50 @@
+import json
+
+from trigger_engine import TriggerEngine
+
+
+def make_engine(tmp_path, rules):
+    path = tmp_path / "triggers.json"
+    path.write_text(json.dumps(rules), encoding="utf-8")
+    return TriggerEngine(str(path))
+
+
+def replies(engine, text, chat_id=None):
+    return [rule["reply"] for rule in engine.match(text, chat_id)]
+
+
+def test_whole_word_case_insensitive(tmp_path):
+    engine = make_engine(tmp_path, [{"keywords": ["gae"], "reply": "a"}])
+    assert replies(engine, "ciao GAE!") == ["a"]
+    assert replies(engine, "gaetano") == []
+
+
+def test_rule_of_another_chat_does_not_hide_global_rule(tmp_path):
+    engine = make_engine(tmp_path, [
+        {"keywords": ["gae"], "reply": "solo chat 1", "chats": [1]},
+        {"keywords": ["gae"], "reply": "tutte"},
+    ])
+    assert replies(engine, "gae", chat_id=2) == ["tutte"]
+    assert replies(engine, "gae", chat_id="1") == ["solo chat 1", "tutte"]
+
+
+def test_overlapping_keywords_match_every_rule_in_order(tmp_path):
+    engine = make_engine(tmp_path, [
+        {"keywords": ["ciao"], "reply": "b"},
+        {"keywords": ["gae scemo"], "reply": "c"},
+        {"keywords": ["gae"], "reply": "d"},
+    ])
+    assert replies(engine, "gae scemo, ciao") == ["c", "d", "b"]
+    assert replies(engine, "niente") == []
+
+
+def test_whole_word_keywords_with_symbols(tmp_path):
+    engine = make_engine(tmp_path, [
+        {"keywords": ["c++"], "reply": "cpp"},
+        {"keywords": ["!ping"], "reply": "pong"},
+        {"keywords": ["🍕"], "reply": "pizza"},
+    ])
+    assert replies(engine, "chi usa c++?") == ["cpp"]
+    assert replies(engine, "!ping") == ["pong"]
+    assert replies(engine, "stasera 🍕") == ["pizza"]
+    assert replies(engine, "c++11 e ab!ping") == []
@@ -0,0 +1,52 @@
+import pytest
+
+from usage_ledger import UsageLedger
+
+
+RESULT = {"prompt_eval_count": 100, "prompt_eval_duration": 2e9, "eval_count": 20, "eval_duration": 1e9}
+
+
+def test_shard_ledgers_write_apart_and_report_together(tmp_path):
+    paths = [str(tmp_path / f"shard-{shard}" / "usage_ledger.jsonl") for shard in range(2)]
+    ledgers = [UsageLedger(path, paths) for path in paths]
+    ledgers[0].record("generate_ai_response", 1, "m", "interattiva", RESULT)
+    ledgers[1].record("generate_ai_response", 2, "m", "interattiva", RESULT)
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            assert len(f.readlines()) == 1
+    assert ledgers[0].rollup(("method",))[("generate_ai_response",)]["calls"] == 2
+
+
+def test_rollup_sums_by_keys_and_filters_by_time(tmp_path, monkeypatch):
+    import usage_ledger
+
+    ledger = UsageLedger(str(tmp_path / "usage.jsonl"))
+    monkeypatch.setattr(usage_ledger.time, "time", lambda: 1000)
+    ledger.record("analyze_user_character", 1, "m", "background", RESULT)
+    monkeypatch.setattr(usage_ledger.time, "time", lambda: 5000)
+    ledger.record("generate_ai_response", 1, "m", "interattiva", RESULT)
+    ledger.record("generate_ai_response", 2, "m", "interattiva", {"eval_count": 5})
+
+    totals = ledger.rollup(("method", "priority"))
+    assert totals[("generate_ai_response", "interattiva")] == {
+        "calls": 2, "prompt_tokens": 100, "eval_tokens": 25, "gpu_ms": 3000.0
+    }
+    assert totals[("analyze_user_character", "background")]["calls"] == 1
+    assert set(ledger.rollup(("chat",), since=2000)) == {(1,), (2,)}
+    assert ledger.rollup(("chat",), since=2000)[(1,)]["calls"] == 1
+    assert "- generate_ai_response: 2, 100, 25, 3.0 s (50%)" in ledger.report(("method",)).splitlines()
+
+
+def test_parse_since(monkeypatch):
+    import usage_ledger
+    from usage_ledger import parse_since
+
+    monkeypatch.setattr(usage_ledger.time, "time", lambda: 1_000_000)
+    assert parse_since("7d") == 1_000_000 - 7 * 86400
+    assert parse_since("30m") == 1_000_000 - 1800
+    assert parse_since("1.5h") == 1_000_000 - 5400
+    assert parse_since("123") == 123
+    assert parse_since("") is None
+    for invalid in ("abc", "xd", "7w"):
+        with pytest.raises(ValueError):
+            parse_since(invalid)
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from vector_index import EmbeddingIndex
+
+
+class FakeAIService:
+    """Embedding deterministici: una dimensione per ogni parola del vocabolario"""
+    embedding_model = "fake"
+    vocabulary = ["concerto", "chitarra", "mare", "pizza"]
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+
+    def embed_texts(self, texts):
+        if self.fail_on and any(self.fail_on in text for text in texts):
+            raise RuntimeError("modello non raggiungibile")
+        return [[float(word in text) + 0.01 for word in self.vocabulary] for text in texts]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condizione non raggiunta"
+        time.sleep(0.01)
+
+
+def log_entry(timestamp, text):
+    return {"timestamp": timestamp, "chat_id": -100, "user_id": 1, "user_first_name": "Anna", "text": text}
+
+
+def history_message(timestamp, text):
+    return {"timestamp": timestamp, "user_id": 1, "user_name": "Anna", "username": "", "text": text}
+
+
+def test_message_before_backfill_does_not_skip_history(tmp_path):
+    index = EmbeddingIndex(FakeAIService(), index_dir=str(tmp_path))
+    # Un messaggio viene indicizzato durante il riscaldamento: l'indice non è più vuoto
+    index.enqueue(log_entry("2026-10-02T09:00:00", "chi viene al concerto?"))
+    wait_for(lambda: index.size(-100) == 1)
+    assert not index.is_backfilled(-100)
+
+    index.enqueue_history(-100, [
+        history_message("2026-09-01T20:00:00", "la chitarra era stonata"),
+        history_message("2026-10-02T09:00:00", "chi viene al concerto?"),
+    ])
+    wait_for(lambda: index.is_backfilled(-100))
+    # Il messaggio presente sia nel log sia nella cronologia è indicizzato una sola volta
+    assert index.size(-100) == 2
+    assert index.search(-100, "chitarra", k=1)[0]["text"] == "la chitarra era stonata"
+    assert EmbeddingIndex(FakeAIService(), index_dir=str(tmp_path)).is_backfilled(-100)
+
+
+def test_failed_embeddings_leave_backfill_incomplete(tmp_path):
+    index = EmbeddingIndex(FakeAIService(fail_on="mare"), index_dir=str(tmp_path))
+    index.enqueue_history(-100, [history_message("2026-09-01T20:00:00", "andiamo al mare")])
+    wait_for(index.pending.empty)
+    time.sleep(0.2)
+    assert not index.is_backfilled(-100)
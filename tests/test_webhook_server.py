@@ -0,0 +1,71 @@
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from webhook_server import WebhookServer
+
+
+@pytest.fixture
+def running_server():
+    servers = []
+
+    def start(**kwargs):
+        server = WebhookServer(None, "https://example.com/hook", listen="127.0.0.1", port=0, **kwargs)
+        server.httpd = ThreadingHTTPServer(("127.0.0.1", 0), server._make_handler())
+        threading.Thread(target=server.httpd.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, f"http://127.0.0.1:{server.httpd.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.httpd.shutdown()
+        server.httpd.server_close()
+
+
+def status(url, data=None, headers=None):
+    request = urllib.request.Request(url, data=data, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_health_reports_warm_up(running_server):
+    ready = threading.Event()
+    _, base = running_server(ready=ready)
+    assert status(base + "/health") == 503
+    ready.set()
+    assert status(base + "/health") == 200
+
+
+def test_health_without_ready_event_is_ok(running_server):
+    _, base = running_server()
+    assert status(base + "/health") == 200
+
+
+def test_wrong_or_non_ascii_secret_is_rejected(running_server):
+    server, base = running_server(secret="segreto")
+    body = b'{"update_id": 1}'
+    assert status(base + "/hook", body, {"X-Telegram-Bot-Api-Secret-Token": "sbagliato"}) == 403
+    assert status(base + "/hook", body, {"X-Telegram-Bot-Api-Secret-Token": "segretò"}) == 403
+    assert server.rejected_count == 2
+    assert status(base + "/hook", body, {"X-Telegram-Bot-Api-Secret-Token": "segreto"}) == 200
+    assert server.updates.get_nowait() == {"update_id": 1}
+
+
+@pytest.mark.parametrize("length", ["abc", "-5", ""])
+def test_invalid_content_length_is_bad_request(running_server, length):
+    import http.client
+
+    server, base = running_server()
+    connection = http.client.HTTPConnection("127.0.0.1", server.httpd.server_address[1], timeout=5)
+    connection.putrequest("POST", "/hook")
+    connection.putheader("Content-Length", length)
+    connection.endheaders()
+    assert connection.getresponse().status == 400
+    connection.close()
+    assert server.received_count == 0